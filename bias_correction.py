@@ -18,23 +18,48 @@ import sys
 import numpy as np
 from astropy.io import fits
 from pathlib import Path
-import getconfig
+import masks
+import detector
+import binning
+import streaming
+import buffers
+import registry
+import linearity
+from calibration import subtract_bias  # NEW: shared correction kernel (calibration.py)
 ## import mkmasterbias  # Import master bias creation
 import warnings
 warnings.filterwarnings("ignore")
 
 
-def apply_bias_correction(list_in, list_out, mb):
+def apply_bias_correction(list_in, list_out, mb, cfg, files=None, verbose=False):
     # Applies bias correction to all non-bias FITS frames in the directory
     #path = Path(directory)
-    mb_data = fits.open(mb, mode="readonly")[0].data.astype(np.float32)
+    # NEW: settings from the given 'cfg' (CalibConfig), no module globals
+    expected_bias = cfg.get("HEADER_SPECIFICATION", "bias_label", "BIAS").strip().upper()
+    # NEW: inputs selected from the frame registry (biases are not opened at all)
+    frames = registry.registry_from_config(cfg)
+    files_in = (files if files is not None else
+                registry.stage_inputs(frames, list_in, "file", exclude=("BIAS",)))
+    # NEW: with [IMAGE_PROCESSING] strip_rows > 0 (or frames too large for the
+    # memory budget) frames are corrected band by band and only the matching
+    # bands of the masterbias are read
+    strip_rows = streaming.strip_rows_from_config(cfg, files_in)
+    if strip_rows:
+        mb_bands = streaming.MasterBands(mb, binning.MASTER_BINNING["masterbias"])
+    else:
+        with fits.open(mb, mode="readonly") as mb_hdul:
+            mb_data = mb_hdul[0].data.astype(np.float32)
+            mb_header = mb_hdul[0].header
+    mb_binned = {}
     ## print(mb_data), exit()
     type_keyword = cfg.get("HEADER_SPECIFICATION", "image_type_keyword")
-    expected_bias = full_config["HEADER_SPECIFICATION"].get("bias_label", "BIAS").strip().upper()
+    use_masks = cfg.get("MASKS", "use_masks", False)
+    # NEW: non-linearity corrected in the bias subtraction pass ([LINEARITY])
+    lin = linearity.linearity_from_config(cfg)
+    lin_cards = {linearity.HEADER_KEYWORD: lin.header_card()} if lin is not None else None
+    work = buffers.worker_buffers()  # NEW: float32 frame buffer reused for all frames
     files_out = []
 
-    with open(list_in) as f:
-        files_in = f.read().splitlines()
     ## print(files), exit()        
 
     for file in files_in:
@@ -51,30 +76,63 @@ def apply_bias_correction(list_in, list_out, mb):
                 ## else:
                 ##    print(file)
 
-                # Read image data and apply bias correction
-                data = hdul[0].data.astype(np.float32)
-                corrected_data = data - mb_data  # Bias subtraction
-                ## print(corrected_data), exit()
                 extention = str(file.split(".")[-1])
                 new_filepath = str(file.split("."+extention)[0]) + "-b." + extention
+
+                if strip_rows:
+                    level = masks.saturation_level(header, cfg) if use_masks else None
+                    streaming.correct_in_strips(
+                        hdul[0], new_filepath, cfg,
+                        lambda raw, overscan, rows: subtract_bias(raw, overscan,
+                                                                  mb_bands.band(rows, raw.shape[1], header),
+                                                                  linearity=lin),
+                        strip_rows, saturation_level=level, header_cards=lin_cards)
+                    if verbose:
+                        print(f"Bias-subtracted file saved: {new_filepath}")
+                    files_out.append((file, new_filepath))
+                    continue
+
+                # Read image data (trimmed to the useful detector area,
+                # overscan level subtracted) and apply bias correction
+                raw, overscan, header = detector.read_trimmed(hdul[0], cfg)
+                # NEW: masterbias binned to the frame binning if needed
+                mb_frame = binning.match_binning(mb_data, mb_header, header,
+                                                 binning.MASTER_BINNING["masterbias"], mb_binned)
+                corrected_data = subtract_bias(raw, overscan, mb_frame,  # Bias subtraction
+                                               out=work.get("frame", raw.shape), linearity=lin)
+                if lin is not None:
+                    header.update(lin_cards)
+                ## print(corrected_data), exit()
                 ##print(new_filepath), exit()
 
                 # Save the bias-corrected image
-                hdu = fits.PrimaryHDU(corrected_data.astype(np.float32), header=header)
+                hdu = fits.PrimaryHDU(corrected_data, header=header)
+                hdus = [hdu]
+                # NEW: saturation flags of the raw data, bit-packed
+                if use_masks:
+                    sat_hdu = masks.saturation_hdu(raw, masks.saturation_level(header, cfg))
+                    if sat_hdu is not None:
+                        hdus.append(sat_hdu)
                 
                 ## TO DO: add header entries
-                hdu.writeto(new_filepath, overwrite=True)
+                fits.HDUList(hdus).writeto(new_filepath, overwrite=True)
                 hdul.flush()
                 if verbose:
                     print(f"Bias-subtracted file saved: {new_filepath}")
-                files_out.append(new_filepath)
+                files_out.append((file, new_filepath))
                 
         except Exception as e:
             print(f"Skipping {file}: {e}")
 
-        with open(list_out, "w", encoding="utf-8") as f:
-            for item in files_out:
-                f.write(item + "\n")
+    # NEW: outputs written once, after the loop
+    if list_out is not None:
+        registry.write_list(list_out, [output for _, output in files_out])
+    if frames is not None:
+        frames.record_outputs("b", files_out)
+
+    if strip_rows:
+        mb_bands.close()
+    return files_out
 
 
 if __name__ == "__main__":
@@ -100,14 +158,11 @@ if __name__ == "__main__":
     ## obs_name = cfg.get("GENERAL", "observatory_name")
     ## gain = cfg.get("DEFAULT_VALUES", "gain")
     ## print(f"Observatory: {obs_name}, Gain: {gain}")
-    working_dir = cfg.get("DATA_STRUCTURE", "working_dir")
-    results_dir = cfg.get("DATA_STRUCTURE", "results_dir")
-    results_aux_dir = cfg.get("DATA_STRUCTURE", "results_aux_dir")
     
     '''
     Applying procedures
     '''
-    apply_bias_correction(list_of_files_in, list_of_files_out, masterbias_file)
+    apply_bias_correction(list_of_files_in, list_of_files_out, masterbias_file, cfg, verbose=verbose)
     sys.exit(0)
     
 ### END
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: binning.py
+# Description:
+#   Software binning of FITS frames and master calibration files.
+#   - arbitrary NX x NY binning by sum or mean (vectorized reshape, rows and
+#     columns not filling a whole bin at the top/right edge are dropped),
+#   - header and WCS are updated for the binned pixel grid,
+#   - batches of files are binned in parallel worker processes,
+#   - binned masters are derived from existing 1x1 masters, so a night
+#     observed with 2x2 binning can reuse the 1x1 calibration library.
+#
+#   On-chip binning adds the charge of the binned pixels but the bias
+#   offset only once per read, so binned masters are made as:
+#     masterbias -> mean, masterdark -> sum, normalized masterflat -> mean,
+#     bad-pixel mask -> bitwise OR of the flags.
+# =============================================================================
+
+import sys
+import argparse
+import numpy as np
+from astropy.io import fits
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+
+# binning method of every master type
+MASTER_BINNING = {
+    "masterbias": "mean",
+    "masterdark": "sum",
+    "masterflat": "mean",
+    "badpixmask": "or",
+}
+
+
+# ---------------------------------------------------------------------------
+# Function: bin_array
+# Description:
+#   Bins a 2D array by *nx* columns and *ny* rows. Methods: 'sum', 'mean'
+#   and 'or' (bitwise OR for integer masks).
+# ---------------------------------------------------------------------------
+def bin_array(data, nx, ny=None, method="sum"):
+    ny = nx if ny is None else ny
+    if nx < 1 or ny < 1:
+        raise ValueError(f"Invalid binning {nx}x{ny}.")
+    height, width = data.shape[0] // ny, data.shape[1] // nx
+    if height == 0 or width == 0:
+        raise ValueError(f"Frame of shape {data.shape} is smaller than one {nx}x{ny} bin.")
+    blocks = data[:height * ny, :width * nx].reshape(height, ny, width, nx)
+    if method == "sum":
+        return blocks.sum(axis=(1, 3), dtype=np.float32)
+    if method == "mean":
+        return blocks.mean(axis=(1, 3), dtype=np.float32)
+    if method == "or":
+        return np.bitwise_or.reduce(np.bitwise_or.reduce(blocks, axis=3), axis=1)
+    raise ValueError(f"Unsupported binning method '{method}'.")
+
+
+# ---------------------------------------------------------------------------
+# Function: binned_header
+# Description:
+#   Returns a copy of *header* describing the binned frame: binning
+#   keywords, WCS reference pixel and pixel scale (CDELT/CD), IRAF LTM/LTV.
+# ---------------------------------------------------------------------------
+def binned_header(header, nx, ny):
+    header = header.copy()
+    for keyword in ("NAXIS1", "NAXIS2"):
+        header.remove(keyword, ignore_missing=True)
+    for axis, factor in (("1", nx), ("2", ny)):
+        if "CRPIX" + axis in header:
+            header["CRPIX" + axis] = (header["CRPIX" + axis] - 0.5) / factor + 0.5
+        if "CDELT" + axis in header:
+            header["CDELT" + axis] = header["CDELT" + axis] * factor
+        # CDi_j scales with the pixel axis j
+        for i in ("1", "2"):
+            if f"CD{i}_{axis}" in header:
+                header[f"CD{i}_{axis}"] = header[f"CD{i}_{axis}"] * factor
+        if f"LTM{axis}_{axis}" in header or "LTV" + axis in header:
+            header[f"LTM{axis}_{axis}"] = header.get(f"LTM{axis}_{axis}", 1.0) / factor
+            header["LTV" + axis] = (header.get("LTV" + axis, 0.0) - 0.5) / factor + 0.5
+    header["XBINNING"] = (int(header.get("XBINNING", 1)) * nx, "Binning factor in X")
+    header["YBINNING"] = (int(header.get("YBINNING", 1)) * ny, "Binning factor in Y")
+    header["CCDSUM"] = f"{header['XBINNING']} {header['YBINNING']}"
+    header["SWBIN"] = (f"{nx}x{ny}", "Software binning applied by calib-fits")
+    return header
+
+
+# ---------------------------------------------------------------------------
+# Function: frame_binning
+# Description:
+#   (XBINNING, YBINNING) of a frame, 1x1 when the keywords are missing.
+# ---------------------------------------------------------------------------
+def frame_binning(header):
+    return int(header.get("XBINNING", 1)), int(header.get("YBINNING", 1))
+
+
+# ---------------------------------------------------------------------------
+# Function: copy_binning
+# Description:
+#   Copies the binning keywords of a source frame into a master header, so
+#   masters made from binned frames are never binned a second time.
+# ---------------------------------------------------------------------------
+def copy_binning(source_header, header):
+    xbin, ybin = frame_binning(source_header)
+    header["XBINNING"] = (xbin, "Binning factor in X")
+    header["YBINNING"] = (ybin, "Binning factor in Y")
+    return header
+
+
+# ---------------------------------------------------------------------------
+# Function: match_binning
+# Description:
+#   Returns *master* binned to the binning of a frame with *frame_header*.
+#   The frame binning must be an integer multiple of the master binning.
+#   Results are kept in *cache* (dict) for the following frames.
+# ---------------------------------------------------------------------------
+def match_binning(master, master_header, frame_header, method, cache=None):
+    master_bin = frame_binning(master_header)
+    frame_bin = frame_binning(frame_header)
+    if frame_bin == master_bin:
+        return master
+    if cache is not None and frame_bin in cache:
+        return cache[frame_bin]
+    if frame_bin[0] % master_bin[0] or frame_bin[1] % master_bin[1]:
+        raise ValueError(f"Frame binning {frame_bin[0]}x{frame_bin[1]} cannot be made from "
+                         f"master binning {master_bin[0]}x{master_bin[1]}")
+    binned = bin_array(master, frame_bin[0] // master_bin[0], frame_bin[1] // master_bin[1], method)
+    if cache is not None:
+        cache[frame_bin] = binned
+    return binned
+
+
+# ---------------------------------------------------------------------------
+# Function: master_cutout
+# Description:
+#   Cutout of a master for a window (rows, cols) given in master pixels of
+#   the frame binning. *source* is anything sliceable (HDU.section or an
+#   array); a master with a finer binning is cut out on its own pixel grid
+#   and binned with *method*, so only the needed pixels are read.
+# ---------------------------------------------------------------------------
+def master_cutout(source, master_header, rows, cols, frame_header, method):
+    master_bin = frame_binning(master_header)
+    frame_bin = frame_binning(frame_header)
+    if frame_bin[0] % master_bin[0] or frame_bin[1] % master_bin[1]:
+        raise ValueError(f"Frame binning {frame_bin[0]}x{frame_bin[1]} cannot be made from "
+                         f"master binning {master_bin[0]}x{master_bin[1]}")
+    fx, fy = frame_bin[0] // master_bin[0], frame_bin[1] // master_bin[1]
+    if rows.start < 0 or cols.start < 0:
+        raise ValueError("Window lies outside the master frame.")
+    dtype = np.uint8 if method == "or" else np.float32  # masks keep their bit flags
+    cutout = np.asarray(source[rows.start * fy:rows.stop * fy, cols.start * fx:cols.stop * fx], dtype=dtype)
+    if cutout.shape != ((rows.stop - rows.start) * fy, (cols.stop - cols.start) * fx):
+        raise ValueError("Window lies outside the master frame.")
+    if (fx, fy) != (1, 1):
+        cutout = bin_array(cutout, fx, fy, method)
+    return cutout
+
+
+# ---------------------------------------------------------------------------
+# Function: bin_file
+# Description:
+#   Bins the primary HDU of *input_path* and writes it to *output_path*.
+# ---------------------------------------------------------------------------
+def bin_file(input_path, output_path, nx, ny=None, method="sum"):
+    ny = nx if ny is None else ny
+    with fits.open(input_path) as hdul:
+        binned = bin_array(hdul[0].data, nx, ny, method)
+        header = binned_header(hdul[0].header, nx, ny)
+        header["SWBINMET"] = (method, "Software binning method")
+    if method == "or":
+        binned = binned.astype(np.uint8)
+    fits.PrimaryHDU(binned, header=header).writeto(output_path, overwrite=True)
+    return str(output_path)
+
+
+# ---------------------------------------------------------------------------
+# Function: batch_bin
+# Description:
+#   Bins all *files* in parallel (one process per CPU by default) and
+#   writes them with the same names into *output_dir*.
+# ---------------------------------------------------------------------------
+def batch_bin(files, output_dir, nx, ny=None, method="sum", workers=None, verbose=False):
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    outputs = [output_dir / Path(f).name for f in files]
+    done = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(bin_file, f, o, nx, ny, method) for f, o in zip(files, outputs)]
+        for file, job in zip(files, jobs):
+            try:
+                done.append(job.result())
+                if verbose:
+                    print(f"Binned and saved: {done[-1]}")
+            except Exception as e:
+                print(f"Skipping {file}: {e}")
+    return done
+
+
+# ---------------------------------------------------------------------------
+# Function: master_binning_method
+# Description:
+#   Binning method for a master file, chosen by its file name.
+# ---------------------------------------------------------------------------
+def master_binning_method(path):
+    name = Path(path).name
+    for prefix, method in MASTER_BINNING.items():
+        if name.startswith(prefix):
+            return method
+    return None
+
+
+# ---------------------------------------------------------------------------
+# Function: bin_masters
+# Description:
+#   Derives binned masters from all 1x1 masters found in *master_dir*
+#   (master bias, master dark, normalized master flats, bad-pixel mask).
+#   Results go to *output_dir* (default: <master_dir>/bin<NX>x<NY>).
+# ---------------------------------------------------------------------------
+def bin_masters(master_dir, nx, ny=None, output_dir=None, workers=None, verbose=False):
+    ny = nx if ny is None else ny
+    master_dir = Path(master_dir)
+    output_dir = Path(output_dir) if output_dir else master_dir / f"bin{nx}x{ny}"
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    masters = [p for p in sorted(master_dir.glob("*.fits")) if master_binning_method(p)]
+    # raw (not normalized) master flats are not needed for calibration
+    masters = [p for p in masters if not (p.name.startswith("masterflat") and not p.stem.endswith("_norm"))]
+    outputs = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(bin_file, p, output_dir / p.name, nx, ny, master_binning_method(p))
+                for p in masters]
+        for path, job in zip(masters, jobs):
+            outputs.append(job.result())
+            if verbose:
+                print(f"[INFO] Binned master {path.name} ({master_binning_method(path)}) -> {outputs[-1]}")
+    return outputs
+
+
+# ---------------------------------------------------------------------------
+# Helper: collect_input_files
+# Description:
+#   Files from a list file (.lst/.txt), a directory or given FITS names.
+# ---------------------------------------------------------------------------
+def collect_input_files(inputs):
+    files = []
+    for item in inputs:
+        path = Path(item)
+        if path.is_dir():
+            files += sorted(str(p) for p in path.iterdir()
+                            if p.suffix in (".fits", ".fit", ".FITS", ".FIT"))
+        elif path.suffix in (".lst", ".txt"):
+            with open(path) as f:
+                files += [line.strip() for line in f if line.strip()]
+        else:
+            files.append(str(path))
+    return files
+
+
+# ---------------------------------------------------------------------------
+# Main block
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bin FITS frames or master calibration files.")
+    parser.add_argument("inputs", nargs="*", help="FITS files, list files (.lst/.txt) or directories")
+    parser.add_argument("-x", "--xbin", type=int, default=2, help="binning factor in X")
+    parser.add_argument("-y", "--ybin", type=int, help="binning factor in Y (default: same as X)")
+    parser.add_argument("-m", "--method", choices=("sum", "mean"), default="sum",
+                        help="binning method for frames")
+    parser.add_argument("-o", "--output", type=str, help="output directory")
+    parser.add_argument("-M", "--masters", type=str,
+                        help="directory with 1x1 masters to derive binned masters from")
+    parser.add_argument("-j", "--jobs", type=int, help="number of parallel workers (default: all CPUs)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
+    args = parser.parse_args()
+    ybin = args.ybin or args.xbin
+
+    if args.masters:
+        bin_masters(args.masters, args.xbin, ybin, args.output, args.jobs, args.verbose)
+    files = collect_input_files(args.inputs)
+    if files:
+        batch_bin(files, args.output or f"./binned_{args.xbin}x{ybin}", args.xbin, ybin,
+                  args.method, args.jobs, args.verbose)
+    elif not args.masters:
+        parser.print_usage()
+        sys.exit(1)
+    sys.exit(0)
+
+### END
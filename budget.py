@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: budget.py
+# Description:
+#   Memory budget of the pipeline ([PERFORMANCE] memory_budget).
+#   Every stage used to pick its footprint implicitly (the whole bias cube,
+#   all darks, all flats of a filter at once). The planner here derives the
+#   sizes from one budget instead:
+#   - tile height of the master combination: the frames are stacked and
+#     combined band by band (streaming.StackedBands),
+#   - strip height of the correction stages (streaming.correct_in_strips)
+#     when a whole frame does not fit,
+#   - number of workers of calib.py.
+#   The budget is shared by the workers of a run: calib.py calls
+#   share_between(workers), the master scripts it starts inherit the share.
+#   With memory_budget = 0 nothing is limited and every stage works on
+#   whole frames as before.
+# =============================================================================
+
+import os
+import re
+import sys
+import argparse
+
+
+# interpreter, numpy and astropy themselves
+RESERVED = 200 * 2**20
+# stacked float32 sample plus the temporaries of sigma clipping / median
+STACK_BYTES_PER_PIXEL = 16
+# correction of one frame: raw data, float32 frame and scratch buffers,
+# master, output and mask copies
+CORRECTION_BYTES_PER_PIXEL = 24
+MIN_ROWS = 8
+
+WORKERS_VARIABLE = "CALIB_BUDGET_WORKERS"
+
+_UNITS = {"": 2**20, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+# ---------------------------------------------------------------------------
+# Function: parse_size
+# Description:
+#   Size in bytes of a budget like '4G', '512M', '512MB' or 1024 (MB).
+#   0, 'none' and empty values give None (unlimited).
+# ---------------------------------------------------------------------------
+def parse_size(value):
+    if value is None:
+        return None
+    text = str(value).strip().upper()
+    if text in ("", "0", "NONE", "FALSE"):
+        return None
+    match = re.fullmatch(r"([0-9.]+)\s*([KMGT]?)I?B?", text)
+    if not match:
+        raise ValueError(f"Invalid memory size '{value}'.")
+    size = int(float(match.group(1)) * _UNITS[match.group(2)])
+    return size or None
+
+
+# ---------------------------------------------------------------------------
+# Function: share_between
+# Description:
+#   Splits the share of the budget of this process between *workers*
+#   concurrent workers; the scripts it starts inherit the split (a run of
+#   two partitions with four workers each plans with 1/8 of the budget).
+# ---------------------------------------------------------------------------
+def share_between(workers):
+    os.environ[WORKERS_VARIABLE] = str(shared_by() * max(1, int(workers)))
+
+
+def shared_by():
+    try:
+        return max(1, int(os.environ.get(WORKERS_VARIABLE, 1)))
+    except ValueError:
+        return 1
+
+
+# ---------------------------------------------------------------------------
+# Class: MemoryPlan
+# Description:
+#   Sizes derived from a budget (bytes, None = unlimited) shared by
+#   *workers* workers. All sizes are per worker.
+# ---------------------------------------------------------------------------
+class MemoryPlan:
+    def __init__(self, budget=None, workers=1):
+        self.budget = budget
+        self.workers_sharing = max(1, int(workers))
+
+    @property
+    def unlimited(self):
+        return self.budget is None
+
+    def available(self, fixed=0):
+        '''Bytes one worker may use besides *fixed* bytes it already holds.'''
+        if self.budget is None:
+            return None
+        return max(0, (self.budget - RESERVED) // self.workers_sharing - fixed)
+
+    # -----------------------------------------------------------------------
+    # Method: tile_rows
+    # Description:
+    #   Rows per band when *n_frames* frames of *height* x *width* pixels
+    #   are stacked and combined; *fixed* bytes (master, statistics) are
+    #   held for the whole combination. The full height if all fits.
+    # -----------------------------------------------------------------------
+    def tile_rows(self, n_frames, height, width, fixed=0, bytes_per_pixel=STACK_BYTES_PER_PIXEL):
+        if self.unlimited:
+            return height
+        rows = self.available(fixed) // max(1, n_frames * width * bytes_per_pixel)
+        return int(min(height, max(MIN_ROWS, rows)))
+
+    # -----------------------------------------------------------------------
+    # Method: strip_rows
+    # Description:
+    #   Strip height of the correction stages: 0 when a whole frame fits,
+    #   otherwise the rows of a band that fits.
+    # -----------------------------------------------------------------------
+    def strip_rows(self, height, width):
+        if self.unlimited or correction_bytes(height, width) <= self.available():
+            return 0
+        rows = self.available() // (width * CORRECTION_BYTES_PER_PIXEL)
+        return int(min(height, max(MIN_ROWS, rows)))
+
+    # -----------------------------------------------------------------------
+    # Method: workers
+    # Description:
+    #   Number of workers (at most *requested*, default all CPUs) that fit
+    #   into the budget with *per_worker* bytes each; at least one.
+    # -----------------------------------------------------------------------
+    def workers(self, per_worker, requested=None):
+        requested = requested or os.cpu_count() or 1
+        if self.unlimited:
+            return requested
+        return int(max(1, min(requested, self.available() // max(1, per_worker))))
+
+
+def correction_bytes(height, width):
+    return height * width * CORRECTION_BYTES_PER_PIXEL
+
+
+# ---------------------------------------------------------------------------
+# Function: plan_from_config
+# Description:
+#   MemoryPlan of [PERFORMANCE] memory_budget for the workers sharing it.
+# ---------------------------------------------------------------------------
+def plan_from_config(cfg, workers=None):
+    budget = parse_size(cfg.get("PERFORMANCE", "memory_budget", 0))
+    return MemoryPlan(budget, workers if workers is not None else shared_by())
+
+
+# ---------------------------------------------------------------------------
+# Main block: print the plan for a frame size and number of frames.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the memory plan of a budget.")
+    parser.add_argument("-c", "--config", type=str, default="config.ini", help="Specify path to config file")
+    parser.add_argument("-b", "--budget", type=str, help="budget (overrides the config), e.g. 4G")
+    parser.add_argument("-s", "--size", type=str, default="4096x4096", help="frame size WIDTHxHEIGHT")
+    parser.add_argument("-n", "--frames", type=int, default=20, help="frames combined into one master")
+    parser.add_argument("-j", "--jobs", type=int, help="requested workers (default: all CPUs)")
+    args = parser.parse_args()
+
+    try:
+        width, height = (int(v) for v in args.size.lower().split("x"))
+        if args.budget is not None:
+            budget = parse_size(args.budget)
+        else:
+            from calib_config import CalibConfig
+            budget = parse_size(CalibConfig(args.config).get("PERFORMANCE", "memory_budget", 0))
+    except (ValueError, FileNotFoundError) as e:
+        print(f"[ERROR]: {e}")
+        sys.exit(1)
+
+    workers = MemoryPlan(budget).workers(correction_bytes(height, width), args.jobs)
+    plan = MemoryPlan(budget, workers)
+    print(f"budget:        {'unlimited' if budget is None else f'{budget / 2**20:.0f} MB'}")
+    print(f"workers:       {workers}")
+    print(f"strip rows:    {plan.strip_rows(height, width) or 'whole frame'}")
+    print(f"combine rows:  {plan.tile_rows(args.frames, height, width, fixed=height * width * 4)}"
+          f" of {height} ({args.frames} frames)")
+    sys.exit(0)
+
+### END
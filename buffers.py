@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: buffers.py
+# Description:
+#   Reusable work buffers for the correction loops.
+#   Every full-frame allocation in a hot loop costs a page-faulted pass over
+#   tens of MB. The correction kernels (subtract_bias, subtract_dark,
+#   divide_flat) write into buffers taken from a WorkBuffers pool instead,
+#   so a worker allocates its float32 frame buffer once and reuses it for
+#   every frame of the same shape.
+#   One pool belongs to one worker: worker_buffers() gives every thread
+#   its own pool.
+# =============================================================================
+
+import threading
+import numpy as np
+
+
+# ---------------------------------------------------------------------------
+# Class: WorkBuffers
+# Description:
+#   Named buffers, reallocated only when the requested shape or dtype
+#   changes.
+# ---------------------------------------------------------------------------
+class WorkBuffers:
+    def __init__(self):
+        self._buffers = {}
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=np.float32):
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+            self.allocations += 1
+        return buffer
+
+    def clear(self):
+        self._buffers = {}
+
+
+_local = threading.local()
+
+
+# ---------------------------------------------------------------------------
+# Function: worker_buffers
+# Description:
+#   WorkBuffers pool of the calling thread (created on first use).
+# ---------------------------------------------------------------------------
+def worker_buffers():
+    if not hasattr(_local, "buffers"):
+        _local.buffers = WorkBuffers()
+    return _local.buffers
+
+### END
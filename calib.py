@@ -1,77 +1,250 @@
-# 
-# 
-# 
+#!/usr/bin/env python3
+
 # =============================================================================
 # Filename: calib.py
 # Description:
-#   ff
-#   
-#   
-#   
+#   Main script running the calibration pipeline (Python version of
+#   calib.sh). The stages are tasks of a dependency graph (scheduler.py)
+#   instead of a fixed sequence:
+#   - masterbias, masterdark and masterflats are made by their scripts,
+#   - bias, dark and flat correction run in-process on groups of frames of
+#     one image type and filter, one group per worker,
+#   - every task starts as soon as the tasks it needs are done, e.g. the
+#     bias correction of the science frames runs next to the masterdark,
+#     and the master flats are made while science frames are still being
+#     dark corrected.
+#   Frames are taken from the frame registry written in the first step.
+#   The number of workers is limited by [PERFORMANCE] memory_budget.
+#   A night with frames of several camera modes is split into one run per
+#   mode ([CAMERA_MODES] partition_by_mode, see partitions.py). With
+#   '-c auto' the config is selected from the frame headers (site_config.py)
+#   and a batch of several observatories is split the same way.
 # =============================================================================
 
-
-# (0) Cleaning & preparing:
-
-
-
-
-# () Prepare all needed lists of files:
-dir_path = "test-data-1-B"
-lst_path = ""
-
-python3 calib_prep_lists.py -d dir_path
-
-
-
-
-
-
-exit()
-
-# () Making masterbias file
-python3 mkmasterbias.py -l test-data-1-B.cat -c config/BIALKOW_Andor-DW432.ini
-
-
-
-
-# () Subtracting masterbias from other files
-
-
-
-
-exit()
-
-
-
-
-
-
-
-python3 bias_correction.py test_Bialkow_1.cat masterbias.fits 
-
-
-# (3)
-
-
-
-# (4) 
-
-
-
-# (5)
-
-
-
-# (6) 
-
-
-
-# (7) 
-
-
-
-# (8)
-
-
-
+import os
+import sys
+import math
+import argparse
+from collections import defaultdict
+from pathlib import Path
+from astropy.io import fits
+import calib_prep_lists
+import budget
+import partitions
+import site_config
+import registry
+import scheduler
+import bias_correction
+import dark_correction
+import flat_correction
+
+
+def chunks(items, n_chunks):
+    size = max(1, math.ceil(len(items) / max(1, n_chunks)))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+# ---------------------------------------------------------------------------
+# Function: build_graph
+# Description:
+#   Adds all tasks of one night to *graph*. *groups* maps (image type,
+#   filter) to the raw files of the group.
+# ---------------------------------------------------------------------------
+def build_graph(graph, groups, config_file, cfg, base_list, workers, verbose):
+    working_dir = cfg.get("DATA_STRUCTURE", "working_dir")
+    python = sys.executable
+    flag = ["-v"] if verbose else []
+
+    def outputs(names):
+        return [output for name in names for _, output in graph.results[name]]
+
+    def list_command(command, list_path, names):
+        registry.write_list(list_path, outputs(names))
+        return scheduler.run_command(command)
+
+    def existing_masters(paths):
+        print(f"Using existing {', '.join(Path(path).name for path in paths)} (no frames in this run).")
+        return 0
+
+    masterbias = working_dir + "/masterbias.fits"
+    masterdark = working_dir + "/masterdark.fits"
+    masterflats = sorted(str(path) for path in Path(working_dir).glob("masterflat_*_norm.fits"))
+    # NEW: a night without calibration frames of a type uses the masters
+    # already in the working directory (e.g. shared by campaign.py)
+    if not any(imagetyp == "BIAS" for imagetyp, _ in groups) and os.path.exists(masterbias):
+        graph.add("masterbias", existing_masters, [masterbias])
+    else:
+        graph.add("masterbias", scheduler.run_command,
+                  [python, "mkmasterbias.py", "-l", base_list, "-c", config_file] + flag)
+
+    bias_tasks, dark_tasks = defaultdict(list), defaultdict(list)
+    for (imagetyp, filt), files in sorted(groups.items()):
+        if imagetyp == "BIAS":
+            continue
+        for number, chunk in enumerate(chunks(files, workers)):
+            name = f"bias:{imagetyp}:{filt}:{number}"
+            graph.add(name, bias_correction.apply_bias_correction, None, None, masterbias, cfg, files=chunk,
+                      verbose=verbose, deps=["masterbias"])
+            bias_tasks[imagetyp, filt].append(name)
+
+    dark_bias_tasks = [name for (imagetyp, _), names in bias_tasks.items() if imagetyp == "DARK"
+                       for name in names]
+    if not dark_bias_tasks and os.path.exists(masterdark):
+        graph.add("masterdark", existing_masters, [masterdark])
+    else:
+        graph.add("masterdark", list_command,
+                  [python, "mkmasterdark.py", "-l", working_dir + "/darks-b.lst", "-o", "masterdark.fits",
+                   "-c", config_file] + flag, working_dir + "/darks-b.lst", dark_bias_tasks,
+                  deps=dark_bias_tasks)
+
+    for (imagetyp, filt), names in bias_tasks.items():
+        if imagetyp == "DARK":
+            continue
+        for bias_task in names:
+            name = bias_task.replace("bias:", "dark:", 1)
+            graph.add(name, lambda task=bias_task: dark_correction.apply_dark_correction(
+                None, None, masterdark, cfg, files=outputs([task]), verbose=verbose),
+                      deps=["masterdark", bias_task])
+            dark_tasks[imagetyp, filt].append(name)
+
+    flat_dark_tasks = [name for (imagetyp, _), names in dark_tasks.items() if imagetyp == "FLAT"
+                       for name in names]
+    if not flat_dark_tasks and masterflats:
+        graph.add("masterflats", existing_masters, masterflats)
+    else:
+        graph.add("masterflats", list_command,
+                  [python, "mkmasterflats.py", config_file, working_dir + "/flats-bd.lst"],
+                  working_dir + "/flats-bd.lst", flat_dark_tasks, deps=flat_dark_tasks)
+
+    for (imagetyp, filt), names in dark_tasks.items():
+        if imagetyp != "OBJECT":
+            continue
+        for dark_task in names:
+            graph.add(dark_task.replace("dark:", "flat:", 1),
+                      lambda task=dark_task: flat_correction.apply_flat_correction(
+                          None, None, cfg, files=outputs([task]), verbose=verbose),
+                      deps=["masterflats", dark_task])
+
+
+# ---------------------------------------------------------------------------
+# Function: run_partitions
+# Description:
+#   Calibrates every partition of the night as a run of its own with a
+#   derived config and list file (partitions.py); all partitions run at the
+#   same time and share the workers and the memory budget.
+#   *runs* maps partition names to (config file, CalibConfig, files);
+#   *split_modes* lets a partition split by camera mode again.
+# ---------------------------------------------------------------------------
+def run_partitions(runs, base_name, jobs, verbose, split_modes=False):
+    graph = scheduler.Scheduler(len(runs), verbose=verbose)
+    budget.share_between(len(runs))
+    jobs_each = str(max(1, jobs // len(runs)))
+    for name, (config_file, cfg, files) in runs.items():
+        config_path = Path(cfg.get("DATA_STRUCTURE", "working_dir")) / name / "config.ini"
+        partitions.write_partition_config(config_file, cfg, name, config_path, split_modes)
+        list_path = f"{base_name}-{name}.lst"
+        registry.write_list(list_path, files)
+        graph.add(name, scheduler.run_command,
+                  [sys.executable, "calib.py", "-l", list_path, "-c", str(config_path), "-j", jobs_each] +
+                  (["-v"] if verbose else []))
+    ok = graph.run()
+    for name, (_, cfg, files) in runs.items():
+        status = "done" if name in graph.results else "FAILED"
+        print(f"Partition {name}: {len(files)} frames, {status} (results in "
+              f"{cfg.get('DATA_STRUCTURE', 'results_dir')}/{name}).")
+    return ok
+
+
+# ---------------------------------------------------------------------------
+# Main block
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the calibration pipeline as a dependency graph.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("-d", "--directory", type=str, help="directory containing FITS files")
+    group.add_argument("-l", "--list", type=str, help="list file with FITS names")
+    parser.add_argument("-c", "--config", type=str, default="config.ini",
+                        help="Specify path to config file, 'auto' to select it from the frame headers")
+    parser.add_argument("-C", "--config-dir", type=str, default=site_config.DEFAULT_CONFIG_DIR,
+                        help="directory with the observatory configs for '-c auto'")
+    parser.add_argument("-R", "--recursive", action="store_true", help="also scan subdirectories (-d)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="number of workers (fewer if the memory budget requires)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
+    args = parser.parse_args()
+
+    # (1) frames, config, frame registry and base list
+    if args.directory:
+        source = Path(args.directory).expanduser().resolve()
+        records = calib_prep_lists.scan_directory(source, recursive=args.recursive)
+        originals = [record.path for record in records]
+    else:
+        source = Path(args.list).expanduser().resolve()
+        originals = [str(Path(p).expanduser().resolve()) for p in calib_prep_lists.read_list_file(source)]
+        records = None
+    if not originals:
+        print("[ERROR]: No FITS files found.")
+        sys.exit(1)
+
+    from calib_config import CalibConfig
+    # NEW: with '-c auto' every frame gets the config of its observatory
+    # (TELESCOP/INSTRUME), mixed batches are split by config
+    if args.config == "auto":
+        sites, unmatched = site_config.ConfigRegistry(args.config_dir).partition(originals)
+        for file in unmatched:
+            print(f"Skipping {file}: no config in '{args.config_dir}' matches its header")
+        if not sites:
+            print("[ERROR]: No frames with a matching config.")
+            sys.exit(1)
+        if len(sites) > 1:
+            runs = {Path(path).stem: (path, CalibConfig(path), files) for path, files in sorted(sites.items())}
+            print(f"{len(runs)} observatory configs: {', '.join(runs)}")
+            base_name = source.with_suffix("").name
+            sys.exit(0 if run_partitions(runs, base_name, args.jobs, args.verbose, split_modes=True) else 1)
+        args.config, originals = next(iter(sites.items()))
+        records = None
+        print(f"Using config '{args.config}'.")
+
+    cfg = CalibConfig(args.config)
+    for key in ("working_dir", "results_dir", "results_aux_dir"):
+        Path(cfg.get("DATA_STRUCTURE", key)).mkdir(parents=True, exist_ok=True)
+
+    base_name = source.with_suffix("").name
+    registry_path = cfg.get("DATA_STRUCTURE", "frame_registry", registry.DEFAULT_REGISTRY)
+    calib_prep_lists.generate_lists(base_name, originals, registry_path, cfg, records=records)
+
+    rows = registry.FrameRegistry(registry_path).rows()
+
+    # NEW: a night with several camera modes is calibrated per mode
+    if partitions.partitioning_enabled(cfg):
+        modes = partitions.partition_frames(rows)
+        if len(modes) > 1:
+            print(f"{len(modes)} camera modes: {', '.join(modes)}")
+            runs = {mode: (args.config, cfg, files) for mode, files in modes.items()}
+            sys.exit(0 if run_partitions(runs, base_name, args.jobs, args.verbose) else 1)
+
+    groups = defaultdict(list)
+    for row in rows:
+        groups[row["imagetyp"], row["filter"]].append(row["file"])
+
+    # (2) workers that fit into [PERFORMANCE] memory_budget; the budget is
+    # split between them and the master scripts they start
+    header = fits.getheader(originals[0])
+    workers = budget.plan_from_config(cfg).workers(
+        budget.correction_bytes(header["NAXIS2"], header["NAXIS1"]), args.jobs)
+    budget.share_between(workers)
+    if args.verbose:
+        print(f"[INFO] Running with {workers} workers.")
+
+    # (3) stages as a dependency graph
+    graph = scheduler.Scheduler(workers, verbose=args.verbose)
+    build_graph(graph, groups, args.config, cfg, base_name + ".lst", workers, args.verbose)
+    ok = graph.run()
+
+    calibrated = [output for name, result in graph.results.items() if name.startswith("flat:")
+                  for _, output in result]
+    print(f"{len(calibrated)} calibrated frames, {len(graph.failed)} failed and "
+          f"{len(graph.skipped)} skipped tasks.")
+    sys.exit(0 if ok else 1)
+
+### END
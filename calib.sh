@@ -11,6 +11,7 @@
 # for tests:
 path_to_config_file="./config/LISNYKY_Moravian-C4-16000.ini"
 #path_to_config_file="./config/BIALKOW_Andor-DW432.ini"
+#path_to_config_file="auto"
 
 # (0) Cleaning & preparing:
 mkdir -p ./work ./results/aux &>/dev/null
@@ -29,6 +30,19 @@ test_checkflats_skip=0
 test_createflats_skip=0
 test_calibrateobjects_skip=0
 
+##################################################################
+## config selected from the frame headers (TELESCOP/INSTRUME) with
+## path_to_config_file="auto"; the frames must belong to one config
+## (calib.py -c auto also splits mixed batches)
+if [ "$path_to_config_file" = "auto" ]; then
+    path_to_config_file=$(shopt -s nullglob; python3 site_config.py -1 ${dir_path}/*.{fits,fit,FITS,FIT} 2>/dev/null | tail -1)
+    if [ -z "$path_to_config_file" ]; then
+        echo "No single config matches the frames in ${dir_path}."
+        exit 1
+    fi
+    echo "Using config ${path_to_config_file}"
+fi
+
 ##################################################################
 ## variables:
 list_IN="${dir_path}.lst"
@@ -48,14 +62,14 @@ list_bdf="${dir_path}-bdf.lst"
 
 ##################################################################
 ##### () Prepare all needed lists of files:
-# Some of these list may not be needed and will be deleted while the program 
-# is running. They are created for consistency and testing. 
-### TO DO: delete some of these in the future
+# Only the base list is written here; all frames are registered in the
+# frame registry (./work/frames.db), from which the stages select their
+# frames. Each stage writes the list of its outputs once when it is done.
 #
 # 
 echo -n "Preparing list of files..."
 if [ $test_preplists_skip != 1 ]; then
-    python3 calib_prep_lists.py -d ${dir_path}
+    python3 calib_prep_lists.py -d ${dir_path} -c ${path_to_config_file}
     ## echo $list_IN, $list_d, $list_b
     ## exit
     echo "done."
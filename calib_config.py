@@ -12,6 +12,7 @@ class CalibConfig:
         if not os.path.exists(config_path):
             raise FileNotFoundError(f"Configuration file '{config_path}' not found.")
 
+        self.path = config_path
         self._parser = configparser.ConfigParser()
         self._parser.optionxform = str  # preserve case sensitivity of keys
         self._parser.read(config_path)
@@ -7,12 +7,21 @@ Create calibrated‑preparation file lists for FITS images.
 
 One (and only one) of the following options must be given:
   -l <listfile>    text file containing a list of FITS filenames (one per line)
-  -d <directory>   directory containing FITS files to process
+  -d <directory>   directory containing FITS files to process (nested
+                   directories as well with -R)
   -a <archive>     .tar(.gz) | .tar.gz | .zip archive with FITS files
 
-For every entry ``file.fits`` in the base list, the script writes six
-additional lists in the current working directory, containing the filenames
-modified with calibration suffixes:
+Directories are scanned by ``scanner.py``: only the FITS header blocks are
+read, in parallel, and truncated or incomplete files are skipped.
+The base list ``<base>.lst`` is written (unless it exists) and all frames
+are registered in the frame registry (``registry.py``, SQLite, default
+``./work/frames.db``) with their image type, filter, exposure time and
+DATE-OBS. The calibration stages select their inputs from the registry and
+record the files they really write.
+
+With ``--legacy-lists`` the script also writes the old derived lists of
+predicted names for every entry ``file.fits`` in the base list, containing
+the filenames modified with calibration suffixes:
 
   * «-b»   → bias‑corrected  (file-b.fits)
   * «-d»   → dark‑corrected  (file-d.fits)
@@ -52,9 +61,19 @@ FITS_EXTENSIONS = {".fits", ".fit", ".FITS", ".FIT"}
 
 # ---- helpers --------------------------------------------------------------
 
-def fits_files_in_directory(directory: Path) -> List[str]:
-    """Return absolute paths of FITS files in *directory* (non‑recursive)."""
-    return sorted([str(p.resolve()) for p in directory.iterdir() if p.suffix in FITS_EXTENSIONS])
+def scan_directory(directory: Path, cfg=None, recursive: bool = False) -> list:
+    """Return scanner records of the complete FITS files in *directory*.
+
+    Only the header blocks are read (in parallel); truncated files and files
+    that are not FITS are skipped. With *recursive* nested directories are
+    scanned as well.
+    """
+    import scanner
+    return scanner.scan(directory, cfg, recursive=recursive)
+
+def fits_files_in_directory(directory: Path, recursive: bool = False) -> List[str]:
+    """Return absolute paths of the complete FITS files in *directory*."""
+    return [record.path for record in scan_directory(directory, recursive=recursive)]
 
 def modified_filename(original: str, suffix: str) -> str:
     """Return *original* with *suffix* inserted before the extension."""
@@ -74,16 +93,30 @@ def write_list_file(name: str, lines: Iterable[str]) -> None:
 
 # ---- core workflow --------------------------------------------------------
 
-def generate_lists(base_name: str, originals: List[str]) -> None:
-    """Given *originals* (absolute or resolved filenames) write the derivative list files."""
+def generate_lists(base_name: str, originals: List[str], registry_path: str | None = None,
+                   cfg=None, legacy: bool = False, records: list | None = None) -> None:
+    """Write the base list of *originals* and register them in the frame registry.
+
+    The frames are registered from scanner *records* (their headers are
+    sniffed here if not given). The derived lists of predicted names are
+    only written with *legacy*.
+    """
     # Base list
     if not Path(base_name + ".lst").exists():
         write_list_file(f"{base_name}.lst", originals)
 
+    if registry_path:
+        import registry
+        import scanner
+        if records is None:
+            records = scanner.scan(cfg=cfg, files=originals)
+        registry.FrameRegistry(registry_path).register_records(records, cfg, reset=True)
+
     # Derived lists
-    for suffix in SUFFIXES:
-        derived = [modified_filename(fn, suffix) for fn in originals]
-        write_list_file(f"{base_name}{suffix}.lst", derived)
+    if legacy:
+        for suffix in SUFFIXES:
+            derived = [modified_filename(fn, suffix) for fn in originals]
+            write_list_file(f"{base_name}{suffix}.lst", derived)
 
 # ---- argument parsing -----------------------------------------------------
 
@@ -96,12 +129,24 @@ def parse_args(argv: List[str] | None = None) -> argparse.Namespace:
     group.add_argument("-l", "--list", metavar="FILE", help="existing list file with FITS names")
     group.add_argument("-d", "--directory", metavar="DIR", help="directory containing FITS files")
     group.add_argument("-a", "--archive", metavar="ARCH", help="zip, tar, or tar.gz archive")
+    parser.add_argument("-c", "--config", metavar="FILE", help="config file (header keywords, registry path)")
+    parser.add_argument("-r", "--registry", metavar="DB", help="frame registry file (default: from config)")
+    parser.add_argument("-R", "--recursive", action="store_true",
+                        help="also scan the subdirectories of the directory")
+    parser.add_argument("--legacy-lists", action="store_true",
+                        help="also write the derived lists of predicted names")
     return parser.parse_args(argv)
 
 # ---- main entry point -----------------------------------------------------
 
 def main(argv: List[str] | None = None) -> None:
     args = parse_args(argv)
+    cfg = None
+    if args.config:
+        from calib_config import CalibConfig
+        cfg = CalibConfig(args.config)
+    registry_path = args.registry or (cfg.get("DATA_STRUCTURE", "frame_registry", "./work/frames.db")
+                                      if cfg is not None else "./work/frames.db")
 
     if args.list:
         list_path = Path(args.list).expanduser().resolve()
@@ -110,17 +155,18 @@ def main(argv: List[str] | None = None) -> None:
         originals = read_list_file(list_path)
         originals = [str(Path(p).expanduser().resolve()) for p in originals]
         base_name = list_path.with_suffix("").name
-        generate_lists(base_name, originals)
+        generate_lists(base_name, originals, registry_path, cfg, args.legacy_lists)
 
     elif args.directory:
         dir_path = Path(args.directory).expanduser().resolve()
         if not dir_path.is_dir():
             sys.exit(f"Error: directory '{dir_path}' not found")
-        originals = fits_files_in_directory(dir_path)
+        records = scan_directory(dir_path, cfg, args.recursive)
+        originals = [record.path for record in records]
         if not originals:
             sys.exit("Error: no FITS files found in directory")
         base_name = dir_path.name
-        generate_lists(base_name, originals)
+        generate_lists(base_name, originals, registry_path, cfg, args.legacy_lists, records)
 
     elif args.archive:
         arc_path = Path(args.archive).expanduser().resolve()
@@ -141,7 +187,7 @@ def main(argv: List[str] | None = None) -> None:
             if not originals:
                 sys.exit("Error: no FITS files found inside archive")
             base_name = arc_path.stem.replace(".tar", "")  # strip .tar from .tar.gz
-            generate_lists(base_name, sorted(originals))
+            generate_lists(base_name, sorted(originals), registry_path, cfg, args.legacy_lists)
 
     else:
         sys.exit("Internal argument parsing error")
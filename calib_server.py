@@ -0,0 +1,437 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: calib_server.py
+# Description:
+#   Local calibration service for the acquisition software.
+#   - one long-lived process keeps the masters of the night (masterbias,
+#     masterdark, normalized masterflats, bad-pixel mask) in memory, read
+#     once at start (and again on /reload),
+#   - clients hand over a new frame by file path or as a raw buffer (array
+#     bytes plus header) over HTTP on localhost or on a UNIX socket,
+#   - requests are queued and calibrated by a pool of worker threads; a
+#     worker takes all requests waiting at that moment (up to [SERVER]
+#     batch_size), groups them by frame size, filter and binning and
+#     calibrates each group with one master lookup and one flat division
+#     over the stacked frames,
+#   - the correction is done by calibration.Calibrator, the library API
+#     behind the file pipeline (same float32 results),
+#   - file requests get the path of the calibrated '-bdf' file, buffer
+#     requests the calibrated float32 array,
+#   - GET /stats reports queue depth, frames in progress, batch sizes and
+#     request latencies.
+#   Protocol:
+#     POST /calibrate   JSON {"path": raw file, "output": optional path}
+#                       -> JSON {"output", "steps", "latency_ms"}
+#     POST /calibrate   application/octet-stream array bytes with headers
+#                       X-Shape (rows,cols), X-Dtype and X-Header (JSON
+#                       header cards) -> float32 array bytes, same headers
+#     POST /reload      re-read the masters
+#     GET  /stats       JSON statistics
+# =============================================================================
+
+import os
+import sys
+import json
+import time
+import queue
+import socket
+import argparse
+import threading
+import http.client
+import socketserver
+from collections import deque, defaultdict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import numpy as np
+from astropy.io import fits
+import buffers
+import calibration
+import detector
+import warnings
+warnings.filterwarnings("ignore")
+
+
+DEFAULT_PORT = 8765
+DEFAULT_WORKERS = 4
+DEFAULT_BATCH_SIZE = 8
+LATENCY_SAMPLES = 1000
+
+
+# ---------------------------------------------------------------------------
+# Class: Request
+# Description:
+#   One frame to calibrate: a raw file (*path*) or an in-memory frame
+#   (detector.ArrayFrame). *output* is the path of the calibrated file
+#   (file requests only).
+# ---------------------------------------------------------------------------
+class Request:
+    def __init__(self, path=None, frame=None, output=None):
+        self.path = path
+        self.frame = frame
+        self.output = output
+        self.future = Future()
+        self.submitted = time.perf_counter()
+
+
+def output_path(path, output_dir=None):
+    path = Path(path)
+    stem = path.stem
+    # only a trailing stage suffix ('-b' or '-bd') is replaced
+    for suffix in ("-bd", "-b"):
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+            break
+    name = stem + "-bdf" + path.suffix
+    return str(Path(output_dir) / name if output_dir else path.with_name(name))
+
+
+def header_cards(header):
+    return {key: value for key, value in header.items()
+            if key not in ("", "COMMENT", "HISTORY") and isinstance(value, (str, int, float, bool))}
+
+
+# ---------------------------------------------------------------------------
+# Class: CalibrationServer
+# Description:
+#   Request queue with a pool of worker threads calibrating batches of
+#   waiting requests against the masters in memory.
+# ---------------------------------------------------------------------------
+class CalibrationServer:
+    def __init__(self, cfg, workers=DEFAULT_WORKERS, batch_size=DEFAULT_BATCH_SIZE, master_dir=None,
+                 output_dir=None, verbose=False):
+        self.cfg = cfg
+        self.workers = max(1, int(workers))
+        self.batch_size = max(1, int(batch_size))
+        self.output_dir = output_dir
+        self.verbose = verbose
+        self.master_dir = Path(master_dir or cfg.get("DATA_STRUCTURE", "working_dir", "./work/"))
+        self.calibrator = calibration.Calibrator(calibration.MasterSet(), cfg)
+        self.load_masters()
+        self.requests = queue.Queue()
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.in_progress = 0
+        self.completed = 0
+        self.failed = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    # -----------------------------------------------------------------------
+    # Method: load_masters
+    # Description:
+    #   (Re)reads the masters of the master directory; requests already
+    #   running keep the masters they started with.
+    # -----------------------------------------------------------------------
+    def load_masters(self):
+        mask_name = self.calibrator.mask_name if self.calibrator.use_masks else None
+        self.calibrator.masters = calibration.MasterSet.from_directory(self.master_dir, mask_name)
+        self.loaded = time.time()
+
+    def start(self):
+        for number in range(self.workers):
+            threading.Thread(target=self.worker, name=f"calib-worker-{number}", daemon=True).start()
+
+    def submit(self, request):
+        self.requests.put(request)
+        return request.future
+
+    def worker(self):
+        while True:
+            batch = [self.requests.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+            with self.lock:
+                self.in_progress += len(batch)
+                self.batches += 1
+            self.calibrate_batch(batch)
+
+    # -----------------------------------------------------------------------
+    # Method: read
+    # Description:
+    #   Trimmed raw data, overscan level and header of a request.
+    # -----------------------------------------------------------------------
+    def read(self, request):
+        if request.frame is not None:
+            return self.calibrator.read(request.frame)
+        with fits.open(request.path, memmap=False) as hdul:
+            raw, overscan, header = self.calibrator.read(hdul[0])
+            return np.asarray(raw), overscan, header
+
+    # -----------------------------------------------------------------------
+    # Method: calibrate_batch
+    # Description:
+    #   Calibrates the requests of one batch, grouped by frame size, filter
+    #   and binning, and resolves their futures.
+    # -----------------------------------------------------------------------
+    def calibrate_batch(self, batch):
+        groups = defaultdict(list)
+        for request in batch:
+            try:
+                raw, overscan, header = self.read(request)
+                groups[self.calibrator.group_key(raw, header)].append((request, raw, overscan, header))
+            except Exception as e:
+                self.finish(request, error=e)
+        for (shape, _, _), frames in groups.items():
+            try:
+                self.calibrate_group(shape, frames)
+            except Exception as e:
+                for request, *_ in frames:
+                    if not request.future.done():
+                        self.finish(request, error=e)
+
+    def calibrate_group(self, shape, frames):
+        work = buffers.worker_buffers()
+        stack, extensions, steps = self.calibrator.calibrate_group(
+            [(raw, overscan, header) for _, raw, overscan, header in frames],
+            work.get("batch", (len(frames),) + shape), work.get("scratch", shape))
+        for number, (request, _, _, header) in enumerate(frames):
+            data = stack[number]
+            if request.frame is not None:
+                self.finish(request, {"data": data.copy(), "header": header, "steps": steps})
+                continue
+            output = request.output or output_path(request.path, self.output_dir)
+            fits.HDUList([fits.PrimaryHDU(data, header=header)] + extensions[number]).writeto(output,
+                                                                                            overwrite=True)
+            self.finish(request, {"output": output, "steps": steps})
+
+    def finish(self, request, result=None, error=None):
+        latency = time.perf_counter() - request.submitted
+        with self.lock:
+            self.in_progress -= 1
+            if error is None:
+                self.completed += 1
+                self.latencies.append(latency)
+            else:
+                self.failed += 1
+        if error is not None:
+            print(f"Skipping {request.path or 'buffer'}: {error}")
+            request.future.set_exception(error)
+            return
+        result["latency_ms"] = round(1000 * latency, 2)
+        if self.verbose:
+            print(f"[INFO] {request.path or 'buffer'} -> {result.get('output', 'array')} "
+                  f"({result['steps']}, {result['latency_ms']:.0f} ms)", flush=True)
+        request.future.set_result(result)
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+            frames = self.completed + self.failed
+            return {
+                "queue_depth": self.requests.qsize(),
+                "in_progress": self.in_progress,
+                "completed": self.completed,
+                "failed": self.failed,
+                "batches": self.batches,
+                "mean_batch_size": round(frames / self.batches, 2) if self.batches else 0.0,
+                "latency_ms": {"mean": round(float(latencies.mean()), 2),
+                               "p50": round(float(np.percentile(latencies, 50)), 2),
+                               "p95": round(float(np.percentile(latencies, 95)), 2),
+                               "max": round(float(latencies.max()), 2)},
+                "workers": self.workers,
+                "masters": self.calibrator.masters.names(),
+                "uptime_s": round(time.time() - self.started, 1),
+            }
+
+
+# ---------------------------------------------------------------------------
+# Class: RequestHandler
+# Description:
+#   HTTP front end of the CalibrationServer (server.service).
+# ---------------------------------------------------------------------------
+class RequestHandler(BaseHTTPRequestHandler):
+    server_version = "calib_server"
+
+    def address_string(self):
+        return self.client_address[0] if self.client_address else "unix-socket"
+
+    def log_message(self, format, *args):
+        if self.server.service.verbose:
+            super().log_message(format, *args)
+
+    def send_body(self, code, body, content_type="application/json", headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, code, value):
+        self.send_body(code, json.dumps(value).encode())
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.service.stats())
+        else:
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        service = self.server.service
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        try:
+            if self.path == "/reload":
+                service.load_masters()
+                self.send_json(200, {"masters": service.calibrator.masters.names()})
+            elif self.path != "/calibrate":
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+            elif self.headers.get("Content-Type") == "application/octet-stream":
+                shape = tuple(int(n) for n in self.headers["X-Shape"].split(","))
+                data = np.frombuffer(body, dtype=np.dtype(self.headers["X-Dtype"])).reshape(shape)
+                header = fits.Header(json.loads(self.headers.get("X-Header", "{}")))
+                result = service.submit(Request(frame=detector.ArrayFrame(data, header))).result()
+                data = np.ascontiguousarray(result["data"], dtype=np.float32)
+                self.send_body(200, data.tobytes(), "application/octet-stream",
+                               {"X-Shape": ",".join(str(n) for n in data.shape), "X-Dtype": "float32",
+                                "X-Header": json.dumps(header_cards(result["header"])),
+                                "X-Latency-Ms": str(result["latency_ms"])})
+            else:
+                request = json.loads(body or b"{}")
+                if not request.get("path"):
+                    raise ValueError("no 'path' given")
+                result = service.submit(Request(path=request["path"], output=request.get("output"))).result()
+                self.send_json(200, result)
+        except Exception as e:
+            self.send_json(400, {"error": str(e)})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+# ---------------------------------------------------------------------------
+# Function: serve
+# Description:
+#   Runs the service on a UNIX socket (*socket_path*) or on localhost:*port*
+#   until interrupted.
+# ---------------------------------------------------------------------------
+def serve(service, socket_path=None, port=DEFAULT_PORT):
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = UnixHTTPServer(socket_path, RequestHandler)
+        address = socket_path
+    else:
+        server = ThreadingHTTPServer(("127.0.0.1", int(port)), RequestHandler)
+        address = f"http://127.0.0.1:{port}"
+    server.service = service
+    service.start()
+    print(f"Calibration service on {address} ({service.workers} workers, masters: "
+          f"{', '.join(service.calibrator.masters.names()) or 'none'}).", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+# ---------------------------------------------------------------------------
+# Client side: connection to a running service.
+# ---------------------------------------------------------------------------
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.socket_path)
+
+
+def call(method, url, body=None, headers=None, socket_path=None, port=DEFAULT_PORT, timeout=300):
+    '''Returns (status, response headers, body) of one request to the service.'''
+    connection = (UnixHTTPConnection(socket_path, timeout) if socket_path
+                  else http.client.HTTPConnection("127.0.0.1", int(port), timeout=timeout))
+    try:
+        connection.request(method, url, body=body, headers=headers or {})
+        response = connection.getresponse()
+        return response.status, dict(response.getheaders()), response.read()
+    finally:
+        connection.close()
+
+
+def calibrate_file(path, output=None, socket_path=None, port=DEFAULT_PORT):
+    '''Calibrates a raw file by the service; returns its JSON answer.'''
+    body = json.dumps({"path": str(Path(path).resolve()), "output": output}).encode()
+    status, _, answer = call("POST", "/calibrate", body, {"Content-Type": "application/json"}, socket_path, port)
+    result = json.loads(answer)
+    if status != 200:
+        raise RuntimeError(result.get("error", f"HTTP {status}"))
+    return result
+
+
+def calibrate_array(data, header, socket_path=None, port=DEFAULT_PORT):
+    '''Calibrates a raw array with its header (dict); returns (float32 array, header dict).'''
+    data = np.ascontiguousarray(data)
+    headers = {"Content-Type": "application/octet-stream", "X-Shape": ",".join(str(n) for n in data.shape),
+               "X-Dtype": data.dtype.str, "X-Header": json.dumps(header_cards(header))}
+    status, response_headers, answer = call("POST", "/calibrate", data.tobytes(), headers, socket_path, port)
+    if status != 200:
+        raise RuntimeError(json.loads(answer).get("error", f"HTTP {status}"))
+    shape = tuple(int(n) for n in response_headers["X-Shape"].split(","))
+    return (np.frombuffer(answer, dtype=np.float32).reshape(shape),
+            json.loads(response_headers.get("X-Header", "{}")))
+
+
+# ---------------------------------------------------------------------------
+# Main block
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local calibration service keeping the masters in memory.")
+    parser.add_argument("action", choices=["serve", "calibrate", "stats", "reload"],
+                        help="serve: run the service; calibrate: send frames to it; stats/reload")
+    parser.add_argument("files", nargs="*", help="raw FITS files (calibrate)")
+    parser.add_argument("-c", "--config", type=str, default="config.ini", help="Specify path to config file")
+    parser.add_argument("-u", "--socket", type=str, help="UNIX socket path (default from config, else HTTP)")
+    parser.add_argument("-p", "--port", type=int, help="localhost HTTP port")
+    parser.add_argument("-n", "--workers", type=int, help="worker threads (serve)")
+    parser.add_argument("-m", "--masters", type=str, help="directory with the masters (default: working_dir)")
+    parser.add_argument("-o", "--output", type=str, help="directory of the calibrated files (default: next "
+                                                         "to the raw files)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
+    args = parser.parse_args()
+
+    from calib_config import CalibConfig
+    cfg = CalibConfig(args.config)
+    socket_path = args.socket or cfg.get("SERVER", "socket", None)
+    if isinstance(socket_path, str) and socket_path.strip().lower() in ("", "none"):
+        socket_path = None
+    port = args.port or cfg.get("SERVER", "port", DEFAULT_PORT)
+
+    if args.action == "serve":
+        output_dir = args.output or cfg.get("SERVER", "output_dir", None)
+        if isinstance(output_dir, str) and output_dir.strip().lower() in ("", "none"):
+            output_dir = None
+        service = CalibrationServer(cfg, args.workers or cfg.get("SERVER", "workers", DEFAULT_WORKERS),
+                                        cfg.get("SERVER", "batch_size", DEFAULT_BATCH_SIZE), args.masters,
+                                        output_dir, args.verbose)
+        serve(service, socket_path, port)
+        sys.exit(0)
+
+    try:
+        if args.action == "calibrate":
+            for file in args.files:
+                try:
+                    result = calibrate_file(file, socket_path=socket_path, port=port)
+                    print(f"{file} -> {result['output']} ({result['steps']}, {result['latency_ms']:.0f} ms)")
+                except RuntimeError as e:
+                    print(f"Skipping {file}: {e}")
+        else:
+            status, _, answer = call("GET" if args.action == "stats" else "POST", "/" + args.action,
+                                     socket_path=socket_path, port=port)
+            print(json.dumps(json.loads(answer), indent=1))
+    except OSError as e:
+        print(f"[ERROR]: No calibration service at {socket_path or f'127.0.0.1:{port}'}: {e}")
+        sys.exit(1)
+    sys.exit(0)
+
+### END
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: calibration.py
+# Description:
+#   Library API of the calibration: plain functions and classes on numpy
+#   arrays and headers (astropy Header or dict), no files and no module
+#   globals. The master and stage scripts are file-based wrappers around
+#   it; other code (scheduler tasks, calib_server.py) calibrates frames
+#   held in memory with it, without temporary FITS files.
+#   - combine_bias, combine_dark, combine_flats: masters from a stack of
+#     frames (the *_band functions combine one band of rows, used by the
+#     scripts reading the stack band by band),
+#   - subtract_bias, subtract_dark, divide_flat: correction kernels,
+#   - MasterSet: masters in memory, matched to the binning of a frame,
+#   - Calibrator, calibrate_frame: raw frame -> calibrated float32 frame.
+#   Example:
+#     masterbias, cards = calibration.combine_bias(bias_frames)
+#     data, header = calibration.calibrate_frame(raw, header, masterbias=masterbias)
+# =============================================================================
+
+import threading
+from pathlib import Path
+import numpy as np
+from astropy.io import fits
+from astropy.stats import sigma_clip
+import binning
+import detector
+import linearity
+import masks
+import site_config
+
+
+# Bias combination methods which can be updated incrementally (mean based)
+INCREMENTAL_BIAS_METHODS = ("Average", "AverageSigmaClipped")
+BIAS_COMBINE_METHODS = {
+    "MedianSigmaClipped": "sigma-clipped median",
+    "AverageSigmaClipped": "sigma-clipped average",
+    "Average": "average",
+}
+
+# Supported dark combination methods: name -> (combine function, sigma clipping)
+DARK_COMBINE_METHODS = {
+    "ScaledExposureMedian": ("median", False),
+    "ScaledExposureAverage": ("average", False),
+    "ScaledExposureMedianSigmaClipped": ("median", True),
+    "ScaledExposureAverageSigmaClipped": ("average", True),
+}
+
+
+# ---------------------------------------------------------------------------
+# Function: as_header
+# Description:
+#   astropy Header of *header* (Header, dict of values or (value, comment)
+#   pairs, or None). A Header is copied, the input is never modified.
+# ---------------------------------------------------------------------------
+def as_header(header):
+    if isinstance(header, fits.Header):
+        return header.copy()
+    result = fits.Header()
+    if header:
+        result.update(header)
+    return result
+
+
+def flat_name(filt):
+    return f"masterflat_{filt}_norm.fits"
+
+
+# ---------------------------------------------------------------------------
+# Function: combine_bias_band
+# Description:
+#   Combines an (N, rows, W) band of the bias stack. Returns the master
+#   band and the sigma-clipping mask (True = rejected) or None.
+# ---------------------------------------------------------------------------
+def combine_bias_band(stack, method, sigma):
+    if method == "MedianSigmaClipped":
+        clipped_bias = sigma_clip(stack, sigma=sigma, axis=0)
+        return np.nanmedian(clipped_bias, axis=0), np.ma.getmaskarray(clipped_bias)
+    if method == "AverageSigmaClipped":
+        clipped_bias = sigma_clip(stack, sigma=sigma, axis=0)
+        return np.ma.mean(clipped_bias, axis=0).filled(np.nan), np.ma.getmaskarray(clipped_bias)
+    return np.mean(stack, axis=0), None
+
+
+def bias_cards(method, n_combined):
+    return {"MB_COMB": (method, "Bias combination method"),
+            "MB_NCOMB": (n_combined, "Number of combined bias frames")}
+
+
+# ---------------------------------------------------------------------------
+# Function: combine_bias
+# Description:
+#   Master bias (float32) of the bias *frames* (sequence of 2D arrays or an
+#   (N, H, W) stack, overscan already subtracted if there is one).
+#   Returns (master, header cards).
+# ---------------------------------------------------------------------------
+def combine_bias(frames, method="MedianSigmaClipped", sigma=2.3):
+    if method not in BIAS_COMBINE_METHODS:
+        raise ValueError(f"unsupported bias combination method '{method}'")
+    stack = np.asarray(frames)
+    master, _ = combine_bias_band(stack, method, sigma)
+    return master.astype(np.float32), bias_cards(method, len(stack))
+
+
+# ---------------------------------------------------------------------------
+# Function: combine_dark_stack
+# Description:
+#   Combines the (N, H, W) dark stack into a master dark. Work is done in
+#   bands of 'tile_rows' rows directly on the stack buffer (sigma clipping
+#   replaces rejected pixels by NaN in place), so temporary arrays never
+#   exceed the size of one band. If 'stats' (master_stats.MasterStatistics)
+#   is given, the running statistics are accumulated band by band as well;
+#   'first_row' is the row of the master where the stack starts.
+# ---------------------------------------------------------------------------
+def combine_dark_stack(stack, method, sigma=3.0, tile_rows=256, stats=None, first_row=0):
+    combine, clipped = DARK_COMBINE_METHODS[method]
+    master = np.empty(stack.shape[1:], dtype=np.float32)
+
+    for row in range(0, stack.shape[1], tile_rows):
+        rows = slice(row, row + tile_rows)
+        stats_rows = slice(first_row + row, first_row + min(row + tile_rows, stack.shape[1]))
+        band = stack[:, rows]
+        if stats is not None:
+            stats.add_band(stats_rows, band)
+        if clipped:
+            band = sigma_clip(band, sigma=sigma, axis=0, masked=False, copy=False)
+            if stats is not None:
+                stats.add_band(stats_rows, band, clipped=True)
+        if combine == "median":
+            median = np.nanmedian if clipped else np.median
+            master[row:row + tile_rows] = median(band, axis=0, overwrite_input=True)
+        else:
+            mean = np.nanmean if clipped else np.mean
+            master[row:row + tile_rows] = mean(band, axis=0)
+    return master
+
+
+def dark_cards(method, exptimes, temperatures=(), temperature_keyword="CCD-TEMP"):
+    cards = {"MD_COMB": method,  # Record the combination method.
+             # Record what the dark library needs to index this master
+             "MD_EXPT": (float(np.median(exptimes)), "Median exposure of combined darks"),
+             "MD_SCALE": (method.startswith("ScaledExposure"), "Dark signal per 1 second"),
+             "MD_NCOMB": (len(exptimes), "Number of combined dark frames")}
+    if len(temperatures):
+        cards[temperature_keyword] = (float(np.median(temperatures)), "Median CCD temperature of combined darks")
+    return cards
+
+
+# ---------------------------------------------------------------------------
+# Function: combine_dark
+# Description:
+#   Master dark (float32, ADU per second) of the dark *frames* with
+#   exposure times *exptimes*; every frame is scaled to a one second
+#   exposure before combining. Returns (master, header cards).
+# ---------------------------------------------------------------------------
+def combine_dark(frames, exptimes, method="ScaledExposureMedian", sigma=3.0, temperatures=(),
+                 temperature_keyword="CCD-TEMP"):
+    if method not in DARK_COMBINE_METHODS:
+        raise ValueError(f"unsupported dark combination method '{method}'")
+    stack = np.empty(np.shape(frames), dtype=np.float32)
+    for i, (frame, exptime) in enumerate(zip(frames, exptimes)):
+        np.copyto(stack[i], frame, casting="unsafe")
+        np.divide(stack[i], np.float32(exptime), out=stack[i], casting="unsafe")
+    master = combine_dark_stack(stack, method, sigma=sigma)
+    return master, dark_cards(method, exptimes, temperatures, temperature_keyword)
+
+
+def flat_level(data):
+    return np.average(data.astype(np.float32))
+
+
+# ---------------------------------------------------------------------------
+# Function: combine_flat_band
+# Description:
+#   Median flat and median normalized flat of an (N, rows, W) band of the
+#   flat stack; *levels* are the mean levels of the whole flats.
+# ---------------------------------------------------------------------------
+def combine_flat_band(stack, levels):
+    levels = np.asarray(levels, dtype=np.float32).reshape(-1, 1, 1)
+    return np.median(stack, axis=0), np.median(stack / levels, axis=0)
+
+
+# ---------------------------------------------------------------------------
+# Function: combine_flats
+# Description:
+#   Master flat and normalized master flat (float32) of the flat *frames*
+#   of one filter (bias and dark already corrected).
+# ---------------------------------------------------------------------------
+def combine_flats(frames, levels=None):
+    stack = np.empty(np.shape(frames), dtype=np.float32)
+    for i, frame in enumerate(frames):
+        np.copyto(stack[i], frame, casting="unsafe")
+    if levels is None:
+        levels = [flat_level(np.asarray(frame)) for frame in frames]
+    flat, normflat = combine_flat_band(stack, levels)
+    return flat.astype(np.float32), normflat.astype(np.float32)
+
+
+# ---------------------------------------------------------------------------
+# Function: subtract_bias
+# Description:
+#   Bias correction of one frame: float32 copy of the raw data minus the
+#   overscan level (if any) and the master bias. The result is written into
+#   *out* (float32, shape of raw) when given, otherwise a new array is
+#   allocated. With *linearity* (linearity.Linearity) the raw data and the
+#   overscan level are corrected for non-linearity in the same pass.
+# ---------------------------------------------------------------------------
+def subtract_bias(raw, overscan, masterbias, out=None, linearity=None):
+    if out is None:
+        out = np.empty(raw.shape, dtype=np.float32)
+    if linearity is not None:
+        linearity.apply(raw, out=out)
+        if overscan is not None:
+            overscan = linearity.apply(overscan)
+    else:
+        np.copyto(out, raw, casting="unsafe")
+    if overscan is not None:
+        np.subtract(out, overscan, out=out)
+    np.subtract(out, masterbias, out=out)
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Function: subtract_dark
+# Description:
+#   Dark correction of one frame: *dark* scaled by *exposure* is subtracted
+#   (masterdark in ADU/s, or exposure=1 for an already scaled library dark).
+#   The result goes into *out* (may be *data* itself) and the scaled dark
+#   into *scratch* when given, otherwise new arrays are allocated.
+# ---------------------------------------------------------------------------
+def subtract_dark(data, dark, exposure=1.0, out=None, scratch=None):
+    if out is None:
+        out = np.empty(np.shape(data), dtype=np.float32)
+    if exposure != 1.0:
+        dark = np.multiply(dark, np.float32(exposure), out=scratch)
+    np.subtract(data, dark, out=out)
+    return out
+
+
+# ---------------------------------------------------------------------------
+# Function: divide_flat
+# Description:
+#   Flat-field correction of one frame (or a stack of frames) by the
+#   normalized masterflat, into *out* (may be *data* itself) when given.
+# ---------------------------------------------------------------------------
+def divide_flat(data, normflat, out=None):
+    if out is None:
+        out = np.empty(np.shape(data), dtype=np.float32)
+    return np.divide(data, normflat, out=out)
+
+
+# ---------------------------------------------------------------------------
+# Class: MasterSet
+# Description:
+#   Masters in memory by file name (masterbias.fits, masterdark.fits,
+#   masterflat_<filter>_norm.fits, the bad-pixel mask), with their copies
+#   binned to the frame binnings met so far. Safe to share between threads.
+# ---------------------------------------------------------------------------
+class MasterSet:
+    def __init__(self, masters=None):
+        self.masters = {}
+        self.lock = threading.Lock()
+        for name, (data, header) in (masters or {}).items():
+            self.add(name, data, header)
+
+    def add(self, name, data, header=None, method=None):
+        self.masters[name] = (data, as_header(header), method or binning.master_binning_method(name), {})
+
+    # -----------------------------------------------------------------------
+    # Method: from_directory
+    # Description:
+    #   The masters found in *master_dir* (and the bad-pixel mask
+    #   *mask_name*, if given), read once.
+    # -----------------------------------------------------------------------
+    @classmethod
+    def from_directory(cls, master_dir, mask_name=None):
+        master_dir = Path(master_dir)
+        masters = cls()
+        names = ["masterbias.fits", "masterdark.fits"]
+        names += sorted(path.name for path in master_dir.glob("masterflat_*_norm.fits"))
+        for name in names:
+            path = master_dir / name
+            if path.exists():
+                with fits.open(path) as hdul:
+                    masters.add(name, hdul[0].data.astype(np.float32), hdul[0].header)
+        if mask_name:
+            mask, header = masks.read_bad_pixel_mask(master_dir / mask_name, with_header=True)
+            if mask is not None:
+                masters.add(mask_name, mask, header, binning.MASTER_BINNING["badpixmask"])
+        return masters
+
+    def __contains__(self, name):
+        return name in self.masters
+
+    def names(self):
+        return sorted(self.masters)
+
+    def get(self, name, frame_header):
+        '''Master *name* matched to the binning of a frame, None if there is none.'''
+        entry = self.masters.get(name)
+        if entry is None:
+            return None
+        data, header, method, cache = entry
+        with self.lock:
+            return binning.match_binning(data, header, frame_header, method, cache)
+
+
+# ---------------------------------------------------------------------------
+# Class: Calibrator
+# Description:
+#   Calibrates raw frames in memory against a MasterSet (a dict of
+#   name -> (data, header), or anything with get(name, frame_header)
+#   returning a master or None, e.g. dataset.MasterCutouts): trimming and
+#   overscan (with *cfg*), linearity ([LINEARITY]), bias, dark (scaled by
+#   the exposure time) and flat correction, bad-pixel and saturation masks
+#   ([MASKS]). Missing masters are skipped; CALSTEPS records the steps
+#   applied. Without *cfg* the frames are used as they are and no masks
+#   are applied.
+# ---------------------------------------------------------------------------
+class Calibrator:
+    def __init__(self, masters, cfg=None):
+        self.masters = MasterSet(masters) if isinstance(masters, dict) else masters
+        self.cfg = cfg
+        self.site = site_config.from_calib_config(cfg)
+        self.exptime_keyword = (cfg.get("HEADER_SPECIFICATION", "exposure_keyword", "EXPTIME")
+                                if cfg is not None else "EXPTIME")
+        self.use_masks = cfg is not None and cfg.get("MASKS", "use_masks", False)
+        self.mask_name = (cfg.get("MASKS", "bad_pixel_mask_file", "badpixmask.fits")
+                          if cfg is not None else "badpixmask.fits")
+        self.masked_value = masks.masked_value_from_config(cfg) if self.use_masks else None
+        self.linearity = linearity.linearity_from_config(cfg)
+
+    # -----------------------------------------------------------------------
+    # Method: read
+    # Description:
+    #   (raw, overscan, header) of a raw frame: an HDU, a
+    #   detector.ArrayFrame or an array with its *header*.
+    # -----------------------------------------------------------------------
+    def read(self, frame, header=None):
+        if isinstance(frame, np.ndarray):
+            frame = detector.ArrayFrame(frame, as_header(header))
+        if self.cfg is None:
+            return frame.data, None, frame.header.copy()
+        return detector.read_trimmed(frame, self.cfg)
+
+    def group_key(self, raw, header):
+        '''Frames with the same key share their masters (calibrate_group).'''
+        return raw.shape, self.site.filter_of(header), binning.frame_binning(header)
+
+    # -----------------------------------------------------------------------
+    # Method: calibrate_group
+    # Description:
+    #   Calibrates *frames*, a list of (raw, overscan, header) of one group
+    #   (group_key), into *stack* ((N, H, W) float32, allocated if None),
+    #   with one master lookup and one flat division for all of them.
+    #   The headers are updated in place. Returns (stack, extension HDUs of
+    #   every frame, steps).
+    # -----------------------------------------------------------------------
+    def calibrate_group(self, frames, stack=None, scratch=None):
+        shape = frames[0][0].shape
+        if stack is None:
+            stack = np.empty((len(frames),) + shape, dtype=np.float32)
+        header = frames[0][2]
+        masterbias = self.masters.get("masterbias.fits", header)
+        masterdark = self.masters.get("masterdark.fits", header)
+        normflat = self.masters.get(flat_name(self.site.filter_of(header)), header)
+        steps = ("B" if masterbias is not None else "") + ("D" if masterdark is not None else "") + \
+                ("F" if normflat is not None else "")
+        for number, (raw, overscan, header) in enumerate(frames):
+            subtract_bias(raw, overscan, masterbias if masterbias is not None else 0.0, out=stack[number],
+                          linearity=self.linearity)
+            if masterdark is not None:
+                subtract_dark(stack[number], masterdark, float(header.get(self.exptime_keyword, 0.0)),
+                              out=stack[number], scratch=scratch)
+        if normflat is not None:
+            divide_flat(stack, normflat, out=stack)
+
+        static_mask = self.masters.get(self.mask_name, header) if self.use_masks else None
+        extensions = []
+        for number, (raw, _, header) in enumerate(frames):
+            hdus = []
+            if self.use_masks:
+                level = masks.saturation_level(header, self.cfg)
+                saturated = raw >= level
+                mask = masks.frame_mask(static_mask, saturated if saturated.any() else None)
+                if self.masked_value is not None:
+                    masks.apply_mask(stack[number], mask, self.masked_value)
+                if static_mask is not None:
+                    header["BPMFILE"] = (self.mask_name, "Static bad-pixel mask")
+                header["NBADPIX"] = (int(np.count_nonzero(mask)) if mask is not None else 0,
+                                     "Number of flagged pixels")
+                sat_hdu = masks.saturation_hdu(raw, level)
+                if sat_hdu is not None:
+                    hdus.append(sat_hdu)
+            if self.linearity is not None:
+                header[linearity.HEADER_KEYWORD] = self.linearity.header_card()
+            header["CALSTEPS"] = (steps or "none", "Calibration steps applied")
+            extensions.append(hdus)
+        return stack, extensions, steps
+
+    # -----------------------------------------------------------------------
+    # Method: calibrate
+    # Description:
+    #   Calibrated float32 data and header of one raw frame (array with
+    #   *header*, or HDU / detector.ArrayFrame).
+    # -----------------------------------------------------------------------
+    def calibrate(self, frame, header=None):
+        raw, overscan, header = self.read(frame, header)
+        stack, _, _ = self.calibrate_group([(raw, overscan, header)])
+        return stack[0], header
+
+
+# ---------------------------------------------------------------------------
+# Function: calibrate_frame
+# Description:
+#   Calibrated float32 data and header of the raw frame *raw* with
+#   *header*, using the masters given as arrays (None = step skipped).
+#   *cfg* (CalibConfig, optional) adds trimming, overscan and masks.
+# ---------------------------------------------------------------------------
+def calibrate_frame(raw, header=None, masterbias=None, masterdark=None, normflat=None, cfg=None):
+    header = as_header(header)
+    masters = MasterSet()
+    if masterbias is not None:
+        masters.add("masterbias.fits", masterbias)
+    if masterdark is not None:
+        masters.add("masterdark.fits", masterdark)
+    if normflat is not None:
+        masters.add(flat_name(site_config.from_calib_config(cfg).filter_of(header)), normflat)
+    return Calibrator(masters, cfg).calibrate(np.asarray(raw), header)
+
+### END
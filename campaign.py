@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: campaign.py
+# Description:
+#   Reprocessing campaign over many nights of an archive.
+#   - all frames below a root directory are scanned (scanner.py) and split
+#     into nights by DATE-OBS (the '-b', '-bd', '-bdf' products of earlier
+#     runs, written next to the raw frames, are left out); a night starts
+#     at [CAMPAIGN] night_boundary_utc, so frames taken after midnight
+#     belong to the evening the night began,
+#   - every night is calibrated by calib.py as a run of its own with a
+#     derived config (working_dir/<night>, results_dir/<night>); several
+#     nights run at the same time and share the workers and the memory
+#     budget,
+#   - a night without bias, dark or flat frames (of a filter of its science
+#     frames) uses the masters of the nearest night that has them, at most
+#     [CAMPAIGN] max_master_age days away; that night is calibrated first
+#     and its masters are copied into the working directory of the night,
+#   - the state of every night is kept in working_dir/campaign-<root>.json,
+#     a restarted campaign continues with the nights not completed yet,
+#   - a summary per night (frames, calibrated frames, shared masters,
+#     status, run time) is written to results_dir/campaign-<root>.txt.
+#   Masters are only shared between nights that are not split by camera
+#   mode (their masters are in working_dir/<night>/<mode>).
+# =============================================================================
+
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import argparse
+import threading
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+import budget
+import partitions
+import quality
+import registry
+import scanner
+import scheduler
+import site_config
+from calib_config import CalibConfig
+
+
+DEFAULT_MAX_MASTER_AGE = 3
+# master files made from every kind of calibration frames
+MASTER_FILES = {"bias": ["masterbias.fits"], "dark": ["masterdark.fits"]}
+
+
+def master_files(kind):
+    if kind.startswith("flat:"):
+        filt = kind.split(":", 1)[1]
+        return [f"masterflat_{filt}.fits", f"masterflat_{filt}_norm.fits"]
+    return MASTER_FILES[kind]
+
+
+# ---------------------------------------------------------------------------
+# Function: night_of
+# Description:
+#   Night (YYYY-MM-DD of the evening it began, quality.observing_night
+#   with the boundary of *cfg*) of a DATE-OBS value, None if the value is
+#   not a date.
+# ---------------------------------------------------------------------------
+def night_of(date_obs, cfg=None):
+    try:
+        datetime.fromisoformat(str(date_obs).strip().replace("Z", ""))
+    except ValueError:
+        return None
+    return quality.observing_night(date_obs, cfg)
+
+
+# ---------------------------------------------------------------------------
+# Class: Night
+# Description:
+#   Frames of one night with the kinds of masters it can make ('bias',
+#   'dark', 'flat:<filter>') and the kinds it needs.
+# ---------------------------------------------------------------------------
+class Night:
+    def __init__(self, name):
+        self.name = name
+        self.files = []
+        self.has = set()
+        self.needs = {"bias", "dark"}
+        self.donors = {}
+
+    def add(self, record, site):
+        self.files.append(record.path)
+        imagetyp = site.image_type_of(record.header)
+        if imagetyp == "BIAS":
+            self.has.add("bias")
+        elif imagetyp == "DARK":
+            self.has.add("dark")
+        elif imagetyp == "FLAT":
+            self.has.add("flat:" + site.filter_of(record.header))
+        elif imagetyp == "OBJECT":
+            self.needs.add("flat:" + site.filter_of(record.header))
+
+    @property
+    def missing(self):
+        return sorted(self.needs - self.has)
+
+    @property
+    def date(self):
+        return datetime.fromisoformat(self.name)
+
+
+# ---------------------------------------------------------------------------
+# Function: is_product
+# Description:
+#   True for a frame written by the pipeline itself (a '-b', '-bd' or
+#   '-bdf' file next to its raw frame, or a frame with CALSTEPS); reruns
+#   must not ingest them as raw frames.
+# ---------------------------------------------------------------------------
+def is_product(record):
+    stem = Path(record.path).stem
+    return "CALSTEPS" in record.header or any(stem.endswith("-" + stage) for stage in registry.STAGES)
+
+
+# ---------------------------------------------------------------------------
+# Function: split_nights
+# Description:
+#   Nights ({name: Night}) of scanner records; pipeline products and frames
+#   without a valid DATE-OBS are skipped.
+# ---------------------------------------------------------------------------
+def split_nights(records, cfg):
+    site = site_config.from_calib_config(cfg)
+    date_keyword = cfg.get("HEADER_SPECIFICATION", "date_and_time_keyword", "DATE-OBS")
+    nights = {}
+    products = 0
+    for record in records:
+        if is_product(record):
+            products += 1
+            continue
+        name = night_of(record.header.get(date_keyword, ""), cfg)
+        if name is None:
+            print(f"Skipping {record.path}: no valid {date_keyword}")
+            continue
+        nights.setdefault(name, Night(name)).add(record, site)
+    if products:
+        print(f"Skipping {products} calibrated frames written by earlier runs.")
+    return dict(sorted(nights.items()))
+
+
+# ---------------------------------------------------------------------------
+# Function: assign_donors
+# Description:
+#   For every master a night is missing, the nearest night (the earlier one
+#   of two equally near) having frames of that kind, at most *max_age* days
+#   away. Returns the kinds no night can provide ({night: [kinds]}).
+# ---------------------------------------------------------------------------
+def assign_donors(nights, max_age=DEFAULT_MAX_MASTER_AGE):
+    unresolved = defaultdict(list)
+    for night in nights.values():
+        for kind in night.missing:
+            candidates = [(abs((other.date - night.date).days), other.name) for other in nights.values()
+                          if kind in other.has and other is not night]
+            candidates = [c for c in candidates if c[0] <= max_age]
+            if candidates:
+                night.donors[kind] = min(candidates)[1]
+            else:
+                unresolved[night.name].append(kind)
+    return dict(unresolved)
+
+
+# ---------------------------------------------------------------------------
+# Function: count_calibrated
+# Description:
+#   Calibrated frames in the frame registries of a night's working directory
+#   (camera-mode partitions have registries of their own).
+# ---------------------------------------------------------------------------
+def count_calibrated(working_dir):
+    count = 0
+    for path in Path(working_dir).rglob("frames.db"):
+        try:
+            with sqlite3.connect(path) as con:
+                count += con.execute("SELECT COUNT(*) FROM frames WHERE bdf IS NOT NULL").fetchone()[0]
+        except sqlite3.Error as e:
+            print(f"Skipping {path}: {e}")
+    return count
+
+
+# ---------------------------------------------------------------------------
+# Class: Campaign
+# Description:
+#   Campaign over the nights below *root*. The state of the nights is saved
+#   after every night, so a restart skips the completed ones.
+# ---------------------------------------------------------------------------
+class Campaign:
+    def __init__(self, root, config_file, cfg, jobs=None, verbose=False):
+        self.root = Path(root).expanduser().resolve()
+        self.config_file = config_file
+        self.cfg = cfg
+        self.jobs = jobs or os.cpu_count() or 1
+        self.verbose = verbose
+        self.working_dir = Path(cfg.get("DATA_STRUCTURE", "working_dir", "./work"))
+        self.results_dir = Path(cfg.get("DATA_STRUCTURE", "results_dir", "./results"))
+        self.state_path = self.working_dir / f"campaign-{self.root.name}.json"
+        self.summary_path = self.results_dir / f"campaign-{self.root.name}.txt"
+        self.state = self.load_state()
+        self.lock = threading.Lock()
+        self.nights = {}
+
+    def load_state(self):
+        if not self.state_path.exists():
+            return {}
+        with open(self.state_path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_state(self):
+        tmp_path = str(self.state_path) + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def completed(self, name):
+        return self.state.get(name, {}).get("status") == "done"
+
+    def night_dir(self, name):
+        return self.working_dir / name
+
+    # -----------------------------------------------------------------------
+    # Method: borrowed_masters
+    # Description:
+    #   Master files the night takes from its donor nights:
+    #   {kind: (donor night, [master paths])}.
+    # -----------------------------------------------------------------------
+    def borrowed_masters(self, night):
+        return {kind: (donor, [self.night_dir(donor) / name for name in master_files(kind)])
+                for kind, donor in sorted(night.donors.items())}
+
+    def mask_name(self):
+        return self.cfg.get("MASKS", "bad_pixel_mask_file", "badpixmask.fits")
+
+    # -----------------------------------------------------------------------
+    # Method: share_masters
+    # Description:
+    #   Copies the masters the night borrows from its donor nights into its
+    #   working directory; returns {kind: donor night} of the copied ones.
+    # -----------------------------------------------------------------------
+    def share_masters(self, night):
+        shared = {}
+        for kind, (donor, sources) in self.borrowed_masters(night).items():
+            if not all(path.exists() for path in sources):
+                print(f"Skipping {kind} masters of night {donor} for night {night.name}: not found in "
+                      f"{self.night_dir(donor)}")
+                continue
+            for path in sources:
+                shutil.copy2(path, self.night_dir(night.name) / path.name)
+            shared[kind] = donor
+        mask = self.night_dir(night.name) / self.mask_name()
+        if shared and not mask.exists():
+            for donor in sorted(set(shared.values())):
+                if (self.night_dir(donor) / self.mask_name()).exists():
+                    shutil.copy2(self.night_dir(donor) / self.mask_name(), mask)
+                    break
+        return shared
+
+    # -----------------------------------------------------------------------
+    # Method: prepare_night
+    # Description:
+    #   Writes the derived config and the list file of a night; returns the
+    #   calib.py command calibrating it with *jobs* workers.
+    # -----------------------------------------------------------------------
+    def prepare_night(self, night, jobs):
+        config_path = self.night_dir(night.name) / "config.ini"
+        partitions.write_partition_config(self.config_file, self.cfg, night.name, config_path,
+                                          split_modes=True)
+        list_path = f"{self.root.name}-{night.name}.lst"
+        registry.write_list(list_path, night.files)
+        return [sys.executable, "calib.py", "-l", list_path, "-c", str(config_path),
+                "-j", str(jobs)] + (["-v"] if self.verbose else [])
+
+    # -----------------------------------------------------------------------
+    # Method: run_night
+    # Description:
+    #   Calibrates one night with calib.py and records its state.
+    # -----------------------------------------------------------------------
+    def run_night(self, night, jobs):
+        start = time.perf_counter()
+        command = self.prepare_night(night, jobs)
+        shared = self.share_masters(night)
+        status = "done"
+        try:
+            scheduler.run_command(command)
+        except RuntimeError as e:
+            print(f"[ERROR]: Night {night.name}: {e}")
+            status = "failed"
+        with self.lock:
+            self.state[night.name] = {
+                "status": status,
+                "frames": len(night.files),
+                "calibrated": count_calibrated(self.night_dir(night.name)),
+                "shared_masters": shared,
+                "seconds": round(time.perf_counter() - start, 1),
+                "finished": datetime.now().isoformat(timespec="seconds"),
+            }
+            self.save_state()
+        if status != "done":
+            raise RuntimeError(f"night {night.name} failed")
+        return self.state[night.name]
+
+    # -----------------------------------------------------------------------
+    # Method: scan
+    # Description:
+    #   Splits the frames below the root directory into nights and assigns
+    #   the donors of missing masters; returns the nights.
+    # -----------------------------------------------------------------------
+    def scan(self, recursive=True):
+        records = scanner.scan(self.root, self.cfg, recursive=recursive)
+        self.nights = split_nights(records, self.cfg)
+        max_age = int(self.cfg.get("CAMPAIGN", "max_master_age", DEFAULT_MAX_MASTER_AGE))
+        for name, kinds in assign_donors(self.nights, max_age).items():
+            print(f"Night {name}: no frames for {', '.join(kinds)} within {max_age} days.")
+        return self.nights
+
+    # -----------------------------------------------------------------------
+    # Method: run
+    # Description:
+    #   Scans the root directory and calibrates all nights not completed
+    #   yet, *parallel* nights at a time. A night borrowing masters starts
+    #   when its donor nights are done. Returns True if no night failed.
+    # -----------------------------------------------------------------------
+    def run(self, parallel=2, recursive=True):
+        if not self.scan(recursive):
+            print("[ERROR]: No frames with a valid date found.")
+            return False
+
+        todo = [night for name, night in self.nights.items() if not self.completed(name)]
+        done = len(self.nights) - len(todo)
+        print(f"{len(self.nights)} nights, {done} completed before, {len(todo)} to calibrate.")
+        if todo:
+            parallel = max(1, min(parallel, len(todo)))
+            budget.share_between(parallel)
+            jobs = max(1, self.jobs // parallel)
+            graph = scheduler.Scheduler(parallel, verbose=self.verbose)
+            pending = {night.name for night in todo}
+            for night in todo:
+                deps = sorted({donor for donor in night.donors.values() if donor in pending})
+                graph.add(night.name, self.run_night, night, jobs, deps=deps)
+            graph.run()
+            for name in graph.skipped:
+                print(f"Night {name}: skipped, a night sharing its masters failed.")
+        self.write_summary()
+        return all(self.completed(name) for name in self.nights)
+
+    def write_summary(self):
+        lines = [f"# campaign {self.root} ({len(self.nights)} nights)",
+                 f"# {'night':10s} {'frames':>7s} {'calib':>7s} {'status':8s} {'time[s]':>8s}  shared masters"]
+        for name, night in self.nights.items():
+            state = self.state.get(name, {})
+            shared = ", ".join(f"{kind} from {donor}"
+                               for kind, donor in sorted(state.get("shared_masters", {}).items()))
+            lines.append(f"{name:12s} {len(night.files):7d} {state.get('calibrated', 0):7d} "
+                         f"{state.get('status', 'pending'):8s} {state.get('seconds', 0.0):8.1f}  {shared or '-'}")
+        self.summary_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.summary_path, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines) + "\n")
+        print("\n".join(lines))
+        print(f"Summary saved to '{self.summary_path}'.")
+
+
+# ---------------------------------------------------------------------------
+# Main block
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate all nights below a root directory.")
+    parser.add_argument("root", help="root directory of the archive (nights in any subdirectories)")
+    parser.add_argument("-c", "--config", type=str, default="config.ini", help="Specify path to config file")
+    parser.add_argument("-n", "--nights", type=int, default=2, help="nights calibrated at the same time")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="workers shared by all nights")
+    parser.add_argument("--restart", action="store_true", help="forget the saved state and calibrate all nights")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.root):
+        print(f"[ERROR]: '{args.root}' is not a valid directory.")
+        sys.exit(1)
+    cfg = CalibConfig(args.config)
+    for key in ("working_dir", "results_dir"):
+        Path(cfg.get("DATA_STRUCTURE", key)).mkdir(parents=True, exist_ok=True)
+
+    campaign = Campaign(args.root, args.config, cfg, args.jobs, args.verbose)
+    if args.restart:
+        campaign.state = {}
+    sys.exit(0 if campaign.run(args.nights) else 1)
+
+### END
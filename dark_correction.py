@@ -18,24 +18,50 @@ import sys
 import numpy as np
 from astropy.io import fits
 from pathlib import Path
-import getconfig
+import masks
+import binning
+import streaming
+import buffers
+import registry
+from calibration import subtract_dark  # NEW: shared correction kernel (calibration.py)
 import warnings
 warnings.filterwarnings("ignore")
 
 
-def apply_dark_correction(list_in, list_out, md):
+def apply_dark_correction(list_in, list_out, md, cfg, files=None, verbose=False):
     # Applies bias correction to all non-bias FITS frames in the directory
     #path = Path(directory)
-    md_data = fits.open(md, mode="readonly")[0].data.astype(np.float32)
+    # NEW: with [DARK_SUBTRACTION] library_files = True the dark for every frame
+    # is taken from the temperature-indexed dark library instead of 'md'
+    library = None
+    if cfg.get("DARK_SUBTRACTION", "library_files", False):
+        import dark_library
+        library = dark_library.library_from_config(cfg, verbose=verbose)
+        md_data = None
+    # NEW: inputs selected from the frame registry (biases and darks are not opened)
+    frames = registry.registry_from_config(cfg)
+    files_in = (files if files is not None else
+                registry.stage_inputs(frames, list_in, "b", exclude=("BIAS", "DARK")))
+    # NEW: with [IMAGE_PROCESSING] strip_rows > 0 (or frames too large for the
+    # memory budget) frames are corrected band by band and only the matching
+    # bands of the masterdark are read
+    strip_rows = streaming.strip_rows_from_config(cfg, files_in)
+    if library is None and strip_rows:
+        md_bands = streaming.MasterBands(md, binning.MASTER_BINNING["masterdark"])
+    elif library is None:
+        with fits.open(md, mode="readonly") as md_hdul:
+            md_data = md_hdul[0].data.astype(np.float32)
+            md_header = md_hdul[0].header
+    md_binned = {}
+    library_binned = {}  # library dark -> its copies binned to the frame binnings
     ## print(mb_data), exit()
     type_keyword = cfg.get("HEADER_SPECIFICATION", "image_type_keyword")
     ## expected_bias = full_config["HEADER_SPECIFICATION"].get("dark_label", "DARK").strip().upper()
+    work = buffers.worker_buffers()  # NEW: float32 frame buffers reused for all frames
     files_out = []
-    exptime_keyword = full_config["HEADER_SPECIFICATION"]['exposure_keyword']
+    exptime_keyword = cfg.get("HEADER_SPECIFICATION", "exposure_keyword")
     ## exit()
 
-    with open(list_in) as f:
-        files_in = f.read().splitlines()
     ## print(files), exit()        
 
     for file in files_in:
@@ -53,35 +79,78 @@ def apply_dark_correction(list_in, list_out, md):
                 if imagetyp == "BIAS" or imagetyp == "DARK":
                     continue
 
-                # Read image data and apply bias correction
-                data = hdul[0].data.astype(np.float32)
                 exposure = float(header[exptime_keyword])
                 ## print(imagetyp, exposure)
-                
-                corrected_data = data - exposure * md_data  # dark subtraction HERE
-                ## print(corrected_data), exit()
                 extention = str(file.split(".")[-1])
                 new_filepath = str(file.replace("-b","").split("."+extention)[0]) + "-bd." + extention
+                if library is not None:
+                    temperature = dark_library.header_temperature(header, cfg)
+                    if temperature is None:
+                        raise ValueError("no CCD temperature in header, cannot select library dark")
+                    dark, dark_header = library.get_dark(temperature, exposure)
+
+                if strip_rows:
+                    if library is not None:
+                        dark_band = lambda rows, width: binning.master_cutout(
+                            dark, dark_header, rows, slice(0, width), header, binning.MASTER_BINNING["masterdark"])
+                        scale = 1.0
+                    else:
+                        dark_band = lambda rows, width: md_bands.band(rows, width, header)
+                        scale = exposure
+                    extensions = ([hdul[masks.SATMASK_EXTNAME].copy()]
+                                  if masks.SATMASK_EXTNAME in hdul else [])
+                    streaming.correct_in_strips(
+                        hdul[0], new_filepath, cfg,
+                        lambda raw, overscan, rows: subtract_dark(raw, dark_band(rows, raw.shape[1]), scale),
+                        strip_rows, extensions=extensions)
+                    if verbose:
+                        print(f"Dark-subtracted file saved: {new_filepath}")
+                    files_out.append((file, new_filepath))
+                    continue
+
+                # Read image data and apply bias correction
+                data = hdul[0].data
+                out = work.get("frame", data.shape)
+                if library is not None:
+                    dark_frame = binning.match_binning(dark, dark_header, header, binning.MASTER_BINNING["masterdark"],
+                                                       library_binned.setdefault(id(dark), {}))
+                    corrected_data = subtract_dark(data, dark_frame, out=out)
+                else:
+                    # NEW: masterdark binned to the frame binning if needed
+                    md_frame = binning.match_binning(md_data, md_header, header,
+                                                     binning.MASTER_BINNING["masterdark"], md_binned)
+                    corrected_data = subtract_dark(data, md_frame, exposure,  # dark subtraction HERE
+                                                   out=out, scratch=work.get("scratch", md_frame.shape))
+                ## print(corrected_data), exit()
                 ## print(new_filepath), exit()                
                 ## print(file, new_filepath)
                 ## continue  
                 # Save the bias-corrected image
-                hdu = fits.PrimaryHDU(corrected_data.astype(np.float32), header=header)
+                hdu = fits.PrimaryHDU(corrected_data, header=header)
+                hdus = [hdu]
+                # NEW: pass saturation flags on to the next stage
+                if masks.SATMASK_EXTNAME in hdul:
+                    hdus.append(hdul[masks.SATMASK_EXTNAME].copy())
                 
                 ## TO DO: add header entries
-                hdu.writeto(new_filepath, overwrite=True)
+                fits.HDUList(hdus).writeto(new_filepath, overwrite=True)
                 hdul.flush()
                 if verbose:
                     print(f"Dark-subtracted file saved: {new_filepath}")
-                files_out.append(new_filepath)
+                files_out.append((file, new_filepath))
                 
         except Exception as e:
             print(f"Skipping {file}: {e}")
 
-        with open(list_out, "w", encoding="utf-8") as f:
-            for item in files_out:
-                ## print(item)
-                f.write(item + "\n")
+    # NEW: outputs written once, after the loop
+    if list_out is not None:
+        registry.write_list(list_out, [output for _, output in files_out])
+    if frames is not None:
+        frames.record_outputs("bd", files_out)
+
+    if library is None and strip_rows:
+        md_bands.close()
+    return files_out
 
 if __name__ == "__main__":
     if len(sys.argv) < 3:
@@ -109,14 +178,11 @@ if __name__ == "__main__":
     ## obs_name = cfg.get("GENERAL", "observatory_name")
     ## gain = cfg.get("DEFAULT_VALUES", "gain")
     ## print(f"Observatory: {obs_name}, Gain: {gain}")
-    working_dir = cfg.get("DATA_STRUCTURE", "working_dir")
-    results_dir = cfg.get("DATA_STRUCTURE", "results_dir")
-    results_aux_dir = cfg.get("DATA_STRUCTURE", "results_aux_dir")
     
     '''
     Applying procedures
     '''
-    apply_dark_correction(list_of_files_in, list_of_files_out, masterdark_file)
+    apply_dark_correction(list_of_files_in, list_of_files_out, masterdark_file, cfg, verbose=verbose)
     sys.exit(0)
     
 ### END
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: dark_library.py
+# Description:
+#   This module keeps a library of master dark frames indexed by CCD
+#   temperature and exposure time. Our cameras do not always reach their
+#   temperature setpoint, so a single masterdark does not describe every
+#   night. Darks for temperatures that are not in the library are obtained by
+#   interpolation between the two nearest library entries and the result is
+#   cached (in memory and on disk) for reuse.
+#
+#   The library lives in [DARK_SUBTRACTION] library_dir and consists of
+#   the master dark FITS files plus an index file 'darklib.json'.
+#   - entries marked as "scaled" hold dark signal per one second
+#     (ScaledExposure* methods of mkmasterdark.py),
+#   - other entries hold dark signal for their own exposure time.
+# =============================================================================
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from astropy.io import fits
+from pathlib import Path
+import binning
+
+
+INDEX_FILENAME = "darklib.json"
+CACHE_DIRNAME = "cache"
+
+
+# ---------------------------------------------------------------------------
+# Class: DarkLibrary
+# Description:
+#   Access to the library of master darks. The index is read once; master
+#   files are read on demand and kept in memory together with every
+#   interpolated dark requested so far.
+# ---------------------------------------------------------------------------
+class DarkLibrary:
+    def __init__(self, library_dir, tolerance=0.5, interpolation="linear",
+                 temperature_step=0.1, verbose=False):
+        self.library_dir = Path(library_dir)
+        self.index_path = self.library_dir / INDEX_FILENAME
+        self.cache_dir = self.library_dir / CACHE_DIRNAME
+        self.tolerance = float(tolerance)
+        self.interpolation = str(interpolation).lower()
+        self.temperature_step = float(temperature_step)
+        self.verbose = verbose
+        if self.interpolation not in ("linear", "log"):
+            raise ValueError(f"Unsupported dark interpolation '{interpolation}'.")
+
+        self.entries = self._read_index()
+        self._masters = {}      # library file -> (data, header)
+        self._cache = {}        # (temperature, exptime) -> (data, header)
+
+    # -- index handling -----------------------------------------------------
+    def _read_index(self):
+        if not self.index_path.exists():
+            return []
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            return json.load(f).get("entries", [])
+
+    def _write_index(self):
+        self.library_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"entries": self.entries}, f, indent=2)
+        os.replace(tmp_path, self.index_path)
+
+    def add_master(self, master_file, temperature, exptime, scaled, method=""):
+        '''
+        Copy *master_file* into the library and register it in the index.
+        An existing entry with the same temperature, exposure and scaling
+        is replaced.
+        '''
+        temperature = float(temperature)
+        exptime = float(exptime)
+        name = f"masterdark_T{temperature:+.1f}_E{exptime:g}{'_s' if scaled else ''}.fits"
+        self.library_dir.mkdir(parents=True, exist_ok=True)
+        with fits.open(master_file) as hdul:
+            header = hdul[0].header.copy()
+            data = hdul[0].data.astype(np.float32)
+        header["DL_TEMP"] = (temperature, "Library CCD temperature")
+        header["DL_EXPT"] = (exptime, "Library exposure time")
+        header["DL_SCALE"] = (bool(scaled), "Dark signal per 1 second")
+        fits.PrimaryHDU(data, header=header).writeto(self.library_dir / name, overwrite=True)
+
+        self.entries = [e for e in self.entries if e["file"] != name]
+        self.entries.append({"file": name, "temperature": temperature,
+                             "exptime": exptime, "scaled": bool(scaled),
+                             "method": method})
+        self.entries.sort(key=lambda e: (e["exptime"], e["temperature"]))
+        self._write_index()
+        self._cache.clear()
+        self._masters.pop(name, None)
+        return self.library_dir / name
+
+    # -- reading --------------------------------------------------------------
+    def _load_master(self, entry):
+        name = entry["file"]
+        if name not in self._masters:
+            with fits.open(self.library_dir / name) as hdul:
+                self._masters[name] = (hdul[0].data.astype(np.float32), hdul[0].header.copy())
+        return self._masters[name][0]
+
+    def _master_header(self, entry):
+        self._load_master(entry)
+        return self._masters[entry["file"]][1]
+
+    def _rate(self, entry):
+        # Dark signal per second for *entry*
+        data = self._load_master(entry)
+        if entry["scaled"]:
+            return data
+        return data / np.float32(entry["exptime"])
+
+    def _candidates(self, exptime):
+        '''
+        Entries usable for *exptime* and a flag telling whether their data
+        must be scaled by the exposure time. Masters taken at the very same
+        exposure are preferred as they also contain non-linear components
+        (e.g. amplifier glow).
+        '''
+        equal = [e for e in self.entries
+                 if not e["scaled"] and abs(e["exptime"] - exptime) < 1e-3]
+        if equal:
+            return equal, False
+        return list(self.entries), True
+
+    def _interpolate(self, low, high, weight):
+        # Vectorized interpolation between two dark arrays
+        if self.interpolation == "log":
+            tiny = np.float32(1e-6)
+            out = np.log(np.maximum(low, tiny))
+            out *= np.float32(1.0 - weight)
+            out += np.float32(weight) * np.log(np.maximum(high, tiny))
+            np.exp(out, out=out)
+            return out
+        out = high - low
+        out *= np.float32(weight)
+        out += low
+        return out
+
+    def _cache_path(self, temperature, exptime):
+        return self.cache_dir / f"darkinterp_T{temperature:+.1f}_E{exptime:g}.fits"
+
+    def get_dark(self, temperature, exptime):
+        '''
+        Return the dark signal (ADU) for a frame taken at *temperature* with
+        exposure time *exptime*, and the header of the library master it was
+        made from (its binning).
+        '''
+        if not self.entries:
+            raise FileNotFoundError(f"Dark library '{self.index_path}' is empty or missing.")
+
+        temperature = round(float(temperature) / self.temperature_step) * self.temperature_step
+        exptime = float(exptime)
+        key = (round(temperature, 3), exptime)
+        if key in self._cache:
+            return self._cache[key]
+
+        candidates, scale = self._candidates(exptime)
+        candidates = sorted(candidates, key=lambda e: e["temperature"])
+        nearest = min(candidates, key=lambda e: abs(e["temperature"] - temperature))
+
+        if abs(nearest["temperature"] - temperature) <= self.tolerance:
+            dark = self._rate(nearest) * np.float32(exptime) if scale else self._load_master(nearest)
+            result = (dark, self._master_header(nearest))
+        else:
+            result = self._read_cached(temperature, exptime)
+            if result is None:
+                result = self._build_interpolated(candidates, temperature, exptime, scale)
+
+        self._cache[key] = result
+        return result
+
+    def _read_cached(self, temperature, exptime):
+        path = self._cache_path(temperature, exptime)
+        if not path.exists():
+            return None
+        # the cache is invalidated by any change of the library index
+        if self.index_path.exists() and path.stat().st_mtime < self.index_path.stat().st_mtime:
+            return None
+        if self.verbose:
+            print(f"[INFO] Using cached interpolated dark '{path}'.")
+        with fits.open(path) as hdul:
+            return hdul[0].data.astype(np.float32), hdul[0].header.copy()
+
+    def _build_interpolated(self, candidates, temperature, exptime, scale):
+        lower = [e for e in candidates if e["temperature"] <= temperature]
+        upper = [e for e in candidates if e["temperature"] > temperature]
+        if not lower or not upper:
+            # outside of the library range - no extrapolation, use the closest entry
+            entry = lower[-1] if lower else upper[0]
+            print(f"[WARNING] CCD temperature {temperature:+.1f} outside of dark library range, "
+                  f"using entry at {entry['temperature']:+.1f}.")
+            dark = self._rate(entry) * np.float32(exptime) if scale else self._load_master(entry)
+            return dark, self._master_header(entry)
+
+        low, high = lower[-1], upper[0]
+        weight = (temperature - low["temperature"]) / (high["temperature"] - low["temperature"])
+        if scale:
+            dark = self._interpolate(self._rate(low), self._rate(high), weight)
+            dark *= np.float32(exptime)
+        else:
+            dark = self._interpolate(self._load_master(low), self._load_master(high), weight)
+
+        if self.verbose:
+            print(f"[INFO] Interpolated dark for T={temperature:+.1f}, t={exptime:g}s "
+                  f"between {low['file']} and {high['file']} (w={weight:.3f}).")
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        hdu = fits.PrimaryHDU(dark.astype(np.float32))
+        hdu.header["DL_TEMP"] = (temperature, "Interpolated CCD temperature")
+        hdu.header["DL_EXPT"] = (exptime, "Exposure time")
+        hdu.header["DL_LOW"] = (low["file"], "Lower library entry")
+        hdu.header["DL_HIGH"] = (high["file"], "Upper library entry")
+        hdu.header["DL_INTP"] = (self.interpolation, "Interpolation method")
+        binning.copy_binning(self._master_header(low), hdu.header)
+        hdu.writeto(self._cache_path(temperature, exptime), overwrite=True)
+        return dark, hdu.header
+
+
+# ---------------------------------------------------------------------------
+# Function: library_from_config
+# Description:
+#   Creates a DarkLibrary object using [DARK_SUBTRACTION] settings.
+# ---------------------------------------------------------------------------
+def library_from_config(cfg, verbose=False):
+    return DarkLibrary(cfg.get("DARK_SUBTRACTION", "library_dir", "./library/darks"),
+                       tolerance=cfg.get("DARK_SUBTRACTION", "temperature_tolerance", 0.5),
+                       interpolation=cfg.get("DARK_SUBTRACTION", "temperature_interpolation", "linear"),
+                       verbose=verbose)
+
+
+# ---------------------------------------------------------------------------
+# Function: header_temperature
+# Description:
+#   Returns the CCD temperature stored in the header or None.
+# ---------------------------------------------------------------------------
+def header_temperature(header, cfg):
+    keyword = cfg.get("HEADER_SPECIFICATION", "temperature_keyword", "CCD-TEMP")
+    value = header.get(keyword)
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Main block: add masters to the library or list its content.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage the temperature-indexed library of master darks.")
+    parser.add_argument("-c", "--config", type=str, default="config.ini", help="Specify path to config file")
+    parser.add_argument("-a", "--add", type=str, help="Master dark file to be added to the library")
+    parser.add_argument("-t", "--temperature", type=float,
+                        help="CCD temperature of the added master (default: read from header)")
+    parser.add_argument("-e", "--exptime", type=float,
+                        help="Exposure time of the added master (default: read from header)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
+    args = parser.parse_args()
+
+    from calib_config import CalibConfig
+    cfg = CalibConfig(args.config)
+    library = library_from_config(cfg, verbose=args.verbose)
+
+    if args.add:
+        header = fits.getheader(args.add)
+        temperature = args.temperature if args.temperature is not None else header_temperature(header, cfg)
+        exptime = args.exptime if args.exptime is not None else header.get("MD_EXPT")
+        if temperature is None or exptime is None:
+            print("[ERROR]: CCD temperature or exposure time unknown, use -t/-e options.")
+            sys.exit(1)
+        scaled = bool(header.get("MD_SCALE", str(header.get("MD_COMB", "")).startswith("ScaledExposure")))
+        path = library.add_master(args.add, temperature, exptime, scaled, header.get("MD_COMB", ""))
+        print(f"Master dark added to the library: '{path}'.")
+
+    for entry in library.entries:
+        print(f"{entry['file']:40s} T={entry['temperature']:+6.1f}  t={entry['exptime']:8.2f}s  "
+              f"scaled={entry['scaled']}")
+    sys.exit(0)
+
+### END
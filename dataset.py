@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: dataset.py
+# Description:
+#   Lazily calibrated frames: a dataset over the raw frames of a night and
+#   the masters, for analysis code that only needs the calibrated pixels.
+#   - no '-b', '-bd' or '-bdf' files are written; the raw frames stay the
+#     only stored copy,
+#   - a frame is calibrated when it is asked for (calibration.Calibrator,
+#     same float32 result as the file pipeline),
+#   - a cutout only reads its window of the raw frame and of the masters
+#     (HDU.section) and is calibrated on its own, unless the whole frame
+#     is already in the cache,
+#   - recent frames and cutouts are kept in an LRU cache limited to
+#     [DATASET] cache_mb.
+#   Coordinates of cutouts are (rows, cols) slices of the calibrated
+#   (trimmed) frame, i.e. the pixels of the '-bdf' file.
+#   Example:
+#     frames = dataset.CalibratedDataset(files, cfg)
+#     data, header = frames.frame(0)
+#     stamp = frames.cutout(3, slice(100, 164), slice(200, 264))
+# =============================================================================
+
+import sys
+import argparse
+import threading
+from collections import OrderedDict
+import numpy as np
+from astropy.io import fits
+from pathlib import Path
+import calibration
+import detector
+import roi
+import scanner
+import warnings
+warnings.filterwarnings("ignore")
+
+
+DEFAULT_CACHE_MB = 256
+
+
+# ---------------------------------------------------------------------------
+# Class: MasterCutouts
+# Description:
+#   Master lookups of a calibration.Calibrator restricted to one window
+#   (master pixels); only the window of every master file is read.
+# ---------------------------------------------------------------------------
+class MasterCutouts:
+    def __init__(self, reader, rows, cols):
+        self.reader = reader
+        self.rows = rows
+        self.cols = cols
+
+    def get(self, name, frame_header):
+        return self.reader.cutout(name, self.rows, self.cols, frame_header)
+
+
+# ---------------------------------------------------------------------------
+# Class: CalibratedDataset
+# Description:
+#   Calibrated view of the raw *files* (frames of *imagetypes* only) with
+#   the masters of *master_dir* (default: working_dir). frame() and
+#   cutout() calibrate on access; results are cached (LRU, *cache_mb*).
+# ---------------------------------------------------------------------------
+class CalibratedDataset:
+    def __init__(self, files, cfg, master_dir=None, cache_mb=None, imagetypes=("OBJECT",), verbose=False):
+        self.cfg = cfg
+        self.master_dir = Path(master_dir or cfg.get("DATA_STRUCTURE", "working_dir", "./work/"))
+        self.verbose = verbose
+        records = scanner.scan(cfg=cfg, files=files)
+        # record.imagetyp is BIAS, DARK, FLAT or OBJECT (labels of the config)
+        self.files = [record.path for record in records if imagetypes is None or record.imagetyp in imagetypes]
+        self.cache_bytes = int(float(cache_mb if cache_mb is not None else
+                                     cfg.get("DATASET", "cache_mb", DEFAULT_CACHE_MB)) * 1024 ** 2)
+        self.cache = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self._calibrator = None
+        self._reader = roi.ROICalibrator(cfg, self.master_dir)
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        return self.frame(index)[0]
+
+    def __iter__(self):
+        for index in range(len(self.files)):
+            data, header = self.frame(index)
+            yield self.files[index], data, header
+
+    def index(self, key):
+        '''Position of a frame given by position or by path.'''
+        if isinstance(key, (int, np.integer)):
+            return range(len(self.files))[key]
+        return self.files.index(str(key))
+
+    @property
+    def calibrator(self):
+        # the full masters are only read for the first whole frame
+        if self._calibrator is None:
+            mask_name = self.cfg.get("MASKS", "bad_pixel_mask_file", "badpixmask.fits")
+            masters = calibration.MasterSet.from_directory(
+                self.master_dir, mask_name if self.cfg.get("MASKS", "use_masks", False) else None)
+            self._calibrator = calibration.Calibrator(masters, self.cfg)
+        return self._calibrator
+
+    # -----------------------------------------------------------------------
+    # Method: frame
+    # Description:
+    #   Calibrated float32 data and header of frame *key* (position or
+    #   path). The cached arrays are shared: copy them before changing.
+    # -----------------------------------------------------------------------
+    def frame(self, key):
+        index = self.index(key)
+        cached = self._cached((index, None))
+        if cached is not None:
+            return cached
+        with fits.open(self.files[index]) as hdul:
+            data, header = self.calibrator.calibrate(hdul[0])
+        if self.verbose:
+            print(f"[INFO] Calibrated {self.files[index]} ({header['CALSTEPS']})")
+        return self._store((index, None), (data, header))
+
+    def header(self, key):
+        return self.frame(key)[1]
+
+    # -----------------------------------------------------------------------
+    # Method: cutout
+    # Description:
+    #   Calibrated float32 pixels [rows, cols] of frame *key*, in pixels of
+    #   the calibrated (trimmed) frame. Only the window is read and
+    #   calibrated, with the overscan level of the whole trimmed frame.
+    # -----------------------------------------------------------------------
+    def cutout(self, key, rows, cols):
+        index = self.index(key)
+        whole = self._cached((index, None), count=False)
+        if whole is not None:
+            return whole[0][rows, cols]
+        cache_key = (index, rows.start, rows.stop, cols.start, cols.stop)
+        cached = self._cached(cache_key)
+        if cached is not None:
+            return cached
+        with fits.open(self.files[index]) as hdul:
+            data = self._calibrate_window(hdul[0], rows, cols)
+        return self._store(cache_key, data)
+
+    def _calibrate_window(self, hdu, rows, cols):
+        header = hdu.header.copy()
+        trim, bias = detector.frame_sections(header, self.cfg)
+        trim_rows, trim_cols = trim if trim is not None else (slice(0, hdu.shape[0]), slice(0, hdu.shape[1]))
+        height, width = trim_rows.stop - trim_rows.start, trim_cols.stop - trim_cols.start
+        if not (0 <= rows.start < rows.stop <= height and 0 <= cols.start < cols.stop <= width):
+            raise ValueError(f"Cutout {detector.format_section((rows, cols))} lies outside the "
+                             f"{width}x{height} frame.")
+        raw = hdu.section[trim_rows.start + rows.start:trim_rows.start + rows.stop,
+                          trim_cols.start + cols.start:trim_cols.start + cols.stop]
+        overscan = None
+        if bias is not None:
+            overscan = detector.overscan_level(hdu, trim, bias, self.cfg.get("DETECTOR", "overscan_method", "row"))
+            if np.ndim(overscan) == 2:
+                overscan = overscan[rows] if overscan.shape[0] > 1 else overscan[:, cols]
+
+        # master pixels: detector position of the trimmed frame (subframes)
+        x0, y0 = roi.subframe_origin(header, self.cfg)
+        masters = MasterCutouts(self._reader, slice(rows.start + y0, rows.stop + y0),
+                                slice(cols.start + x0, cols.stop + x0))
+        calibrator = calibration.Calibrator(masters, self.cfg)
+        stack, _, _ = calibrator.calibrate_group([(raw, overscan, header)])
+        return stack[0]
+
+    # -----------------------------------------------------------------------
+    # Method: _cached / _store
+    # Description:
+    #   LRU cache of frames and cutouts, limited to cache_bytes.
+    # -----------------------------------------------------------------------
+    def _cached(self, key, count=True):
+        with self.lock:
+            value = self.cache.get(key)
+            if value is None:
+                self.misses += count
+                return None
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _store(self, key, value):
+        size = (value[0] if isinstance(value, tuple) else value).nbytes
+        with self.lock:
+            if key not in self.cache and size <= self.cache_bytes:
+                self.cache[key] = value
+                self.cached_bytes += size
+                while self.cached_bytes > self.cache_bytes:
+                    _, old = self.cache.popitem(last=False)
+                    self.cached_bytes -= (old[0] if isinstance(old, tuple) else old).nbytes
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {"frames": len(self.files), "cached": len(self.cache),
+                    "cached_mb": round(self.cached_bytes / 1024 ** 2, 1), "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        self._reader.close()
+        with self.lock:
+            self.cache.clear()
+            self.cached_bytes = 0
+
+
+# ---------------------------------------------------------------------------
+# Main block: statistics of calibrated frames or cutouts, no files written.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate frames on access and print their statistics.")
+    parser.add_argument("inputs", nargs="+", help="raw FITS files, list files (.lst/.txt) or directories")
+    parser.add_argument("-c", "--config", type=str, default="config.ini", help="Specify path to config file")
+    parser.add_argument("-w", "--window", action="append",
+                        help="cutout '[x1:x2,y1:y2]' in calibrated frame pixels (may be repeated)")
+    parser.add_argument("-m", "--masters", type=str, help="directory with the masters (default: working_dir)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
+    args = parser.parse_args()
+
+    from calib_config import CalibConfig
+    import binning
+    cfg = CalibConfig(args.config)
+    try:
+        windows = roi.parse_windows(args.window)
+    except ValueError as e:
+        print(f"[ERROR]: {e}")
+        sys.exit(1)
+    frames = CalibratedDataset(binning.collect_input_files(args.inputs), cfg, args.masters, verbose=args.verbose)
+    if not len(frames):
+        print("No science frames found.")
+        sys.exit(1)
+    for index, file in enumerate(frames.files):
+        try:
+            pieces = ([(detector.format_section(window), frames.cutout(index, *window)) for window in windows]
+                      if windows else [("", frames[index])])
+            for name, data in pieces:
+                print(f"{file}{name}  median {np.nanmedian(data):10.2f}  std {np.nanstd(data):9.2f}  "
+                      f"shape {data.shape[1]}x{data.shape[0]}")
+        except Exception as e:
+            print(f"Skipping {file}: {e}")
+    if args.verbose:
+        print(f"[INFO] Cache: {frames.stats()}")
+    frames.close()
+    sys.exit(0)
+
+### END
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: detector.py
+# Description:
+#   Detector geometry: trimming to the useful detector area and overscan
+#   (prescan) level subtraction.
+#
+#   The sections are given per camera in the [DETECTOR] part of config.ini
+#   (or read from TRIMSEC/BIASSEC header keywords) in FITS notation
+#   '[x1:x2,y1:y2]' (1-based, inclusive). Trimming happens when a frame is
+#   read: only the TRIMSEC pixels and the overscan strip are read from the
+#   file (HDU.section), so discarded columns and rows are never decoded,
+#   combined or written by any later stage.
+# =============================================================================
+
+import re
+import numpy as np
+
+
+SECTION_PATTERN = re.compile(r"^\[\s*(\d+)\s*:\s*(\d+)\s*,\s*(\d+)\s*:\s*(\d+)\s*\]$")
+TRIMMED_KEYWORD = "CALTRIM"
+
+
+# ---------------------------------------------------------------------------
+# Function: parse_section
+# Description:
+#   Converts a FITS section string '[x1:x2,y1:y2]' into a tuple of numpy
+#   slices (rows, columns). Returns None for empty or 'none' values.
+#   Lists produced by CalibConfig (the comma splits the value) are accepted.
+# ---------------------------------------------------------------------------
+def parse_section(value):
+    if value is None:
+        return None
+    if isinstance(value, (list, tuple)):
+        value = ",".join(str(v) for v in value)
+    value = str(value).strip()
+    if value.lower() in ("", "none"):
+        return None
+    match = SECTION_PATTERN.match(value)
+    if not match:
+        raise ValueError(f"Invalid detector section '{value}', expected '[x1:x2,y1:y2]'.")
+    x1, x2, y1, y2 = (int(v) for v in match.groups())
+    if x2 < x1 or y2 < y1 or x1 < 1 or y1 < 1:
+        raise ValueError(f"Invalid detector section '{value}'.")
+    return slice(y1 - 1, y2), slice(x1 - 1, x2)
+
+
+def format_section(section):
+    rows, cols = section
+    return f"[{cols.start + 1}:{cols.stop},{rows.start + 1}:{rows.stop}]"
+
+
+# ---------------------------------------------------------------------------
+# Function: frame_sections
+# Description:
+#   Returns the (trim, bias) sections for a frame with *header*. Header
+#   TRIMSEC/BIASSEC are used if [DETECTOR] header_sections is True.
+#   Frames already trimmed by the pipeline get (None, None).
+# ---------------------------------------------------------------------------
+def frame_sections(header, cfg):
+    if TRIMMED_KEYWORD in header:
+        return None, None
+    trimsec = cfg.get("DETECTOR", "trimsec", None)
+    biassec = cfg.get("DETECTOR", "biassec", None)
+    if cfg.get("DETECTOR", "header_sections", False):
+        trimsec = header.get("TRIMSEC", trimsec)
+        biassec = header.get("BIASSEC", biassec)
+    return parse_section(trimsec), parse_section(biassec)
+
+
+# ---------------------------------------------------------------------------
+# Function: overscan_level
+# Description:
+#   Overscan level for the trimmed area, read from the overscan strip only.
+#   A vertical strip (columns) gives one level per trimmed row, a horizontal
+#   strip one level per trimmed column; method 'mean' gives a single median
+#   level for the whole frame.
+# ---------------------------------------------------------------------------
+def overscan_level(hdu, trim, bias, method="row"):
+    height, width = hdu.shape
+    trim_rows, trim_cols = trim if trim is not None else (slice(0, height), slice(0, width))
+    bias_rows, bias_cols = bias
+    vertical = (bias_cols.stop - bias_cols.start) <= (bias_rows.stop - bias_rows.start)
+    if vertical:
+        strip = hdu.section[trim_rows, bias_cols]
+        axis = 1
+    else:
+        strip = hdu.section[bias_rows, trim_cols]
+        axis = 0
+    if str(method).lower() == "mean":
+        return np.float32(np.median(strip))
+    level = np.median(strip, axis=axis).astype(np.float32)
+    return level[:, None] if vertical else level[None, :]
+
+
+# ---------------------------------------------------------------------------
+# Class: ArrayFrame
+# Description:
+#   A raw frame held in memory (array and header) usable wherever a primary
+#   HDU is read here: .section slices the array itself.
+# ---------------------------------------------------------------------------
+class ArrayFrame:
+    def __init__(self, data, header):
+        self.data = data
+        self.section = data
+        self.header = header
+        self.shape = data.shape
+
+
+# ---------------------------------------------------------------------------
+# Function: read_trimmed
+# Description:
+#   Reads the primary data of *hdu* restricted to the trim section.
+#   Returns (raw, overscan, header):
+#   - raw      - trimmed raw data in its native (scaled) dtype,
+#   - overscan - overscan level to subtract (float32 array broadcastable
+#                to raw, a scalar, or None if no overscan is defined),
+#   - header   - copy of the header describing the trimmed frame.
+# ---------------------------------------------------------------------------
+def read_trimmed(hdu, cfg):
+    header = hdu.header.copy()
+    trim, bias = frame_sections(header, cfg)
+    if trim is None and bias is None:
+        return hdu.data, None, header
+
+    if trim is not None:
+        raw = hdu.section[trim]
+    else:
+        raw = hdu.data
+
+    overscan = None
+    if bias is not None:
+        overscan = overscan_level(hdu, trim, bias, cfg.get("DETECTOR", "overscan_method", "row"))
+
+    update_header(header, trim, overscan)
+    return raw, overscan, header
+
+
+# ---------------------------------------------------------------------------
+# Function: read_frame
+# Description:
+#   Trimmed, overscan-subtracted float32 data and the updated header.
+# ---------------------------------------------------------------------------
+def read_frame(hdu, cfg):
+    raw, overscan, header = read_trimmed(hdu, cfg)
+    data = raw.astype(np.float32)
+    if overscan is not None:
+        data -= overscan
+    return data, header
+
+
+# ---------------------------------------------------------------------------
+# Function: update_header
+# Description:
+#   Records trimming and overscan subtraction in the header and shifts the
+#   WCS reference pixel to the trimmed frame (IRAF LTV keywords as well).
+# ---------------------------------------------------------------------------
+def update_header(header, trim, overscan):
+    for keyword in ("TRIMSEC", "BIASSEC", "DATASEC"):
+        header.remove(keyword, ignore_missing=True)
+    if trim is not None:
+        rows, cols = trim
+        header[TRIMMED_KEYWORD] = (format_section(trim), "Trimmed to this detector section")
+        for axis, offset in (("1", cols.start), ("2", rows.start)):
+            if "CRPIX" + axis in header:
+                header["CRPIX" + axis] = header["CRPIX" + axis] - offset
+            header["LTV" + axis] = (header.get("LTV" + axis, 0) - offset, "Offset from raw frame")
+    else:
+        header[TRIMMED_KEYWORD] = ("none", "Full frame kept")
+    if overscan is not None:
+        header["OVERSCAN"] = (float(np.median(overscan)), "Median overscan level subtracted (ADU)")
+    return header
+
+### END
@@ -10,56 +10,178 @@ import sys
 import numpy as np
 from astropy.io import fits
 from pathlib import Path
-import getconfig
+import masks
+import binning
+import preview
+import quality
+import streaming
+import buffers
+import registry
+import site_config
+from calibration import divide_flat  # NEW: shared correction kernel (calibration.py)
 import warnings
 warnings.filterwarnings("ignore")
-import shutil
 
-def get_filter_from_header(header):
-    filt = header.get('FILTER', '').strip()
-    ## print(filt)
-    return filt if filt in ['U', 'B', 'V', 'R', 'I', 'Haw', 'Han', 'None', "-"] else 'UNKNOWN'
+def get_filter_from_header(header, config=None):
+    # NEW: filter names and aliases of the config (site_config.py) instead of
+    # a fixed list
+    return site_config.from_calib_config(config).filter_of(header)
 
-def apply_flat_correction(list_in, list_out):
+
+def apply_flat_correction(list_in, list_out, cfg, files=None, verbose=False):
     # Applies bias correction to all non-bias FITS frames in the directory
     #path = Path(directory)
+    # NEW: settings from the given 'cfg' (CalibConfig), no module globals
+    working_dir = cfg.get("DATA_STRUCTURE", "working_dir")
+    results_aux_dir = cfg.get("DATA_STRUCTURE", "results_aux_dir")
     
-    with open(list_in) as f:
-        files_in = f.read().splitlines()
+    # NEW: inputs selected from the frame registry (only science frames)
+    frames = registry.registry_from_config(cfg)
+    files_in = (files if files is not None else
+                registry.stage_inputs(frames, list_in, "bd", imagetypes=("OBJECT",)))
+    files_out = []
     ## print(files_in), exit()    
     all_filter_entries = []
 
     for filename in files_in:
-        with fits.open(filename) as hdul:
-            header = hdul[0].header
-            data = hdul[0].data.astype(np.float32)
-            imagetyp = header.get("IMAGETYP", "").strip().upper()
-            if imagetyp == "OBJECT":
-                filt = get_filter_from_header(header)
-                all_filter_entries.append(filt)
+        header = fits.getheader(filename)  # the data is not needed here
+        imagetyp = site_config.from_calib_config(cfg).image_type_of(header)
+        if imagetyp == "OBJECT":
+            filt = get_filter_from_header(header, cfg)
+            all_filter_entries.append(filt)
     all_existing_filters = set(all_filter_entries)
     ## print(all_existing_filters), exit()
+
+    # NEW: static bad-pixel mask, combined with per-frame saturation flags below
+    use_masks = cfg.get("MASKS", "use_masks", False)
+    mask_name = cfg.get("MASKS", "bad_pixel_mask_file", "badpixmask.fits")
+    # NEW: band-by-band correction with bounded memory (strip_rows > 0 or
+    # frames too large for the memory budget); quality metrics and previews
+    # need the whole frame and are not made in this mode
+    strip_rows = streaming.strip_rows_from_config(cfg, files_in)
+    mf_bands = {}
+    mask_bands = None
+    if strip_rows and use_masks and Path(working_dir + "/" + mask_name).exists():
+        mask_bands = streaming.MasterBands(working_dir + "/" + mask_name, binning.MASTER_BINNING["badpixmask"])
+    static_mask, static_mask_header = (masks.read_bad_pixel_mask(working_dir + "/" + mask_name, with_header=True)
+                                       if use_masks and not strip_rows else (None, None))
+    mask_binned = {}
+    mf_cache = {}
+    masked_value = masks.masked_value_from_config(cfg)
+    make_previews = preview.previews_enabled(cfg) and not strip_rows
+    quality_db = quality.quality_db_from_config(cfg) if not strip_rows else None
+    work = buffers.worker_buffers()  # NEW: float32 frame buffer reused for all frames
     
     # calibrating...
     for filename in files_in:
         with fits.open(filename) as hdul:
             header = hdul[0].header
-            data = hdul[0].data.astype(np.float32)
-            imagetyp = header.get("IMAGETYP", "").strip().upper()
-            if imagetyp == "OBJECT":
-                filt = get_filter_from_header(header)
+            imagetyp = site_config.from_calib_config(cfg).image_type_of(header)
+            if imagetyp == "OBJECT" and strip_rows:
+                filt = get_filter_from_header(header, cfg)
+                mf_file = working_dir + "/masterflat_" + filt + "_norm.fits"
+                if mf_file not in mf_bands:
+                    mf_bands[mf_file] = streaming.MasterBands(mf_file, binning.MASTER_BINNING["masterflat"])
+                extention = str(filename.split(".")[-1])
+                new_filepath = str(filename.replace("-bd","").split("."+extention)[0]) + "-bdf." + extention
+                flat_correct_in_strips(hdul, new_filepath, cfg, mf_bands[mf_file], mask_bands if use_masks else None,
+                                       use_masks, masked_value, mask_name, strip_rows)
+                files_out.append((filename, new_filepath))
+            elif imagetyp == "OBJECT":
+                data = hdul[0].data
+                filt = get_filter_from_header(header, cfg)
                 mf_file = working_dir + "/masterflat_" + filt + "_norm.fits"
-                mf_data = fits.open(mf_file, mode="readonly")[0].data.astype(np.float32)
+                if mf_file not in mf_cache:
+                    with fits.open(mf_file, mode="readonly") as mf_hdul:
+                        mf_cache[mf_file] = (mf_hdul[0].data.astype(np.float32), mf_hdul[0].header, {})
+                # NEW: normalized masterflat binned to the frame binning if needed
+                mf_data, mf_header, mf_binned = mf_cache[mf_file]
+                mf_data = binning.match_binning(mf_data, mf_header, header,
+                                                binning.MASTER_BINNING["masterflat"], mf_binned)
                 
-                data_cal = data / mf_data
+                data_cal = divide_flat(data, mf_data, out=work.get("frame", data.shape))
                 extention = str(filename.split(".")[-1])
                 new_filepath = str(filename.replace("-bd","").split("."+extention)[0]) + "-bdf." + extention
+                # NEW: quality metrics while the calibrated frame is in memory
+                if quality_db is not None:
+                    quality_db.add(quality.frame_metrics(data_cal, header, cfg, new_filepath,
+                                                         masks.read_saturation_flags(hdul)))
      
+                hdus = []
+                if use_masks:
+                    saturated = masks.read_saturation_flags(hdul)
+                    frame_static_mask = static_mask
+                    if static_mask is not None:
+                        frame_static_mask = binning.match_binning(static_mask, static_mask_header, header,
+                                                                  binning.MASTER_BINNING["badpixmask"],
+                                                                  mask_binned)
+                    mask = masks.frame_mask(frame_static_mask, saturated)
+                    if masked_value is not None:
+                        masks.apply_mask(data_cal, mask, masked_value)
+                    if static_mask is not None:
+                        header["BPMFILE"] = (mask_name, "Static bad-pixel mask")
+                    header["NBADPIX"] = (int(np.count_nonzero(mask)) if mask is not None else 0,
+                                         "Number of flagged pixels")
+                    if saturated is not None:
+                        hdus.append(hdul[masks.SATMASK_EXTNAME].copy())
+
                 # Save the bias-corrected image
-                hdu = fits.PrimaryHDU(data_cal.astype(np.float32), header=header)
+                hdu = fits.PrimaryHDU(data_cal, header=header)
                 ## TO DO: add header entries
-                hdu.writeto(new_filepath, overwrite=True)
+                fits.HDUList([hdu] + hdus).writeto(new_filepath, overwrite=True)
+                # NEW: quick-look preview from the calibrated array in memory
+                if make_previews:
+                    preview.make_preview(data_cal, preview.png_name(new_filepath, results_aux_dir),
+                                         preview.preview_size(cfg))
                 hdul.flush()
+                files_out.append((filename, new_filepath))
+
+    if quality_db is not None:
+        quality_db.flush()
+    if list_out is not None:
+        registry.write_list(list_out, [output for _, output in files_out])
+    if frames is not None:
+        frames.record_outputs("bdf", files_out)
+    for bands in list(mf_bands.values()) + [mask_bands]:
+        if bands is not None:
+            bands.close()
+    return files_out
+
+
+# ---------------------------------------------------------------------------
+# Function: flat_correct_in_strips
+# Description:
+#   Flat correction of one open frame band by band (streaming.py), with
+#   the static bad-pixel mask and saturation flags applied per band.
+# ---------------------------------------------------------------------------
+def flat_correct_in_strips(hdul, new_filepath, cfg, mf, mask_bands, use_masks, masked_value, mask_name, strip_rows):
+    header = hdul[0].header
+    width = hdul[0].shape[1]
+    sat_hdu = hdul[masks.SATMASK_EXTNAME] if masks.SATMASK_EXTNAME in hdul else None
+    nbad = [0]
+
+    def correct_band(raw, overscan, rows):
+        band = divide_flat(raw, mf.band(rows, width, header))
+        if use_masks:
+            flags = (mask_bands.band(rows, width, header) if mask_bands is not None
+                     else np.zeros(band.shape, dtype=np.uint8))
+            if sat_hdu is not None:
+                flags[masks.unpack_flags(sat_hdu.data[rows], width)] |= masks.SATURATED
+            nbad[0] += int(np.count_nonzero(flags))
+            if masked_value is not None:
+                masks.apply_mask(band, flags, masked_value)
+        return band
+
+    header_cards, extensions, finalize = {}, [], None
+    if use_masks:
+        if mask_bands is not None:
+            header_cards["BPMFILE"] = (mask_name, "Static bad-pixel mask")
+        header_cards["NBADPIX"] = (0, "Number of flagged pixels")
+        finalize = lambda: {"NBADPIX": nbad[0]}
+        if sat_hdu is not None:
+            extensions.append(sat_hdu.copy())
+    streaming.correct_in_strips(hdul[0], new_filepath, cfg, correct_band, strip_rows,
+                                extensions=extensions, header_cards=header_cards, finalize=finalize)
                 
                 
 if __name__ == "__main__":
@@ -87,14 +209,11 @@ if __name__ == "__main__":
     ## obs_name = cfg.get("GENERAL", "observatory_name")
     ## gain = cfg.get("DEFAULT_VALUES", "gain")
     ## print(f"Observatory: {obs_name}, Gain: {gain}")
-    working_dir = cfg.get("DATA_STRUCTURE", "working_dir")
-    results_dir = cfg.get("DATA_STRUCTURE", "results_dir")
-    results_aux_dir = cfg.get("DATA_STRUCTURE", "results_aux_dir")
     
     '''
     Applying procedures
     '''
-    apply_flat_correction(list_of_files_in, list_of_files_out)
+    apply_flat_correction(list_of_files_in, list_of_files_out, cfg, verbose=verbose)
     sys.exit(0)
     
 ### END
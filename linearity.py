@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: linearity.py
+# Description:
+#   Correction of the detector non-linearity ([LINEARITY] in config.ini):
+#   every raw ADU value x is replaced by the linear ADU value f(x), with
+#   - method 'polynomial': f(x) = c0 + c1*x + c2*x^2 + ... (coefficients),
+#   - method 'curve': a measured curve, two columns (raw ADU, linear ADU)
+#     in curve_file, interpolated linearly (and extrapolated with the
+#     slope of the first / last segment).
+#   For 16-bit integer data f is compiled once into a lookup table of all
+#   65536 input values, so the correction of a frame is one np.take; other
+#   (scaled, float or binned) data are corrected by evaluating f.
+#   The correction is applied to the raw frames and their overscan level
+#   in the bias subtraction pass (calibration.subtract_bias) and to the
+#   bias frames combined into the master bias.
+# =============================================================================
+
+import sys
+import argparse
+import functools
+import numpy as np
+
+
+TABLE_SIZE = 65536
+HEADER_KEYWORD = "LINCORR"
+
+
+def _as_floats(value):
+    if isinstance(value, (list, tuple)):
+        return [float(v) for v in value]
+    return [float(v) for v in str(value).replace(",", " ").split()]
+
+
+# ---------------------------------------------------------------------------
+# Function: curve_function
+# Description:
+#   f(x) of a measured curve (*measured* raw ADU -> *linear* ADU).
+# ---------------------------------------------------------------------------
+def curve_function(measured, linear):
+    measured, linear = np.asarray(measured, dtype=np.float64), np.asarray(linear, dtype=np.float64)
+    order = np.argsort(measured)
+    measured, linear = measured[order], linear[order]
+    if len(measured) < 2 or np.any(np.diff(measured) <= 0):
+        raise ValueError("linearity curve needs at least two points with distinct raw ADU values")
+    low = (linear[1] - linear[0]) / (measured[1] - measured[0])
+    high = (linear[-1] - linear[-2]) / (measured[-1] - measured[-2])
+
+    def function(x):
+        y = np.interp(x, measured, linear)
+        y = np.where(x < measured[0], linear[0] + (x - measured[0]) * low, y)
+        return np.where(x > measured[-1], linear[-1] + (x - measured[-1]) * high, y)
+    return function
+
+
+# ---------------------------------------------------------------------------
+# Class: Linearity
+# Description:
+#   The correction f with its lookup tables (one per 16-bit integer
+#   type, built on first use). *name* is recorded in the LINCORR card.
+# ---------------------------------------------------------------------------
+class Linearity:
+    def __init__(self, function, name):
+        self.function = function
+        self.name = name
+        self._tables = {}
+
+    @classmethod
+    def polynomial(cls, coefficients):
+        coefficients = np.asarray(coefficients, dtype=np.float64)
+        return cls(lambda x: np.polynomial.polynomial.polyval(x, coefficients),
+                   "polynomial " + " ".join(f"{c:.6g}" for c in coefficients))
+
+    @classmethod
+    def curve(cls, measured, linear, name="curve"):
+        return cls(curve_function(measured, linear), name)
+
+    def table(self, kind):
+        '''float32 lookup table of all 16-bit values, indexed by the uint16 bit pattern.'''
+        if kind not in self._tables:
+            values = np.arange(TABLE_SIZE, dtype=np.uint16)
+            if kind == "i":
+                values = values.astype(np.int16)  # wraps like the uint16 index below
+            self._tables[kind] = self.function(values.astype(np.float64)).astype(np.float32)
+        return self._tables[kind]
+
+    # -----------------------------------------------------------------------
+    # Method: apply
+    # Description:
+    #   f(data) as float32, into *out* when given (shape of data).
+    #   16-bit integer data are looked up in the table.
+    # -----------------------------------------------------------------------
+    def apply(self, data, out=None):
+        data = np.asarray(data)
+        if data.dtype.kind in "iu" and data.dtype.itemsize == 2:
+            index = data.astype(np.uint16, copy=False)
+            if out is None:
+                out = np.empty(data.shape, dtype=np.float32)
+            return np.take(self.table(data.dtype.kind), index, out=out, mode="clip")
+        result = self.function(data.astype(np.float64))
+        if out is None:
+            return np.asarray(result, dtype=np.float32)
+        np.copyto(out, result, casting="unsafe")
+        return out
+
+    def header_card(self):
+        return self.name[:68], "Linearity correction applied"
+
+
+# ---------------------------------------------------------------------------
+# Function: linearity_from_config
+# Description:
+#   Linearity of [LINEARITY] of the config, None if the correction is
+#   disabled. Built once per config (the lookup tables are reused).
+# ---------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def linearity_from_config(cfg):
+    if cfg is None or not cfg.get("LINEARITY", "linearity_correction", False):
+        return None
+    method = str(cfg.get("LINEARITY", "method", "polynomial")).strip().lower()
+    if method == "polynomial":
+        return Linearity.polynomial(_as_floats(cfg.get("LINEARITY", "coefficients", "0.0, 1.0")))
+    if method == "curve":
+        curve_file = cfg.get("LINEARITY", "curve_file", None)
+        if curve_file is None or str(curve_file).strip().lower() == "none":
+            raise ValueError("[LINEARITY] method 'curve' needs a curve_file")
+        measured, linear = np.loadtxt(curve_file, usecols=(0, 1), unpack=True)
+        return Linearity.curve(measured, linear, "curve " + str(curve_file).split("/")[-1])
+    raise ValueError(f"unknown [LINEARITY] method '{method}'")
+
+
+# ---------------------------------------------------------------------------
+# Main block: show the correction of the config at some ADU levels.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the linearity correction of a config.")
+    parser.add_argument("-c", "--config", type=str, default="config.ini", help="Specify path to config file")
+    parser.add_argument("levels", nargs="*", type=float, default=[1000, 10000, 20000, 30000, 40000, 50000, 60000],
+                        help="raw ADU levels")
+    args = parser.parse_args()
+
+    from calib_config import CalibConfig
+    try:
+        linearity = linearity_from_config(CalibConfig(args.config))
+    except (OSError, ValueError) as e:
+        print(f"[ERROR]: {e}")
+        sys.exit(1)
+    if linearity is None:
+        print("Linearity correction is disabled in config.")
+        sys.exit(0)
+    print(f"Linearity correction: {linearity.name}")
+    for level, corrected in zip(args.levels, linearity.apply(np.array(args.levels))):
+        print(f"{level:10.1f} ADU -> {corrected:10.1f} ADU ({100 * (corrected / level - 1) if level else 0.0:+.2f} %)")
+    sys.exit(0)
+
+### END
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: masks.py
+# Description:
+#   Bad-pixel and saturation masks for the calibration pipeline.
+#
+#   Masks are kept as bit flags, never as float images:
+#   - the static bad-pixel mask is one uint8 bitplane (1 byte per pixel)
+#     derived from the masters - hot pixels from the master dark and dead
+#     pixels from the normalized master flats,
+#   - per-frame saturation flags are found in the raw data during the bias
+#     correction and stored bit-packed (np.packbits, 1 bit per pixel) as a
+#     'SATMASK' extension of the corrected frames. The extension is written
+#     only when the frame has saturated pixels.
+#   The full mask of a frame is the static mask OR-ed with its saturation
+#   flags and is built on the fly in the flat correction stage.
+# =============================================================================
+
+import sys
+import argparse
+import numpy as np
+from astropy.io import fits
+from pathlib import Path
+
+
+# Mask bit flags
+HOT = 1
+DEAD = 2
+SATURATED = 4
+
+FLAG_NAMES = {HOT: "HOT", DEAD: "DEAD", SATURATED: "SATURATED"}
+SATMASK_EXTNAME = "SATMASK"
+
+
+# ---------------------------------------------------------------------------
+# Function: saturation_level
+# Description:
+#   Saturation level (ADU) from the header keyword defined in config.ini,
+#   or the [DEFAULT_VALUES] saturate value.
+# ---------------------------------------------------------------------------
+def saturation_level(header, cfg):
+    keyword = cfg.get("HEADER_SPECIFICATION", "saturate_keyword", "SATURATE")
+    try:
+        return float(header[keyword])
+    except (KeyError, TypeError, ValueError):
+        return float(cfg.get("DEFAULT_VALUES", "saturate", 65535))
+
+
+# ---------------------------------------------------------------------------
+# Function: pack_flags / unpack_flags
+# Description:
+#   Convert a boolean image into a bit-packed uint8 array (along rows) and
+#   back.
+# ---------------------------------------------------------------------------
+def pack_flags(flags):
+    return np.packbits(flags, axis=-1)
+
+
+def unpack_flags(packed, width):
+    return np.unpackbits(packed, axis=-1, count=width).view(bool)
+
+
+# ---------------------------------------------------------------------------
+# Function: saturation_hdu
+# Description:
+#   Returns the bit-packed 'SATMASK' extension for raw *data*, or None when
+#   no pixel reaches the saturation *level*. packed_saturation_hdu builds
+#   it from flags already packed (e.g. band by band).
+# ---------------------------------------------------------------------------
+def saturation_hdu(data, level):
+    saturated = data >= level
+    nsat = int(np.count_nonzero(saturated))
+    if nsat == 0:
+        return None
+    return packed_saturation_hdu(pack_flags(saturated), data.shape[-1], level, nsat)
+
+
+def packed_saturation_hdu(packed, width, level, nsat):
+    hdu = fits.ImageHDU(packed, name=SATMASK_EXTNAME)
+    hdu.header["MASKW"] = (width, "Unpacked mask width")
+    hdu.header["SATLEVEL"] = (level, "Saturation level (ADU)")
+    hdu.header["NSATPIX"] = (nsat, "Number of saturated pixels")
+    return hdu
+
+
+# ---------------------------------------------------------------------------
+# Function: read_saturation_flags
+# Description:
+#   Unpacks the 'SATMASK' extension of an open HDUList. Returns None if the
+#   frame has no saturated pixels.
+# ---------------------------------------------------------------------------
+def read_saturation_flags(hdul):
+    if SATMASK_EXTNAME not in hdul:
+        return None
+    hdu = hdul[SATMASK_EXTNAME]
+    return unpack_flags(hdu.data, hdu.header["MASKW"])
+
+
+# ---------------------------------------------------------------------------
+# Function: hot_pixel_flags / dead_pixel_flags
+# Description:
+#   Hot pixels deviate by more than *sigma* robust standard deviations
+#   from the median of the master dark (statistics from a pixel sample).
+#   Dead pixels have a normalized flat response below *threshold*.
+# ---------------------------------------------------------------------------
+def hot_pixel_flags(masterdark, sigma, sample_step=7):
+    sample = masterdark.ravel()[::sample_step]
+    sample = sample[np.isfinite(sample)]
+    median = np.median(sample)
+    spread = 1.4826 * np.median(np.abs(sample - median))
+    if spread == 0:
+        spread = np.std(sample)
+    return masterdark > median + sigma * spread
+
+
+def dead_pixel_flags(normflat, threshold):
+    return ~(normflat >= threshold)  # NaNs are dead as well
+
+
+# ---------------------------------------------------------------------------
+# Function: build_bad_pixel_mask
+# Description:
+#   Creates the static uint8 bad-pixel mask from the master dark and the
+#   normalized master flats. Missing masters are skipped.
+# ---------------------------------------------------------------------------
+def build_bad_pixel_mask(masterdark_path, normflat_paths, hot_sigma=6.0, dead_threshold=0.5):
+    mask = None
+    if masterdark_path is not None and Path(masterdark_path).exists():
+        dark = fits.getdata(masterdark_path).astype(np.float32)
+        mask = np.zeros(dark.shape, dtype=np.uint8)
+        mask[hot_pixel_flags(dark, hot_sigma)] |= HOT
+        del dark
+    for path in normflat_paths:
+        flat = fits.getdata(path).astype(np.float32)
+        if mask is None:
+            mask = np.zeros(flat.shape, dtype=np.uint8)
+        if flat.shape != mask.shape:
+            print(f"Skipping {path}: shape {flat.shape} does not match mask shape {mask.shape}")
+            continue
+        mask[dead_pixel_flags(flat, dead_threshold)] |= DEAD
+    return mask
+
+
+# ---------------------------------------------------------------------------
+# Function: write_bad_pixel_mask / read_bad_pixel_mask
+# ---------------------------------------------------------------------------
+def write_bad_pixel_mask(mask, path, master_header=None):
+    hdu = fits.PrimaryHDU(mask.astype(np.uint8))
+    if master_header is not None:
+        # the mask has the binning of the masters it was derived from
+        for keyword in ("XBINNING", "YBINNING"):
+            if keyword in master_header:
+                hdu.header[keyword] = master_header[keyword]
+    for bit, name in FLAG_NAMES.items():
+        hdu.header[f"MASK{bit}"] = (name, f"Meaning of mask bit value {bit}")
+    hdu.header["NHOTPIX"] = (int(np.count_nonzero(mask & HOT)), "Number of hot pixels")
+    hdu.header["NDEADPIX"] = (int(np.count_nonzero(mask & DEAD)), "Number of dead pixels")
+    hdu.writeto(path, overwrite=True)
+
+
+def read_bad_pixel_mask(path, with_header=False):
+    if path is None or not Path(path).exists():
+        return (None, None) if with_header else None
+    with fits.open(path) as hdul:
+        mask = hdul[0].data.astype(np.uint8)
+        header = hdul[0].header
+    return (mask, header) if with_header else mask
+
+
+# ---------------------------------------------------------------------------
+# Function: frame_mask
+# Description:
+#   Full uint8 mask of a frame: the static mask combined with the frame's
+#   saturation flags. Returns None if there is nothing to mask.
+# ---------------------------------------------------------------------------
+def frame_mask(static_mask, saturation_flags):
+    if saturation_flags is None:
+        return static_mask
+    if static_mask is None:
+        return saturation_flags.astype(np.uint8) * np.uint8(SATURATED)
+    mask = static_mask.copy()
+    mask[saturation_flags] |= SATURATED
+    return mask
+
+
+# ---------------------------------------------------------------------------
+# Function: apply_mask
+# Description:
+#   Replaces all flagged pixels of *data* by *value* (in place).
+# ---------------------------------------------------------------------------
+def apply_mask(data, mask, value):
+    if mask is not None:
+        np.copyto(data, np.float32(value), where=mask != 0)
+    return data
+
+
+# ---------------------------------------------------------------------------
+# Function: masked_value_from_config
+# Description:
+#   Value used for masked pixels of calibrated frames, or None if flagged
+#   pixels are to be kept.
+# ---------------------------------------------------------------------------
+def masked_value_from_config(cfg):
+    value = cfg.get("MASKS", "masked_value", "none")
+    if isinstance(value, str) and value.strip().lower() in ("", "none"):
+        return None
+    return float(value)
+
+
+# ---------------------------------------------------------------------------
+# Main block: build the static bad-pixel mask from existing masters.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create a bad-pixel mask from master dark and normalized flats.")
+    parser.add_argument("-c", "--config", type=str, default="config.ini", help="Specify path to config file")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
+    args = parser.parse_args()
+
+    from calib_config import CalibConfig
+    cfg = CalibConfig(args.config)
+    working_dir = cfg.get("DATA_STRUCTURE", "working_dir")
+    mask_file = Path(working_dir) / cfg.get("MASKS", "bad_pixel_mask_file", "badpixmask.fits")
+
+    mask = build_bad_pixel_mask(Path(working_dir) / "masterdark.fits",
+                                sorted(Path(working_dir).glob("masterflat_*_norm.fits")),
+                                cfg.get("MASKS", "hot_pixel_sigma", 6.0),
+                                cfg.get("MASKS", "dead_pixel_threshold", 0.5))
+    if mask is None:
+        print("[ERROR]: No master files found to build the bad-pixel mask.")
+        sys.exit(1)
+    write_bad_pixel_mask(mask, mask_file)
+    if args.verbose:
+        print(f"[INFO] Bad-pixel mask saved as '{mask_file}' "
+              f"({np.count_nonzero(mask & HOT)} hot, {np.count_nonzero(mask & DEAD)} dead pixels).")
+    sys.exit(0)
+
+### END
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: master_stats.py
+# Description:
+#   This module keeps compact running statistics of the frames combined into
+#   a master calibration file (count, sum and sum of squares of every pixel
+#   and, optionally, the state of a sigma-clipped mean). The statistics are
+#   stored in a sidecar file next to the master ('masterbias.fits' ->
+#   'masterbias.stats.npz'), so new frames can be folded into an existing
+#   master in O(new frames) instead of recombining the whole set. This is
+#   what makes rolling "super-bias" and "super-dark" masters cheap.
+#
+#   Only mean based methods can be updated incrementally. Median based
+#   methods need all frames and are always recomputed in full.
+#
+#   The clipped-mean state is a running clipped mean: each new frame is
+#   clipped against the mean and standard deviation of the samples accepted
+#   so far. For a full rebuild it is initialised from the sigma-clipping
+#   mask of the whole stack.
+# =============================================================================
+
+import os
+import numpy as np
+from pathlib import Path
+
+
+SIDECAR_SUFFIX = ".stats.npz"
+
+
+# ---------------------------------------------------------------------------
+# Function: sidecar_path
+# Description:
+#   Returns the path of the statistics sidecar for a master file.
+# ---------------------------------------------------------------------------
+def sidecar_path(master_path):
+    master_path = Path(master_path)
+    return master_path.with_name(master_path.stem + SIDECAR_SUFFIX)
+
+
+# ---------------------------------------------------------------------------
+# Class: MasterStatistics
+# Description:
+#   Running per-pixel statistics of the frames combined into a master.
+# ---------------------------------------------------------------------------
+class MasterStatistics:
+    def __init__(self, shape, clip_sigma=None):
+        self.shape = tuple(shape)
+        self.count = 0
+        self.sum = np.zeros(self.shape, dtype=np.float64)
+        self.sumsq = np.zeros(self.shape, dtype=np.float64)
+        self.files = []
+        self.clip_sigma = clip_sigma
+        if clip_sigma is not None:
+            self.clip_sum = np.zeros(self.shape, dtype=np.float64)
+            self.clip_sumsq = np.zeros(self.shape, dtype=np.float64)
+            self.clip_count = np.zeros(self.shape, dtype=np.int32)
+
+    @staticmethod
+    def nbytes(shape, clip_sigma=None):
+        '''Memory held by the statistics of frames of 'shape'.'''
+        return int(np.prod(shape)) * (36 if clip_sigma is not None else 16)
+
+    # -- building -------------------------------------------------------------
+    def add_band(self, rows, band, clipped=False):
+        '''
+        Accumulate a (N, h, W) band of a stack into the rows 'rows'. For the
+        clipped-mean state rejected samples are marked by NaN. The caller
+        sets 'count' and 'files' once the whole stack has been processed.
+        '''
+        band = np.asarray(band, dtype=np.float64)
+        if clipped:
+            accepted = ~np.isnan(band)
+            self.clip_sum[rows] += np.nansum(band, axis=0)
+            self.clip_sumsq[rows] += np.nansum(band * band, axis=0)
+            self.clip_count[rows] += accepted.sum(axis=0, dtype=np.int32)
+        else:
+            self.sum[rows] += band.sum(axis=0)
+            self.sumsq[rows] += (band * band).sum(axis=0)
+
+    def _accumulate(self, frame):
+        frame = np.asarray(frame, dtype=np.float64)
+        self.sum += frame
+        self.sumsq += frame * frame
+
+    def _accumulate_clipped(self, frame, accepted):
+        frame = np.where(accepted, np.asarray(frame, dtype=np.float64), 0.0)
+        self.clip_sum += frame
+        self.clip_sumsq += frame * frame
+        self.clip_count += accepted
+
+    def add_frame(self, frame, name=""):
+        '''Fold one new frame into the statistics.'''
+        if frame.shape != self.shape:
+            raise ValueError(f"Frame shape {frame.shape} does not match statistics shape {self.shape}")
+        if self.clip_sigma is not None:
+            if self.count >= 3:
+                center, spread = self.clipped_mean(), self.clipped_std()
+                accepted = np.abs(frame - center) <= self.clip_sigma * spread
+            else:
+                accepted = np.ones(self.shape, dtype=bool)
+            self._accumulate_clipped(frame, accepted)
+        self._accumulate(frame)
+        self.count += 1
+        self.files.append(str(name))
+
+    def can_update(self, clip_sigma=None):
+        '''True if new frames can be folded in for a master clipped at *clip_sigma* (None: plain mean).'''
+        return clip_sigma is None or (self.clip_sigma is not None and
+                                      np.isclose(float(self.clip_sigma), float(clip_sigma)))
+
+    # -- results ----------------------------------------------------------------
+    def mean(self):
+        return (self.sum / max(self.count, 1)).astype(np.float32)
+
+    def std(self):
+        n = max(self.count, 1)
+        var = self.sumsq / n - (self.sum / n) ** 2
+        return np.sqrt(np.clip(var, 0.0, None)).astype(np.float32)
+
+    def clipped_mean(self):
+        if self.clip_sigma is None:
+            raise ValueError("No clipped-mean state in these statistics.")
+        with np.errstate(divide="ignore", invalid="ignore"):
+            out = np.where(self.clip_count > 0, self.clip_sum / self.clip_count, self.sum / max(self.count, 1))
+        return out.astype(np.float32)
+
+    def clipped_std(self):
+        n = np.maximum(self.clip_count, 1)
+        var = self.clip_sumsq / n - (self.clip_sum / n) ** 2
+        return np.sqrt(np.clip(var, 0.0, None)).astype(np.float32)
+
+    # -- persistence --------------------------------------------------------------
+    def save(self, path):
+        '''Write the sidecar atomically (a crash never leaves a broken file).'''
+        path = Path(path)
+        arrays = {"count": np.int64(self.count), "sum": self.sum, "sumsq": self.sumsq,
+                  "files": np.array(self.files, dtype=str)}
+        if self.clip_sigma is not None:
+            arrays.update(clip_sigma=np.float64(self.clip_sigma), clip_sum=self.clip_sum,
+                          clip_sumsq=self.clip_sumsq, clip_count=self.clip_count)
+        tmp_path = path.with_name(path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            clip_sigma = float(npz["clip_sigma"]) if "clip_sigma" in npz else None
+            stats = cls(npz["sum"].shape, clip_sigma)
+            stats.count = int(npz["count"])
+            stats.sum = npz["sum"]
+            stats.sumsq = npz["sumsq"]
+            stats.files = [str(f) for f in npz["files"]]
+            if clip_sigma is not None:
+                stats.clip_sum = npz["clip_sum"]
+                stats.clip_sumsq = npz["clip_sumsq"]
+                stats.clip_count = npz["clip_count"]
+        return stats
+
+### END
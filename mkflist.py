@@ -2,13 +2,11 @@
 
 import os
 import sys
+import scanner
 
-def list_fits_files(directory, output_file='fits_list.txt'):
-    fits_files = sorted([
-        os.path.join(directory, f)
-        for f in os.listdir(directory)
-        if f.lower().endswith(('.fits', '.fit'))
-    ])
+def list_fits_files(directory, output_file='fits_list.txt', recursive=False):
+    # complete FITS files only (headers sniffed in parallel, see scanner.py)
+    fits_files = [record.path for record in scanner.scan(directory, recursive=recursive)]
 
     if not fits_files:
         print("No FITS files found in the directory.")
@@ -21,13 +19,15 @@ def list_fits_files(directory, output_file='fits_list.txt'):
     print(f"List saved to '{output_file}' with {len(fits_files)} FITS files.")
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python mkflist.py <directory>")
+    recursive = "-r" in sys.argv[1:]
+    arguments = [a for a in sys.argv[1:] if a != "-r"]
+    if len(arguments) != 1:
+        print("Usage: python mkflist.py [-r] <directory>")
         sys.exit(1)
 
-    directory = sys.argv[1]
+    directory = arguments[0]
     if not os.path.isdir(directory):
         print(f"Error: '{directory}' is not a valid directory.")
         sys.exit(1)
 
-    list_fits_files(directory)
+    list_fits_files(directory, recursive=recursive)
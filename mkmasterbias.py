@@ -24,13 +24,22 @@ import os
 import sys
 import numpy as np
 from astropy.io import fits
-from astropy.stats import sigma_clip
-from astropy.visualization import ZScaleInterval
 from pathlib import Path
 ## (old) import getconfig
 import calib_config
+import master_stats
+import detector
+import binning
 import argparse
-import matplotlib.pyplot as plt
+import preview
+import registry
+import streaming
+import budget
+import linearity
+import photon_transfer
+# NEW: the combination itself is done by the library API (calibration.py)
+from calibration import (BIAS_COMBINE_METHODS, INCREMENTAL_BIAS_METHODS, combine_bias_band, bias_cards,
+                         subtract_bias)
 
 
 # ---------------------------------------------------------------------------
@@ -40,10 +49,10 @@ import matplotlib.pyplot as plt
 #   NEW: Reads the expected bias label from config.ini and compares the header's
 #        "IMAGETYP" value to that expected value.
 # ---------------------------------------------------------------------------
-def find_bias_frames(flist):
+def find_bias_frames(flist, cfg):
     # NEW: Read the expected bias type from config.ini (e.g., "BIAS" or user-defined)
     ##working_dir = config.get("HEADER_SPECIFICATION", "working_dir")
-    expected_bias = full_config["HEADER_SPECIFICATION"].get("bias_label", "BIAS").strip().upper()
+    expected_bias = cfg.get("HEADER_SPECIFICATION", "bias_label", "BIAS").strip().upper()
     bias_files = []
     # OLD: for file in flist:  # Search for all FITS files and check header for IMAGETYP
     for file in flist:
@@ -61,14 +70,32 @@ def find_bias_frames(flist):
     return sorted(bias_files)
 
 
+# ---------------------------------------------------------------------------
+# Function: read_bias_frame
+# Description:
+#   Reads a bias frame trimmed to the useful detector area. Without overscan
+#   subtraction the data stay int16, otherwise the overscan-corrected
+#   float32 residual bias is returned. With [LINEARITY] the frame is
+#   corrected for non-linearity like the frames in bias_correction.py.
+# ---------------------------------------------------------------------------
+def read_bias_frame(file, cfg):
+    lin = linearity.linearity_from_config(cfg)
+    with fits.open(file) as hdul:
+        raw, overscan, _ = detector.read_trimmed(hdul[0], cfg)
+        if overscan is None and lin is None:
+            return raw.astype(np.int16)  # Convert to int16
+        return subtract_bias(raw, overscan, 0.0, linearity=lin)
+
+
 # ---------------------------------------------------------------------------
 # Function: create_master_bias
 # Description:
 #   Creates a master bias frame from multiple bias frames.
 #   Combination method (sigma-clipping, etc.) and calibration parameters
-#   are now read from config.ini.
+#   are now read from config.ini (*cfg*); the master is written to
+#   *output* in the working directory.
 # ---------------------------------------------------------------------------
-def create_master_bias(flist):
+def create_master_bias(flist, cfg, output="masterbias.fits", update=False, png=False, verbose=False):
     # (old):
     #if config is None:
     #    print("[ERROR]: Could not load configuration. Exiting.")
@@ -88,34 +115,92 @@ def create_master_bias(flist):
     # ---------------------------------------------------------------------------
     # NEW: Use find_bias_frames with config object to determine bias files.
     # ---------------------------------------------------------------------------
-    bias_files = find_bias_frames(flist)
+    bias_files = find_bias_frames(flist, cfg)
 
     if len(bias_files) == 0:
         print("Error: No bias frames found for creating a master bias frame.")
         sys.exit(1)
     else:
-        if args.verbose:
+        if verbose:
             print(f"[INFO] Found {len(bias_files)} bias frames. Processing...")
 
-    # Read all bias images into a list
-    bias_data = []
-    for file in bias_files:
-        with fits.open(file) as hdul:
-            data = hdul[0].data.astype(np.int16)  # Convert to int16
-            bias_data.append(data)
-
-    # Stack into a 3D numpy array
-    bias_stack = np.array(bias_data)
-
-    # Apply median sigma-clipped combination
-    if method == "MedianSigmaClipped":
-        if args.verbose:
-            print(f"[>>>>] Applying sigma-clipped median with sigma = {sigma}...")
-        clipped_bias = sigma_clip(bias_stack, sigma=sigma, axis=0)
-        master_bias = np.nanmedian(clipped_bias, axis=0)
+    masterbias_path_to_save = working_dir + "/" + output
+    stats_path = master_stats.sidecar_path(masterbias_path_to_save)
+    keep_stats = update or cfg.get("IMAGE_PROCESSING", "keep_master_statistics", False)
+
+    # NEW: read noise from the differences of bias pairs ([PHOTON_TRANSFER]),
+    # measured on the bands of the stack below
+    pair_stats = None
+    previous_header = fits.getheader(masterbias_path_to_save) if update and os.path.exists(masterbias_path_to_save) \
+        else fits.Header()
+
+    # NEW: incremental update - fold only new frames into the running statistics
+    # (the sidecar must hold the clipping state of the configured sigma)
+    stats = master_stats.MasterStatistics.load(stats_path) if update and stats_path.exists() else None
+    clip_sigma = sigma if method.endswith("SigmaClipped") else None
+    if stats is not None and method in INCREMENTAL_BIAS_METHODS and stats.can_update(clip_sigma):
+        new_files = [file for file in bias_files if str(file) not in stats.files]
+        if verbose:
+            print(f"[INFO] Updating master bias from {stats.count} frames with {len(new_files)} new frames...")
+        for file in new_files:
+            stats.add_frame(read_bias_frame(file, cfg), file)
+        master_bias = stats.clipped_mean() if method == "AverageSigmaClipped" else stats.mean()
+        stats.save(stats_path)
+        n_combined = stats.count
     else:
-        print("[ERROR]: Unsupported bias subtraction method.")
-        sys.exit(1)
+        if stats is not None:
+            # median methods (or statistics of another clipping) need every
+            # frame: recompute from all known frames
+            known = stats.files
+            bias_files = sorted(set(bias_files) | {f for f in known if os.path.exists(f)})
+            if verbose:
+                print(f"[INFO] Method {method} (sigma {sigma}) cannot be updated from the saved statistics, "
+                      f"recombining all {len(bias_files)} frames...")
+
+        if method not in BIAS_COMBINE_METHODS:
+            print("[ERROR]: Unsupported bias subtraction method.")
+            sys.exit(1)
+        if verbose:
+            print(f"[>>>>] Applying {BIAS_COMBINE_METHODS[method]}" +
+                  (f" with sigma = {sigma}..." if method.endswith("SigmaClipped") else "..."))
+
+        # NEW: the bias stack is read and combined in bands of rows planned
+        # from [PERFORMANCE] memory_budget (one band without a budget)
+        # NEW: with [LINEARITY] the biases are corrected for non-linearity
+        # like all other frames (float32 stack)
+        with_overscan = detector.frame_sections(fits.getheader(bias_files[0]), cfg)[1] is not None
+        lin = linearity.linearity_from_config(cfg)
+        bias_stack = streaming.StackedBands(bias_files, cfg, np.float32 if with_overscan or lin else np.int16, lin)
+        height, width = bias_stack.shape
+        stats = master_stats.MasterStatistics(bias_stack.shape, clip_sigma) if keep_stats else None
+        fixed = height * width * 4 + (master_stats.MasterStatistics.nbytes(bias_stack.shape, clip_sigma)
+                                      if keep_stats else 0)
+        band_rows = budget.plan_from_config(cfg).tile_rows(len(bias_files), height, width, fixed)
+
+        master_bias = np.empty(bias_stack.shape, dtype=np.float32)
+        pair_stats = photon_transfer.pair_statistics_from_config(cfg, len(bias_files))
+        try:
+            for rows, band in bias_stack.bands(band_rows):
+                if pair_stats is not None:
+                    pair_stats.add_band(band)
+                master_bias[rows], clip_mask = combine_bias_band(band, method, sigma)
+                if stats is not None:
+                    band = band.astype(np.float64)
+                    stats.add_band(rows, band)
+                    if clip_sigma is not None:
+                        band[clip_mask] = np.nan
+                        stats.add_band(rows, band, clipped=True)
+        finally:
+            bias_stack.close()
+
+        n_combined = len(bias_files)
+        if stats is not None:
+            stats.count = n_combined
+            stats.files = [str(f) for f in bias_files]
+            stats.save(stats_path)
+
+    if keep_stats and verbose:
+        print(f"[INFO] Master statistics saved as '{stats_path}'.")
 
     # ---------------------------------------------------------------------------
     # OLD: Create "master_bias" file using hardcoded header keywords.
@@ -132,34 +217,44 @@ def create_master_bias(flist):
     ##hdu.header['COMMENT'] = ('aaa', 'Sample comment')
     ## print(working_dir + masterbias_filename), exit()
     
-    
-    masterbias_path_to_save = working_dir + "/" + masterbias_filename
+    binning.copy_binning(fits.getheader(bias_files[0]), hdu.header)
+    hdu.header.update(bias_cards(method, n_combined))
+    if linearity.linearity_from_config(cfg) is not None:
+        hdu.header[linearity.HEADER_KEYWORD] = linearity.linearity_from_config(cfg).header_card()
+    ron_adu = pair_stats.read_noise() if pair_stats is not None else float("nan")
+    if np.isfinite(ron_adu):
+        hdu.header[photon_transfer.RON_ADU_KEYWORD] = (round(ron_adu, 4), "Read noise from bias pairs (ADU)")
+        hdu.header["RONPAIRS"] = (pair_stats.pairs, "Bias pairs used for the read noise")
+        photon_transfer.store_row(photon_transfer.transfer_row(masterbias_path_to_save, fits.getheader(bias_files[0]),
+                                                               cfg, ron_adu=ron_adu, pairs=pair_stats.pairs), cfg)
+        if verbose:
+            print(f"[INFO] Read noise from {pair_stats.pairs} bias pairs: {ron_adu:.3f} ADU")
+    elif pair_stats is not None:
+        print(f"[WARNING] No read noise measured from the {pair_stats.pairs} bias pairs.")
+    elif photon_transfer.RON_ADU_KEYWORD in previous_header:
+        # incremental update: the frames are not stacked, keep the measurement
+        for keyword in (photon_transfer.RON_ADU_KEYWORD, "RONPAIRS"):
+            if keyword in previous_header:
+                hdu.header[keyword] = (previous_header[keyword], previous_header.comments[keyword])
     hdu.writeto(masterbias_path_to_save, overwrite=True)
 
-    if args.verbose:
+    if verbose:
         print(f"[INFO]: Master bias saved as '{masterbias_path_to_save}' successfully.")
 
-    if args.png:
-        make_png(masterbias_filename)
+    if png or preview.previews_enabled(cfg):
+        make_png(master_bias, output, cfg, verbose)
 
 
 # ---------------------------------------------------------------------------
 # Function: make_png
 # Description:
-#   Creates a PNG image of the master bias file using zscale for display.
+#   Creates a downsampled zscale PNG preview of the master bias straight
+#   from the array in memory (stored in results_aux_dir).
 # ---------------------------------------------------------------------------
-def make_png(ffile):
-    ofile = str(ffile).split("." + str(ffile).split(".")[-1])[0] + ".png"
-    with fits.open(ffile) as hdul:
-        data = hdul[0].data
-    interval = ZScaleInterval()
-    vmin, vmax = interval.get_limits(data)
-    plt.imshow(data, origin='lower', vmin=vmin, vmax=vmax, cmap='gray')
-    plt.colorbar(label='Pixel Value (zscale)')
-    plt.title('MasterBias file')
-    plt.savefig(ofile, dpi=300, bbox_inches='tight')
-    plt.close()
-    if args.verbose:
+def make_png(data, ffile, cfg, verbose=False):
+    ofile = preview.png_name(ffile, cfg.get("DATA_STRUCTURE", "results_aux_dir"))
+    preview.make_preview(data, ofile, preview.preview_size(cfg))
+    if verbose:
         print("[INFO] Created PNG file: ", ofile)
 
 
@@ -194,6 +289,8 @@ if __name__ == "__main__":
     parser.add_argument("-p", "--png", action="store_true",
                         help="Prepare PNG file of created master bias file")
     parser.add_argument("-c", "--config", type=str, help="Specify path to config file")
+    parser.add_argument("-u", "--update", action="store_true",
+                        help="Fold new frames into the existing master using its statistics sidecar")
 
     args = parser.parse_args()
     arg_sigma = args.sigma
@@ -211,25 +308,22 @@ if __name__ == "__main__":
     '''
     from calib_config import CalibConfig
     cfg = CalibConfig(config_file)
-    full_config = cfg.config
-    ## print(full_config), exit()
+    ## print(cfg.config), exit()
 
     ## obs_name = cfg.get("GENERAL", "observatory_name")
     ## gain = cfg.get("DEFAULT_VALUES", "gain")
     ## print(f"Observatory: {obs_name}, Gain: {gain}")
-    working_dir = cfg.get("DATA_STRUCTURE", "working_dir")
-    results_dir = cfg.get("DATA_STRUCTURE", "results_dir")
-    results_aux_dir = cfg.get("DATA_STRUCTURE", "results_aux_dir")
     
     '''
     Applying procedures
     '''
-    masterbias_filename = str(args.output)
     list_of_bias_frames = args.list
-    file_list = get_list_of_files_from_file(list_of_bias_frames)
+    # NEW: with the frame registry the biases of the list are selected without
+    # opening any file; create_master_bias re-checks the image type of each frame
+    frames = registry.registry_from_config(cfg)
+    file_list = registry.stage_inputs(frames, list_of_bias_frames, "file", imagetypes=("BIAS",))
     ## print(file_list), exit()
-    create_master_bias(file_list)
-    ## print(working_dir, results_dir, results_aux_dir, masterbias_filename)
+    create_master_bias(file_list, cfg, str(args.output), args.update, args.png, args.verbose)
 
     sys.exit(0) 
     
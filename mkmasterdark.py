@@ -24,13 +24,18 @@ import os
 import sys
 import numpy as np
 from astropy.io import fits
-from astropy.stats import sigma_clip
-from astropy.visualization import ZScaleInterval
 from pathlib import Path
 ## (old) import getconfig
 import calib_config
+import master_stats
+import binning
 import argparse
-import matplotlib.pyplot as plt
+import preview
+import registry
+import streaming
+import budget
+# NEW: the combination itself is done by the library API (calibration.py)
+from calibration import DARK_COMBINE_METHODS, combine_dark_stack, dark_cards
 
 
 # ---------------------------------------------------------------------------
@@ -39,9 +44,9 @@ import matplotlib.pyplot as plt
 #   OLD: Reads dark frames by checking the FITS header "IMAGETYP" directly.
 #   NEW: Reads the expected dark frame pattern from config.ini and then compares.
 # ---------------------------------------------------------------------------
-def find_dark_frames(paths):
+def find_dark_frames(paths, cfg):
     # NEW: Retrieve the dark frame pattern from config.ini (e.g., "dark")
-    pattern = full_config["HEADER_SPECIFICATION"].get("dark_label", "DARK").strip().upper()
+    pattern = cfg.get("HEADER_SPECIFICATION", "dark_label", "DARK").strip().upper()
     ## print(pattern), exit
     ## print(paths), exit()
     dark_files = []
@@ -62,14 +67,34 @@ def find_dark_frames(paths):
     return sorted(dark_files)
 
 
+# ---------------------------------------------------------------------------
+# Function: read_dark_headers
+# Description:
+#   Exposure times and CCD temperatures of the dark frames (headers only;
+#   the data are read band by band by streaming.StackedBands).
+# ---------------------------------------------------------------------------
+def read_dark_headers(dark_files, exptime_keyword, temperature_keyword):
+    exptimes = []
+    temperatures = []
+    for file in dark_files:
+        header = fits.getheader(file)
+        exptimes.append(float(header[exptime_keyword]))
+        if temperature_keyword in header:
+            temperatures.append(float(header[temperature_keyword]))
+    return exptimes, temperatures
+
+
 # ---------------------------------------------------------------------------
 # Function: make_master_dark
 # Description:
 #   Creates a master dark frame from multiple dark frames.
-#   Reads dark correction settings from config.ini.
+#   Reads dark correction settings from config.ini (*cfg*); with *library*
+#   the master is added to the temperature-indexed dark library.
 # ---------------------------------------------------------------------------
-def make_master_dark(dark_files, output_filename):
+def make_master_dark(dark_files, output_filename, cfg, update=False, library=False, png=False, verbose=False):
     # NEW: Check if dark correction is enabled in config.ini.
+    full_config = cfg.config
+    working_dir = cfg.get("DATA_STRUCTURE", "working_dir")
     dark_correction_enabled = full_config["IMAGE_PROCESSING"]['dark_correction']
     ## print(type(dark_correction_enabled)), exit()
     
@@ -82,53 +107,128 @@ def make_master_dark(dark_files, output_filename):
     method = full_config["IMAGE_PROCESSING"]['dark_correction_method']
     ## print(method), exit()
     
-    # Read all dark frame data.
-    dark_data_arrays = []
-    dark_data_exptimes = []
-    
-    for file in dark_files:
-        with fits.open(file) as hdul:
-            data = hdul[0].data.astype(np.float32)
-            dark_data_arrays.append(data)
-            dark_data_exptimes.append(float(hdul[0].header[exptime_keyword]))
-    ## print(dark_data_arrays, dark_data_exptimes), exit()        
-
-    # Combine dark frames based on the specified method.
-    # (I): scaled exposure method - creating an median/average masterdark file
-    #      which contains a dark signal for a one second exposure
-    if method == "ScaledExposureMedian":
-        print("Applying scaled exposure (median) method for dark combination.")
-        dark_data_out = [arr / val for arr, val in zip(dark_data_arrays, dark_data_exptimes)]
-        master_dark = np.median(dark_data_out, axis=0)
-    elif method == "ScaledExposureAverage":    
-        print("Applying scaled exposure (median) method for dark combination.")
-        dark_data_out = [arr / val for arr, val in zip(dark_data_arrays, dark_data_exptimes)]
-        master_dark = np.average(dark_data_out, axis=0)
-    ## (TO DO): elif method == "EqualExposure":
-    else:
-        # OLD: print("Error: Unsupported dark correction method.")
-        # NEW: Use median as a fallback if unsupported method encountered.
+    temperature_keyword = full_config["HEADER_SPECIFICATION"].get("temperature_keyword", "CCD-TEMP")
+
+    # Unsupported methods fall back to the median of scaled darks.
+    if method not in DARK_COMBINE_METHODS:
         print("Error: Unsupported dark correction method. Using median as fallback.")
+        method = "ScaledExposureMedian"
+    sigma = full_config["IMAGE_PROCESSING"].get("dark_correction_sigma", 3.0)
 
-    ## print(master_dark), exit()
     masterdark_filename = "masterdark.fits"
-    hdu = fits.PrimaryHDU(master_dark.astype(np.float32))
     masterbias_path_to_save = working_dir + "/" + masterdark_filename
+    stats_path = master_stats.sidecar_path(masterbias_path_to_save)
+    keep_stats = update or cfg.get("IMAGE_PROCESSING", "keep_master_statistics", False)
+    combine, clipped = DARK_COMBINE_METHODS[method]
+
+    # NEW: incremental update - fold only new darks into the running statistics
+    # (the sidecar must hold the clipping state of the configured sigma)
+    stats = master_stats.MasterStatistics.load(stats_path) if update and stats_path.exists() else None
+    if stats is not None and combine == "average" and stats.can_update(sigma if clipped else None):
+        new_files = [file for file in dark_files if str(file) not in stats.files]
+        print(f"Updating {method} master dark from {stats.count} frames with {len(new_files)} new frames.")
+        # exposure and temperature of the frames already combined
+        old_header = fits.getheader(masterbias_path_to_save)
+        dark_data_exptimes = [old_header.get("MD_EXPT", 0.0)] * stats.count
+        dark_data_temperatures = ([old_header[temperature_keyword]] * stats.count
+                                  if temperature_keyword in old_header else [])
+        for file in new_files:
+            with fits.open(file) as hdul:
+                header = hdul[0].header
+                exptime = float(header[exptime_keyword])
+                stats.add_frame(hdul[0].data / np.float32(exptime), file)
+                dark_data_exptimes.append(exptime)
+                if temperature_keyword in header:
+                    dark_data_temperatures.append(float(header[temperature_keyword]))
+        master_dark = stats.clipped_mean() if clipped else stats.mean()
+        stats.save(stats_path)
+    else:
+        if stats is not None:
+            # median methods (or statistics of another clipping) need every
+            # frame: recompute from all known frames
+            known = stats.files
+            dark_files = sorted(set(dark_files) | {f for f in known if os.path.exists(f)})
+            print(f"Method {method} (sigma {sigma}) cannot be updated from the saved statistics, "
+                  f"recombining all {len(dark_files)} frames.")
+
+        # NEW: the darks are read into a preallocated stack, already scaled to
+        # a one second exposure, in bands of rows planned from [PERFORMANCE]
+        # memory_budget (one band without a budget)
+        dark_data_exptimes, dark_data_temperatures = read_dark_headers(
+            dark_files, exptime_keyword, temperature_keyword)
+        dark_stack = streaming.StackedBands(dark_files)
+        height, width = dark_stack.shape
+
+        stats = None
+        if keep_stats:
+            stats = master_stats.MasterStatistics(dark_stack.shape, sigma if clipped else None)
+        fixed = height * width * 4 + (master_stats.MasterStatistics.nbytes(dark_stack.shape, stats.clip_sigma)
+                                      if stats is not None else 0)
+        band_rows = budget.plan_from_config(cfg).tile_rows(len(dark_files), height, width, fixed)
+
+        # Combine dark frames based on the specified method.
+        # (I): scaled exposure method - creating an median/average masterdark file
+        #      which contains a dark signal for a one second exposure
+        print(f"Applying {method} method for dark combination.")
+        master_dark = np.empty(dark_stack.shape, dtype=np.float32)
+        try:
+            for rows, band in dark_stack.bands(band_rows, divisors=dark_data_exptimes):
+                master_dark[rows] = combine_dark_stack(band, method, sigma=sigma, stats=stats,
+                                                       first_row=rows.start)
+        finally:
+            dark_stack.close()
+
+        if stats is not None:
+            stats.count = len(dark_files)
+            stats.files = [str(f) for f in dark_files]
+            stats.save(stats_path)
+
+    if keep_stats and verbose:
+        print(f"[INFO] Master statistics saved as '{stats_path}'.")
+
+    ## print(master_dark), exit()
+    hdu = fits.PrimaryHDU(master_dark.astype(np.float32))
 
     ## hdu.header[image_type_keyword] = "" # master_dark_label
-    hdu.header["MD_COMB"] = method  # Record the combination method.
+    binning.copy_binning(fits.getheader(dark_files[0]), hdu.header)
+    hdu.header.update(dark_cards(method, dark_data_exptimes, dark_data_temperatures, temperature_keyword))
 
     hdu.writeto(masterbias_path_to_save, overwrite=True)
     
-    if args.verbose:
+    if verbose:
         print(f"[INFO]: Master bias saved as '{masterbias_path_to_save}' successfully.")
 
-    if args.png:
-        make_png(masterdark_filename)
+    if png or preview.previews_enabled(cfg):
+        make_png(master_dark, masterdark_filename, cfg, verbose)
+
+    # NEW: store the master in the temperature-indexed dark library
+    if library:
+        if not dark_data_temperatures:
+            print(f"[WARNING] No '{temperature_keyword}' keyword in dark frames, master not added to the library.")
+        else:
+            import dark_library
+            dark_lib = dark_library.library_from_config(cfg, verbose=verbose)
+            library_path = dark_lib.add_master(masterbias_path_to_save, hdu.header[temperature_keyword],
+                                              hdu.header["MD_EXPT"], hdu.header["MD_SCALE"], method)
+            if verbose:
+                print(f"[INFO]: Master dark added to the dark library as '{library_path}'.")
     ## exit()
     return masterbias_path_to_save
 
    
+# ---------------------------------------------------------------------------
+# Function: make_png
+# Description:
+#   Creates a downsampled zscale PNG preview of the master dark straight
+#   from the array in memory (stored in results_aux_dir).
+# ---------------------------------------------------------------------------
+def make_png(data, ffile, cfg, verbose=False):
+    ofile = preview.png_name(ffile, cfg.get("DATA_STRUCTURE", "results_aux_dir"))
+    preview.make_preview(data, ofile, preview.preview_size(cfg))
+    if verbose:
+        print("[INFO] Created PNG file: ", ofile)
+
+
 # ---------------------------------------------------------------------------
 # Main block: Parse arguments and call make_master_dark.
 # ---------------------------------------------------------------------------
@@ -151,6 +251,10 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
     parser.add_argument("-p", "--png", action="store_true", help="prepare PNG file of created master dark")
     parser.add_argument("-c", "--config", type=str, help="Specify path to config file")
+    parser.add_argument("-L", "--library", action="store_true",
+                        help="add created master dark to the temperature-indexed dark library")
+    parser.add_argument("-u", "--update", action="store_true",
+                        help="fold new darks into the existing master using its statistics sidecar")
     args = parser.parse_args()
     if args.config:
         config_file = str(args.config).strip() 
@@ -165,10 +269,6 @@ if __name__ == "__main__":
     '''
     from calib_config import CalibConfig
     cfg = CalibConfig(config_file)
-    full_config = cfg.config
-    working_dir = cfg.get("DATA_STRUCTURE", "working_dir")
-    results_dir = cfg.get("DATA_STRUCTURE", "results_dir")
-    results_aux_dir = cfg.get("DATA_STRUCTURE", "results_aux_dir")
     
     '''
     Applying procedures
@@ -176,14 +276,20 @@ if __name__ == "__main__":
     # Load file list from the provided text file.
     with open(args.list, "r") as f:
         file_paths = [line.strip() for line in f if line.strip()]
-        
-    # NEW: Use find_dark_frames to filter dark files from the list.
-    dark_files = find_dark_frames(file_paths)
+
+    # NEW: with the frame registry the bias-corrected darks of the list are
+    # selected directly, no header of any other frame is read
+    dark_files = registry.registry_selection(registry.registry_from_config(cfg), file_paths, "b",
+                                             imagetypes=("DARK",))
+    if dark_files is None:
+        # NEW: Use find_dark_frames to filter dark files from the list.
+        dark_files = find_dark_frames(file_paths, cfg)
     
     if not dark_files:
         print("No dark frames found matching the pattern specified in config.")
     else:
-        master_dark_file = make_master_dark(dark_files, args.output)
+        master_dark_file = make_master_dark(dark_files, args.output, cfg, args.update, args.library, args.png,
+                                            args.verbose)
     ## exit()
         if master_dark_file:
             print(f"Master dark created: '{master_dark_file}'.")
@@ -6,7 +6,17 @@ import numpy as np
 from astropy.io import fits
 from collections import defaultdict
 import calib_config
+import masks
+import binning
+import preview
+import registry
+import site_config
+import streaming
+import budget
+import photon_transfer
 import shutil
+# NEW: the combination itself is done by the library API (calibration.py)
+from calibration import combine_flat_band, flat_level
 
 def read_filenames(input_arg):
     if input_arg.endswith('.lst'):
@@ -16,73 +26,103 @@ def read_filenames(input_arg):
         files = input_arg.split()
     return files
 
-def get_filter_from_header(header):
-    filt = header.get('FILTER', '').strip()
-    ## print(filt)
-    return filt if filt in ['U', 'B', 'V', 'R', 'I', 'Haw', 'Han', 'None', "-"] else 'UNKNOWN'
+def get_filter_from_header(header, cfg):
+    # NEW: filter names and aliases of the config (site_config.py)
+    return site_config.from_calib_config(cfg).filter_of(header)
+
+# NEW: mean levels of the flats from every *step*-th row only, for stacks
+# combined in several bands (only about one band of rows of every flat is read)
+def sampled_levels(file_list, step):
+    levels = []
+    for filename in file_list:
+        with fits.open(filename) as hdul:
+            levels.append(flat_level(hdul[0].section[::step, :]))
+    return levels
 
 def normalize_flat(data):
     avg = np.mean(data)
     return data / avg if avg != 0 else data
 
-def process_flats(file_list):
-    all_filter_entries = []
+# NEW: gain and read noise (e-) of the flat pairs of one filter, with the
+# read noise (ADU) of the master bias, into the master flat headers and the
+# quality database
+def transfer_cards(pair_stats, flat_header, filt_name, master_path, cfg, headers):
+    working_dir = cfg.get("DATA_STRUCTURE", "working_dir")
+    ron_adu, measured = photon_transfer.bias_read_noise(working_dir + "/masterbias.fits", cfg)
+    gain = pair_stats.gain(ron_adu)
+    if not np.isfinite(gain):
+        print(f"[WARNING] No gain measured from the {filt_name} flat pairs.")
+        return
+    ron = gain * ron_adu if measured else None
+    for header in headers:
+        header[cfg.get("HEADER_SPECIFICATION", "gain_keyword", "GAIN")] = (round(gain, 4),
+                                                                         "Gain from flat pairs (e-/ADU)")
+        if ron is not None:
+            header[cfg.get("HEADER_SPECIFICATION", "ron_keyword", "RDNOISE")] = (round(ron, 4),
+                                                                               "Read noise from bias pairs (e-)")
+        header["PTCLEVEL"] = (round(pair_stats.level(), 1), "Mean level of the flat pairs (ADU)")
+        header["PTCPAIRS"] = (pair_stats.pairs, "Flat pairs used for the gain")
+    for warning in photon_transfer.check_header(flat_header, cfg, gain, ron):
+        print(f"[WARNING] {filt_name} flats: {warning}")
+    photon_transfer.store_row(photon_transfer.transfer_row(master_path, flat_header, cfg, filt_name,
+                                                           pair_stats.level(), gain,
+                                                           ron_adu if measured else None, pair_stats.pairs), cfg)
+
+def process_flats(file_list, cfg):
+    working_dir = cfg.get("DATA_STRUCTURE", "working_dir")
+    results_aux_dir = cfg.get("DATA_STRUCTURE", "results_aux_dir")
     filter_groups = defaultdict(list)
     shape_by_filter = {}
 
+    # NEW: only the headers are read here; the flats of each filter are
+    # combined band by band below, in bands of rows planned from
+    # [PERFORMANCE] memory_budget (one band without a budget)
     for filename in file_list:
-        with fits.open(filename) as hdul:
-            header = hdul[0].header
-            data = hdul[0].data.astype(np.float32)
-            imagetyp = header.get("IMAGETYP", "").strip().upper()
-            if imagetyp != "FLAT":
-                continue
-            ## print(filt)
-            ## continue            
-            filt = get_filter_from_header(header)
-            all_filter_entries.append(filt)
-            if filt == 'UNKNOWN':
-                print(f"Skipping {filename}: unknown or unsupported filter.")
-                continue
-
-            if filt not in shape_by_filter:
-                shape_by_filter[filt] = data.shape
-            elif data.shape != shape_by_filter[filt]:
-                print(f"Skipping {filename}: shape {data.shape} does not match expected \
-                        {shape_by_filter[filt]} for filter {filt}")
-                continue
-            filter_groups[filt].append((data, header, filename))
+        header = fits.getheader(filename)
+        imagetyp = site_config.from_calib_config(cfg).image_type_of(header)
+        if imagetyp != "FLAT":
+            continue
+        filt = get_filter_from_header(header, cfg)
+        if filt == 'UNKNOWN':
+            print(f"Skipping {filename}: unknown or unsupported filter.")
+            continue
+
+        shape = (header.get("NAXIS2"), header.get("NAXIS1"))
+        if filt not in shape_by_filter:
+            shape_by_filter[filt] = shape
+        elif shape != shape_by_filter[filt]:
+            print(f"Skipping {filename}: shape {shape} does not match expected \
+                    {shape_by_filter[filt]} for filter {filt}")
+            continue
+        filter_groups[filt].append(filename)
 
     all_output_paths = []
-    all_filters = set(all_filter_entries)
-    ## print(all_filters), exit()
-    ## print(filter_groups["B"])
-    ## exit()
-    
-    for filt_name in all_filters:
-        ## print(filt_name)
-        data_all = []
-        data_all_norm = []
-    
-        for filename in file_list:
-            with fits.open(filename) as hdul:
-                header = hdul[0].header
-                imagetyp = header.get("IMAGETYP", "").strip().upper()
-                if imagetyp == "FLAT":
-                    filt = get_filter_from_header(header)
-                    if filt == filt_name:
-                        ## print(filename)
-                        data = hdul[0].data.astype(np.float32)
-                        data_all.append(data)
-                        data_all_norm.append(data / np.average(data))
-                        ## print(data)
-                        ## print(data / np.average(data))
-                        ## exit()
-        
-        median_flat = np.median(data_all, axis=0)
-        median_normflat = np.median(data_all_norm, axis=0)
-        ## print(median_flat)
-        ## print(median_normflat)
+    plan = budget.plan_from_config(cfg)
+
+    for filt_name, flat_files in sorted(filter_groups.items()):
+        flat_stack = streaming.StackedBands(flat_files)
+        height, width = flat_stack.shape
+        band_rows = plan.tile_rows(len(flat_files), height, width, fixed=2 * height * width * 4)
+        median_flat = np.empty(flat_stack.shape, dtype=np.float32)
+        median_normflat = np.empty(flat_stack.shape, dtype=np.float32)
+        # mean level of every flat for the normalized master: from the stack
+        # itself when it is read in one band, otherwise from a row sample
+        levels = sampled_levels(flat_files, -(-height // band_rows)) if band_rows < height else None
+        pair_stats = None
+        try:
+            for rows, band in flat_stack.bands(band_rows):
+                if levels is None:
+                    levels = [flat_level(frame) for frame in band]
+                # NEW: gain from the differences of flat pairs of similar level
+                # ([PHOTON_TRANSFER]), measured on the bands of the stack
+                if rows.start == 0:
+                    pair_stats = photon_transfer.pair_statistics_from_config(cfg, len(flat_files), levels)
+                if pair_stats is not None:
+                    pair_stats.add_band(band)
+                median_flat[rows], median_normflat[rows] = combine_flat_band(band, levels)
+        finally:
+            flat_stack.close()
+        flat_binning_header = fits.getheader(flat_files[0])
         
         flat_path_to_save = working_dir + "/" + "masterflat_" + filt_name + ".fits"
         normflat_path_to_save = working_dir + "/" + "masterflat_" + filt_name + "_norm.fits"
@@ -92,6 +132,11 @@ def process_flats(file_list):
         
         hdu = fits.PrimaryHDU(median_flat.astype(np.float32))
         hdun = fits.PrimaryHDU(median_normflat.astype(np.float32))
+        binning.copy_binning(flat_binning_header, hdu.header)
+        binning.copy_binning(flat_binning_header, hdun.header)
+        if pair_stats is not None:
+            transfer_cards(pair_stats, flat_binning_header, filt_name, flat_path_to_save, cfg,
+                           (hdu.header, hdun.header))
         
         hdu.writeto(flat_path_to_save, overwrite=True)
         hdun.writeto(normflat_path_to_save, overwrite=True)
@@ -99,7 +144,23 @@ def process_flats(file_list):
         # copy flats to results aux as well to keep it there
         shutil.copy(flat_path_to_save, flat_path_to_store)
         shutil.copy(normflat_path_to_save, normflat_path_to_store)
-        
+        all_output_paths.append(normflat_path_to_save)
+
+        if preview.previews_enabled(cfg):
+            preview.make_preview(median_normflat, preview.png_name(normflat_path_to_store, results_aux_dir),
+                                 preview.preview_size(cfg))
+
+    # NEW: static bad-pixel mask from the master dark and normalized flats
+    if cfg.get("MASKS", "use_masks", False):
+        mask_name = cfg.get("MASKS", "bad_pixel_mask_file", "badpixmask.fits")
+        mask = masks.build_bad_pixel_mask(working_dir + "/masterdark.fits", all_output_paths,
+                                          cfg.get("MASKS", "hot_pixel_sigma", 6.0),
+                                          cfg.get("MASKS", "dead_pixel_threshold", 0.5))
+        if mask is not None:
+            masks.write_bad_pixel_mask(mask, working_dir + "/" + mask_name,
+                                       fits.getheader(all_output_paths[0]) if all_output_paths else None)
+            shutil.copy(working_dir + "/" + mask_name, results_aux_dir + "/" + mask_name)
+
     ## if args.verbose:
     ##    print(f"[INFO]: Master bias saved as '{masterbias_path_to_save}' successfully.")
         
@@ -114,12 +175,7 @@ if __name__ == "__main__":
     '''
     from calib_config import CalibConfig
     cfg = CalibConfig(config_file)
-    full_config = cfg.config
-    ## print(full_config), exit()
-
-    working_dir = cfg.get("DATA_STRUCTURE", "working_dir")
-    results_dir = cfg.get("DATA_STRUCTURE", "results_dir")
-    results_aux_dir = cfg.get("DATA_STRUCTURE", "results_aux_dir")
+    ## print(cfg.config), exit()
     
     '''
     Applying procedures
@@ -129,9 +185,14 @@ if __name__ == "__main__":
         input_files = read_filenames(sys.argv[2])
     else:
         input_files = sys.argv[2:] 
+    # NEW: dark-corrected flats of the list selected from the frame registry if enabled
+    selected = registry.registry_selection(registry.registry_from_config(cfg), input_files, "bd",
+                                           imagetypes=("FLAT",))
+    if selected is not None:
+        input_files = selected
     ## print(input_files), exit()
     
-    process_flats(input_files)
+    process_flats(input_files, cfg)
     sys.exit(0)
     
 ### END
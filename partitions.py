@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: partitions.py
+# Description:
+#   Camera-mode partitioning of a night.
+#   Frames taken in different camera modes (instrument, binning, readout
+#   speed, gain mode, geometry) need their own master bias, dark and flats.
+#   The camera mode of every frame is stored in the frame registry; calib.py
+#   splits a night with several modes into partitions and calibrates each
+#   partition as a run of its own:
+#   - a derived config file per partition with its own working, results
+#     and registry paths (work/<mode>/, results/<mode>/),
+#   - a list file of the frames of the partition,
+#   - the partitions run concurrently, sharing the workers and the memory
+#     budget of the run.
+#   Frames of a mode without bias, dark or flat frames of its own (e.g.
+#   binned science frames with unbinned calibrations) are calibrated
+#   together with the largest complete partition, with masters binned on
+#   the fly as before.
+#   Settings: [CAMERA_MODES] partition_by_mode, mode_keywords.
+# =============================================================================
+
+import re
+import sys
+import argparse
+import configparser
+from collections import defaultdict
+from pathlib import Path
+from astropy.io import fits
+
+
+DEFAULT_MODE_KEYWORDS = ["INSTRUME", "XBINNING", "YBINNING", "READOUTM", "GAINMODE"]
+
+
+def mode_keywords(cfg=None):
+    keywords = cfg.get("CAMERA_MODES", "mode_keywords", DEFAULT_MODE_KEYWORDS) if cfg is not None else None
+    if keywords is None:
+        return DEFAULT_MODE_KEYWORDS
+    return [keywords] if isinstance(keywords, str) else list(keywords)
+
+
+def partitioning_enabled(cfg):
+    return bool(cfg.get("CAMERA_MODES", "partition_by_mode", False))
+
+
+# ---------------------------------------------------------------------------
+# Function: camera_mode
+# Description:
+#   Name of the camera mode of a frame: the values of the mode keywords
+#   present in the header and the geometry NAXIS1xNAXIS2, usable as a
+#   directory name (e.g. 'C4-16000_2_2_130x100').
+# ---------------------------------------------------------------------------
+def camera_mode(header, cfg=None):
+    values = [str(header[keyword]).strip() for keyword in mode_keywords(cfg) if keyword in header]
+    values.append(f"{header.get('NAXIS1', 0)}x{header.get('NAXIS2', 0)}")
+    return "_".join(re.sub(r"[^A-Za-z0-9.+-]+", "-", value) for value in values if value)
+
+
+# ---------------------------------------------------------------------------
+# Function: partition_frames
+# Description:
+#   Files of every camera mode ({mode: [files]}) from registry rows. A mode
+#   is a partition of its own only if it can make all of its masters: bias,
+#   dark and a flat of every filter of its science frames. Other modes are
+#   merged into the largest complete mode (all frames stay in one partition
+#   if no mode is complete).
+# ---------------------------------------------------------------------------
+def partition_frames(rows):
+    files = defaultdict(list)
+    has, needs = defaultdict(set), defaultdict(lambda: {"BIAS", "DARK"})
+    for row in rows:
+        mode = row.get("mode") or "-"
+        files[mode].append(row["file"])
+        if row["imagetyp"] in ("BIAS", "DARK"):
+            has[mode].add(row["imagetyp"])
+        elif row["imagetyp"] == "FLAT":
+            has[mode].add("FLAT:" + (row["filter"] or ""))
+        elif row["imagetyp"] == "OBJECT":
+            needs[mode].add("FLAT:" + (row["filter"] or ""))
+    complete = {mode for mode in files if needs[mode] <= has[mode]}
+    if not complete:
+        return {"all": [file for mode in sorted(files) for file in files[mode]]}
+    largest = max(sorted(complete), key=lambda mode: len(files[mode]))
+    partitions = {mode: list(files[mode]) for mode in sorted(complete)}
+    for mode in sorted(set(files) - complete):
+        partitions[largest] += files[mode]
+    return partitions
+
+
+# ---------------------------------------------------------------------------
+# Function: write_partition_config
+# Description:
+#   Writes a copy of *config_file* with the working, results and registry
+#   paths of partition *mode* to *path*. Returns the derived paths. With
+#   *split_modes* the partition may be split by camera mode again (a
+#   partition by observatory config).
+# ---------------------------------------------------------------------------
+def write_partition_config(config_file, cfg, mode, path, split_modes=False):
+    parser = configparser.ConfigParser()
+    parser.optionxform = str  # preserve case sensitivity of keys
+    parser.read(config_file)
+    working_dir = Path(cfg.get("DATA_STRUCTURE", "working_dir", "./work")) / mode
+    results_dir = Path(cfg.get("DATA_STRUCTURE", "results_dir", "./results")) / mode
+    paths = {
+        "working_dir": str(working_dir),
+        "results_dir": str(results_dir),
+        "results_aux_dir": str(results_dir / "aux"),
+        "frame_registry": str(working_dir / "frames.db"),
+    }
+    if not parser.has_section("DATA_STRUCTURE"):
+        parser.add_section("DATA_STRUCTURE")
+    for key, value in paths.items():
+        parser.set("DATA_STRUCTURE", key, value)
+        if key != "frame_registry":
+            Path(value).mkdir(parents=True, exist_ok=True)
+    # a camera-mode partition must not split again
+    if not split_modes:
+        if not parser.has_section("CAMERA_MODES"):
+            parser.add_section("CAMERA_MODES")
+        parser.set("CAMERA_MODES", "partition_by_mode", "False")
+    with open(path, "w", encoding="utf-8") as f:
+        parser.write(f)
+    return paths
+
+
+# ---------------------------------------------------------------------------
+# Main block: show the camera modes of a set of frames.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the camera modes of FITS frames.")
+    parser.add_argument("files", nargs="+", help="FITS files")
+    parser.add_argument("-c", "--config", type=str, help="Specify path to config file")
+    args = parser.parse_args()
+
+    cfg = None
+    if args.config:
+        from calib_config import CalibConfig
+        cfg = CalibConfig(args.config)
+    modes = defaultdict(int)
+    for file in args.files:
+        try:
+            modes[camera_mode(fits.getheader(file), cfg)] += 1
+        except Exception as e:
+            print(f"Skipping {file}: {e}")
+    for mode, count in sorted(modes.items()):
+        print(f"{count:6d}  {mode}")
+    sys.exit(0)
+
+### END
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: photon_transfer.py
+# Description:
+#   Gain and read noise of the detector from the bias and flat frames of
+#   the night (photon transfer, [PHOTON_TRANSFER] in config.ini):
+#   - read noise (ADU): variance of the difference of two biases,
+#       ron^2 = var(B1 - B2) / 2,
+#   - gain (e-/ADU): from two flats of levels S1, S2 (bias subtracted),
+#     the second scaled to the first (r = S1 / S2),
+#       gain = S1 * (1 + r) / (var(F1 - r * F2) - (1 + r^2) * ron^2),
+#   - read noise (e-) = gain * ron.
+#   The statistics are computed on tiles of the difference images, every
+#   *subsample*-th pixel only, all pairs and tiles at once; the result is
+#   the median over tiles, so stars, cosmic rays, defects and gradients of
+#   the illumination only affect single tiles. The master stages feed the
+#   bands of their stacks (already in memory) to PairStatistics, so no
+#   frame is read twice. Results are written to the master headers and to
+#   the quality database, and compared with the GAIN / RDNOISE keywords of
+#   the frames (or [DEFAULT_VALUES] gain / ron).
+# =============================================================================
+
+import sys
+import argparse
+import numpy as np
+from astropy.io import fits
+import quality
+
+
+DEFAULT_TILE = 64
+DEFAULT_SUBSAMPLE = 2
+DEFAULT_TOLERANCE = 0.2
+# flats above this fraction of the saturation level are not paired
+MAX_LEVEL_FRACTION = 0.7
+RON_ADU_KEYWORD = "RONADU"
+
+
+# ---------------------------------------------------------------------------
+# Function: subsampled_tiles
+# Description:
+#   Every *step*-th pixel of an (N, rows, W) stack band as (N, tiles,
+#   pixels) float64 tiles of tile x tile frame pixels (band rows / frame
+#   width if smaller). Only the subsample is copied.
+# ---------------------------------------------------------------------------
+def subsampled_tiles(band, tile=DEFAULT_TILE, step=DEFAULT_SUBSAMPLE):
+    sub = band[:, ::step, ::step]
+    size = max(1, tile // step)
+    tile_rows, tile_cols = min(size, sub.shape[1]), min(size, sub.shape[2])
+    ny, nx = sub.shape[1] // tile_rows, sub.shape[2] // tile_cols
+    sub = sub[:, :ny * tile_rows, :nx * tile_cols].reshape(len(band), ny, tile_rows, nx, tile_cols)
+    return sub.transpose(0, 1, 3, 2, 4).reshape(len(band), ny * nx, tile_rows * tile_cols).astype(np.float64)
+
+
+# ---------------------------------------------------------------------------
+# Function: level_pairs
+# Description:
+#   Pairs of frames of similar level: the frames sorted by *levels* and
+#   paired with their neighbour; frames above *max_level* are left out.
+#   Without levels the frames are paired in order.
+# ---------------------------------------------------------------------------
+def level_pairs(count, levels=None, max_level=None):
+    order = list(range(count))
+    if levels is not None:
+        order = [i for i in np.argsort(levels) if max_level is None or levels[i] <= max_level]
+    return [(int(order[i]), int(order[i + 1])) for i in range(0, len(order) - 1, 2)]
+
+
+# ---------------------------------------------------------------------------
+# Class: PairStatistics
+# Description:
+#   Tile statistics of the difference images of frame *pairs* (indices
+#   into the stack), collected band by band with add_band(). With
+#   *scaled* (flats) the second frame of a pair is scaled to the level of
+#   the first in every tile.
+# ---------------------------------------------------------------------------
+class PairStatistics:
+    def __init__(self, pairs, scaled=False, tile=DEFAULT_TILE, step=DEFAULT_SUBSAMPLE):
+        self.first = np.array([a for a, _ in pairs], dtype=np.intp)
+        self.second = np.array([b for _, b in pairs], dtype=np.intp)
+        self.scaled = scaled
+        self.tile = int(tile)
+        self.step = int(step)
+        self._means, self._ratios, self._variances = [], [], []
+
+    @property
+    def pairs(self):
+        return len(self.first)
+
+    def add_band(self, band):
+        if not self.pairs:
+            return
+        tiles = subsampled_tiles(band, self.tile, self.step)
+        if tiles.shape[-1] < 2:
+            return
+        first, second = tiles[self.first], tiles[self.second]
+        means = first.mean(axis=-1)
+        ratios = means / second.mean(axis=-1) if self.scaled else np.ones_like(means)
+        self._means.append(means.ravel())
+        self._ratios.append(ratios.ravel())
+        self._variances.append((first - ratios[..., None] * second).var(axis=-1, ddof=1).ravel())
+
+    def _collected(self):
+        if not self._variances:
+            return np.empty(0), np.empty(0), np.empty(0)
+        return (np.concatenate(self._means), np.concatenate(self._ratios), np.concatenate(self._variances))
+
+    def level(self):
+        means = self._collected()[0]
+        return float(np.median(means)) if means.size else float("nan")
+
+    def read_noise(self):
+        '''Read noise (ADU) of bias pairs.'''
+        variances = self._collected()[2]
+        variances = variances[np.isfinite(variances)]
+        return float(np.sqrt(np.median(variances) / 2.0)) if variances.size else float("nan")
+
+    def gain(self, ron_adu=0.0):
+        '''Gain (e-/ADU) of flat pairs, with the read noise *ron_adu* (ADU) of the frames.'''
+        means, ratios, variances = self._collected()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            gains = means * (1.0 + ratios) / (variances - (1.0 + ratios ** 2) * ron_adu ** 2)
+        gains = gains[np.isfinite(gains) & (gains > 0)]
+        return float(np.median(gains)) if gains.size else float("nan")
+
+
+# ---------------------------------------------------------------------------
+# Function: pair_statistics_from_config
+# Description:
+#   PairStatistics with the tiling of [PHOTON_TRANSFER], or None if the
+#   measurement is disabled or there is no pair.
+# ---------------------------------------------------------------------------
+def pair_statistics_from_config(cfg, count, levels=None):
+    if not cfg.get("PHOTON_TRANSFER", "photon_transfer", False):
+        return None
+    max_level = None
+    if levels is not None:
+        max_level = MAX_LEVEL_FRACTION * float(cfg.get("DEFAULT_VALUES", "saturate", 65535))
+    pairs = level_pairs(count, levels, max_level)
+    if not pairs:
+        return None
+    return PairStatistics(pairs, scaled=levels is not None,
+                          tile=cfg.get("PHOTON_TRANSFER", "tile_size", DEFAULT_TILE),
+                          step=cfg.get("PHOTON_TRANSFER", "subsample", DEFAULT_SUBSAMPLE))
+
+
+# ---------------------------------------------------------------------------
+# Function: bias_read_noise
+# Description:
+#   Read noise (ADU) stored in the master bias by mkmasterbias.py, or
+#   [DEFAULT_VALUES] ron / gain if it was not measured.
+# ---------------------------------------------------------------------------
+def bias_read_noise(masterbias_path, cfg):
+    try:
+        value = fits.getheader(masterbias_path).get(RON_ADU_KEYWORD)
+    except OSError:
+        value = None
+    if value is not None and np.isfinite(value):
+        return float(value), True
+    return float(cfg.get("DEFAULT_VALUES", "ron", 2.0)) / float(cfg.get("DEFAULT_VALUES", "gain", 1.0)), False
+
+
+# ---------------------------------------------------------------------------
+# Function: check_header
+# Description:
+#   Warnings for the GAIN / RDNOISE keywords of *header* (or the
+#   [DEFAULT_VALUES] if missing) that differ from the measured values by
+#   more than [PHOTON_TRANSFER] tolerance.
+# ---------------------------------------------------------------------------
+def check_header(header, cfg, gain=None, ron=None):
+    tolerance = float(cfg.get("PHOTON_TRANSFER", "tolerance", DEFAULT_TOLERANCE))
+    warnings = []
+    for name, measured, keyword, default in (
+            ("gain", gain, cfg.get("HEADER_SPECIFICATION", "gain_keyword", "GAIN"), "gain"),
+            ("read noise", ron, cfg.get("HEADER_SPECIFICATION", "ron_keyword", "RDNOISE"), "ron")):
+        if measured is None or not np.isfinite(measured):
+            continue
+        expected, source = header.get(keyword), f"header {keyword}"
+        if expected is None:
+            expected, source = cfg.get("DEFAULT_VALUES", default, None), f"[DEFAULT_VALUES] {default}"
+        try:
+            expected = float(expected)
+        except (TypeError, ValueError):
+            continue
+        if expected > 0 and abs(measured / expected - 1.0) > tolerance:
+            warnings.append(f"measured {name} {measured:.3f} differs from {source} = {expected:g}")
+    return warnings
+
+
+# ---------------------------------------------------------------------------
+# Function: transfer_row
+# Description:
+#   One row of the photon transfer table of the quality database.
+# ---------------------------------------------------------------------------
+def transfer_row(master, header, cfg, filt="", level=None, gain=None, ron_adu=None, pairs=0):
+    date_keyword = cfg.get("HEADER_SPECIFICATION", "date_and_time_keyword", "DATE-OBS")
+    date_obs = str(header.get(date_keyword, ""))
+    return {
+        "master": str(master),
+        "filter": filt,
+        "date_obs": date_obs,
+        "night": quality.observing_night(date_obs, cfg),
+        "level": level,
+        "gain": gain,
+        "ron_adu": ron_adu,
+        "ron": gain * ron_adu if gain is not None and ron_adu is not None else None,
+        "pairs": pairs,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Function: store_row
+# Description:
+#   Writes a transfer_row to the quality database (if enabled).
+# ---------------------------------------------------------------------------
+def store_row(row, cfg):
+    db = quality.quality_db_from_config(cfg)
+    if db is not None:
+        db.add_transfer(row)
+        db.flush()
+
+
+# ---------------------------------------------------------------------------
+# Main block: print the measurements of the masters of a config.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the gain and read noise measured by the master stages.")
+    parser.add_argument("-c", "--config", type=str, default="config.ini", help="Specify path to config file")
+    parser.add_argument("-n", "--night", type=str, help="observing night (YYYY-MM-DD)")
+    args = parser.parse_args()
+
+    from calib_config import CalibConfig
+    cfg = CalibConfig(args.config)
+    db = quality.quality_db_from_config(cfg)
+    if db is None:
+        print("[ERROR]: Quality database is disabled in config.")
+        sys.exit(1)
+    rows = db.query_transfer("night = ?" if args.night else "", (args.night,) if args.night else ())
+    if not rows:
+        print("No photon transfer measurements found.")
+        sys.exit(0)
+    print(f"{'night':>10s} {'filter':>8s} {'level':>9s} {'gain':>7s} {'ron_adu':>8s} {'ron':>7s} {'pairs':>5s}  master")
+    for row in rows:
+        print(" ".join(f"{row[name]:>{width}.4g}" if isinstance(row[name], float) else f"{str(row[name] or ''):>{width}s}"
+                       for name, width in (("night", 10), ("filter", 8), ("level", 9), ("gain", 7),
+                                           ("ron_adu", 8), ("ron", 7), ("pairs", 5))), "", row["master"])
+    sys.exit(0)
+
+### END
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: preview.py
+# Description:
+#   Fast quick-look PNG previews of masters and calibrated frames.
+#   - the frame is block-averaged to screen resolution first,
+#   - zscale limits are computed on a sample of the pixels,
+#   - the 8-bit grayscale PNG is written directly (zlib), no matplotlib
+#     figure is created,
+#   - previews can be written straight from arrays already in memory during
+#     calibration, or for a whole batch of files in parallel.
+#   Image orientation follows the usual astronomical display (origin at the
+#   lower left corner).
+# =============================================================================
+
+import sys
+import zlib
+import struct
+import argparse
+import numpy as np
+from astropy.io import fits
+from astropy.visualization import ZScaleInterval
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import binning
+
+
+DEFAULT_SIZE = 1024
+ZSCALE_SAMPLES = 20000
+
+
+# ---------------------------------------------------------------------------
+# Function: downsample
+# Description:
+#   Block-averages *data* so that its longer side is at most *max_size*.
+# ---------------------------------------------------------------------------
+def downsample(data, max_size=DEFAULT_SIZE):
+    factor = int(np.ceil(max(data.shape) / float(max_size)))
+    if factor <= 1:
+        return np.asarray(data, dtype=np.float32)
+    return binning.bin_array(data, factor, factor, "mean")
+
+
+# ---------------------------------------------------------------------------
+# Function: zscale_limits
+# Description:
+#   zscale display limits computed on an evenly strided pixel sample.
+# ---------------------------------------------------------------------------
+def zscale_limits(data, n_samples=ZSCALE_SAMPLES):
+    flat = data.ravel()
+    sample = flat[::max(1, flat.size // n_samples)]
+    sample = sample[np.isfinite(sample)]
+    if sample.size == 0:
+        return 0.0, 1.0
+    return ZScaleInterval(n_samples=n_samples).get_limits(sample)
+
+
+# ---------------------------------------------------------------------------
+# Function: to_uint8
+# Description:
+#   Scales *data* linearly between *vmin* and *vmax* into 0..255.
+# ---------------------------------------------------------------------------
+def to_uint8(data, vmin, vmax):
+    scale = 255.0 / (vmax - vmin) if vmax > vmin else 0.0
+    image = (np.nan_to_num(data, nan=vmin) - vmin) * scale
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+# ---------------------------------------------------------------------------
+# Function: write_png
+# Description:
+#   Writes an 8-bit grayscale image as PNG (rows flipped, origin lower).
+# ---------------------------------------------------------------------------
+def write_png(path, image):
+    height, width = image.shape
+    scanlines = np.zeros((height, width + 1), dtype=np.uint8)  # filter byte 0
+    scanlines[:, 1:] = image[::-1]
+
+    def chunk(tag, payload):
+        return (struct.pack(">I", len(payload)) + tag + payload +
+                struct.pack(">I", zlib.crc32(tag + payload) & 0xFFFFFFFF))
+
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(scanlines.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+    return str(path)
+
+
+# ---------------------------------------------------------------------------
+# Function: make_preview
+# Description:
+#   Writes a PNG preview of an array already in memory.
+# ---------------------------------------------------------------------------
+def make_preview(data, png_path, max_size=DEFAULT_SIZE):
+    small = downsample(data, max_size)
+    vmin, vmax = zscale_limits(small)
+    return write_png(png_path, to_uint8(small, vmin, vmax))
+
+
+# ---------------------------------------------------------------------------
+# Function: png_name
+# Description:
+#   PNG file name for a FITS file, placed in *output_dir* if given.
+# ---------------------------------------------------------------------------
+def png_name(fits_path, output_dir=None):
+    fits_path = Path(fits_path)
+    directory = Path(output_dir) if output_dir else fits_path.parent
+    return directory / (fits_path.stem + ".png")
+
+
+# ---------------------------------------------------------------------------
+# Function: preview_file
+# Description:
+#   Writes a PNG preview of the primary HDU of a FITS file.
+# ---------------------------------------------------------------------------
+def preview_file(fits_path, output_dir=None, max_size=DEFAULT_SIZE):
+    with fits.open(fits_path) as hdul:
+        return make_preview(hdul[0].data, png_name(fits_path, output_dir), max_size)
+
+
+# ---------------------------------------------------------------------------
+# Function: batch_previews
+# Description:
+#   Previews of many files in parallel worker processes.
+# ---------------------------------------------------------------------------
+def batch_previews(files, output_dir=None, max_size=DEFAULT_SIZE, workers=None, verbose=False):
+    if output_dir:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+    done = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(preview_file, f, output_dir, max_size) for f in files]
+        for file, job in zip(files, jobs):
+            try:
+                done.append(job.result())
+                if verbose:
+                    print(f"[INFO] Created PNG file: {done[-1]}")
+            except Exception as e:
+                print(f"Skipping {file}: {e}")
+    return done
+
+
+# ---------------------------------------------------------------------------
+# Function: previews_enabled / preview_size
+# Description:
+#   [PREVIEW] settings of config.ini.
+# ---------------------------------------------------------------------------
+def previews_enabled(cfg):
+    return bool(cfg.get("PREVIEW", "make_previews", False))
+
+
+def preview_size(cfg):
+    return int(cfg.get("PREVIEW", "preview_size", DEFAULT_SIZE))
+
+
+# ---------------------------------------------------------------------------
+# Main block: previews for given files, list files or directories.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Create quick-look PNG previews of FITS files.")
+    parser.add_argument("inputs", nargs="+", help="FITS files, list files (.lst/.txt) or directories")
+    parser.add_argument("-o", "--output", type=str, help="output directory (default: next to the FITS files)")
+    parser.add_argument("-s", "--size", type=int, default=DEFAULT_SIZE, help="maximum preview size in pixels")
+    parser.add_argument("-j", "--jobs", type=int, help="number of parallel workers (default: all CPUs)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
+    args = parser.parse_args()
+
+    files = binning.collect_input_files(args.inputs)
+    if not files:
+        print("No FITS files found.")
+        sys.exit(1)
+    batch_previews(files, args.output, args.size, args.jobs, args.verbose)
+    sys.exit(0)
+
+### END
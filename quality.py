@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: quality.py
+# Description:
+#   Per-frame quality metrics computed inline by the correction stage while
+#   the calibrated frame is still in memory (no second read of the night):
+#   - background  - median of a strided pixel sample,
+#   - noise       - robust standard deviation (1.4826 * MAD) of the sample,
+#   - satfrac     - fraction of saturated pixels (from the saturation flags),
+#   - fwhm        - rough FWHM from second moments of the brightest
+#                   isolated, non-saturated peaks (vectorized stamps).
+#   Metrics are stored in an SQLite table in results_aux_dir keyed by file,
+#   filter and DATE-OBS, together with the observing night.
+# =============================================================================
+
+import sys
+import sqlite3
+import argparse
+import numpy as np
+from datetime import datetime, timedelta
+from pathlib import Path
+
+
+DEFAULT_DB = "quality.db"
+DEFAULT_NIGHT_BOUNDARY = 12.0
+SAMPLE_SIZE = 100000
+STAMP_RADIUS = 5
+
+COLUMNS = [("file", "TEXT PRIMARY KEY"), ("filter", "TEXT"), ("date_obs", "TEXT"),
+           ("night", "TEXT"), ("exptime", "REAL"), ("background", "REAL"), ("noise", "REAL"),
+           ("satfrac", "REAL"), ("fwhm", "REAL"), ("nstars", "INTEGER")]
+# gain and read noise measured by the master stages (photon_transfer.py)
+TRANSFER_COLUMNS = [("master", "TEXT PRIMARY KEY"), ("filter", "TEXT"), ("date_obs", "TEXT"),
+                    ("night", "TEXT"), ("level", "REAL"), ("gain", "REAL"), ("ron_adu", "REAL"),
+                    ("ron", "REAL"), ("pairs", "INTEGER")]
+
+
+# ---------------------------------------------------------------------------
+# Function: night_boundary
+# Description:
+#   Hour (UTC) at which a new observing night begins, [CAMPAIGN]
+#   night_boundary_utc of *cfg* (12 without a config).
+# ---------------------------------------------------------------------------
+def night_boundary(cfg=None):
+    if cfg is None:
+        return DEFAULT_NIGHT_BOUNDARY
+    return float(cfg.get("CAMPAIGN", "night_boundary_utc", DEFAULT_NIGHT_BOUNDARY))
+
+
+# ---------------------------------------------------------------------------
+# Function: observing_night
+# Description:
+#   Date of the evening the observing night started (DATE-OBS shifted by
+#   the night boundary of *cfg*), e.g. '2025-05-02T01:30:00' -> '2025-05-01'.
+# ---------------------------------------------------------------------------
+def observing_night(date_obs, cfg=None):
+    if not date_obs:
+        return ""
+    try:
+        moment = datetime.fromisoformat(str(date_obs).strip().replace("Z", ""))
+    except ValueError:
+        return str(date_obs)[:10]
+    return (moment - timedelta(hours=night_boundary(cfg))).date().isoformat()
+
+
+# ---------------------------------------------------------------------------
+# Function: background_noise
+# Description:
+#   Median and robust standard deviation from a strided pixel sample.
+# ---------------------------------------------------------------------------
+def background_noise(data, sample_size=SAMPLE_SIZE):
+    flat = data.ravel()
+    sample = flat[::max(1, flat.size // sample_size)]
+    sample = sample[np.isfinite(sample)]
+    if sample.size == 0:
+        return float("nan"), float("nan")
+    background = np.median(sample)
+    noise = 1.4826 * np.median(np.abs(sample - background))
+    return float(background), float(noise)
+
+
+# ---------------------------------------------------------------------------
+# Function: rough_fwhm
+# Description:
+#   Median FWHM (pixels) of up to *max_stars* bright local maxima above
+#   background + *threshold* * noise. Peaks closer than a stamp to the
+#   edge, or flagged in the *saturated* boolean image, are ignored.
+# ---------------------------------------------------------------------------
+def rough_fwhm(data, background, noise, threshold=10.0, max_stars=50,
+               saturated=None, radius=STAMP_RADIUS):
+    if not np.isfinite(noise) or noise <= 0:
+        return float("nan"), 0
+    inner = data[radius:-radius, radius:-radius]
+    ys, xs = np.nonzero(inner > background + threshold * noise)
+    if ys.size == 0:
+        return float("nan"), 0
+    ys += radius
+    xs += radius
+    if saturated is not None:
+        keep = ~saturated[ys, xs]
+        ys, xs = ys[keep], xs[keep]
+    values = data[ys, xs]
+
+    # local maxima among the candidates only
+    is_peak = np.ones(ys.size, dtype=bool)
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy or dx:
+                is_peak &= values >= data[ys + dy, xs + dx]
+    ys, xs, values = ys[is_peak], xs[is_peak], values[is_peak]
+    if ys.size == 0:
+        return float("nan"), 0
+    order = np.argsort(values)[::-1][:max_stars]
+    ys, xs = ys[order], xs[order]
+
+    # (n, 2r+1, 2r+1) stamps and their second moments
+    offsets = np.arange(-radius, radius + 1)
+    stamps = data[ys[:, None, None] + offsets[None, :, None],
+                  xs[:, None, None] + offsets[None, None, :]].astype(np.float64) - background
+    stamps = np.clip(np.nan_to_num(stamps), 0, None)
+    total = stamps.sum(axis=(1, 2))
+    good = total > 0
+    if not np.any(good):
+        return float("nan"), 0
+    stamps, total = stamps[good], total[good]
+    dy2 = (offsets ** 2)[None, :, None]
+    dx2 = (offsets ** 2)[None, None, :]
+    sigma2 = ((stamps * dy2).sum(axis=(1, 2)) + (stamps * dx2).sum(axis=(1, 2))) / (2.0 * total)
+    fwhm = 2.3548 * np.sqrt(sigma2)
+    return float(np.median(fwhm)), int(fwhm.size)
+
+
+# ---------------------------------------------------------------------------
+# Function: frame_metrics
+# Description:
+#   All metrics of one calibrated frame as a dict (one database row).
+# ---------------------------------------------------------------------------
+def frame_metrics(data, header, cfg, filename, saturated=None):
+    background, noise = background_noise(data)
+    fwhm, nstars = rough_fwhm(data, background, noise,
+                              threshold=cfg.get("QUALITY", "star_threshold", 10.0),
+                              max_stars=cfg.get("QUALITY", "max_stars", 50),
+                              saturated=saturated)
+    date_keyword = cfg.get("HEADER_SPECIFICATION", "date_and_time_keyword", "DATE-OBS")
+    filter_keyword = cfg.get("HEADER_SPECIFICATION", "filters_keyword", "FILTER")
+    exptime_keyword = cfg.get("HEADER_SPECIFICATION", "exposure_keyword", "EXPTIME")
+    date_obs = str(header.get(date_keyword, ""))
+    return {
+        "file": str(filename),
+        "filter": str(header.get(filter_keyword, "")).strip(),
+        "date_obs": date_obs,
+        "night": observing_night(date_obs, cfg),
+        "exptime": float(header.get(exptime_keyword, 0.0)),
+        "background": background,
+        "noise": noise,
+        "satfrac": float(np.count_nonzero(saturated)) / data.size if saturated is not None else 0.0,
+        "fwhm": fwhm,
+        "nstars": nstars,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Class: QualityDB
+# Description:
+#   SQLite table of per-frame metrics (and a table of the photon transfer
+#   measurements of the masters). Rows are collected in memory and
+#   written in one transaction by flush().
+# ---------------------------------------------------------------------------
+class QualityDB:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._rows = []
+        self._transfer_rows = []
+        with sqlite3.connect(self.path) as con:
+            con.execute("CREATE TABLE IF NOT EXISTS frames (" +
+                        ", ".join(f"{name} {kind}" for name, kind in COLUMNS) + ")")
+            con.execute("CREATE INDEX IF NOT EXISTS frames_night ON frames (night, filter)")
+            con.execute("CREATE TABLE IF NOT EXISTS transfer (" +
+                        ", ".join(f"{name} {kind}" for name, kind in TRANSFER_COLUMNS) + ")")
+
+    def add(self, metrics):
+        self._rows.append(tuple(metrics.get(name) for name, _ in COLUMNS))
+
+    def add_transfer(self, row):
+        self._transfer_rows.append(tuple(row.get(name) for name, _ in TRANSFER_COLUMNS))
+
+    def flush(self):
+        if not self._rows and not self._transfer_rows:
+            return 0
+        with sqlite3.connect(self.path) as con:
+            for table, columns, rows in (("frames", COLUMNS, self._rows),
+                                         ("transfer", TRANSFER_COLUMNS, self._transfer_rows)):
+                if rows:
+                    placeholders = ", ".join("?" for _ in columns)
+                    con.executemany(f"INSERT OR REPLACE INTO {table} VALUES ({placeholders})", rows)
+        written = len(self._rows) + len(self._transfer_rows)
+        self._rows, self._transfer_rows = [], []
+        return written
+
+    def query(self, where="", params=(), table="frames"):
+        with sqlite3.connect(self.path) as con:
+            con.row_factory = sqlite3.Row
+            sql = f"SELECT * FROM {table}" + (f" WHERE {where}" if where else "") + " ORDER BY date_obs"
+            return [dict(row) for row in con.execute(sql, params)]
+
+    def query_transfer(self, where="", params=()):
+        return self.query(where, params, table="transfer")
+
+
+# ---------------------------------------------------------------------------
+# Function: quality_db_from_config
+# Description:
+#   QualityDB in results_aux_dir, or None if metrics are disabled.
+# ---------------------------------------------------------------------------
+def quality_db_from_config(cfg):
+    if not cfg.get("QUALITY", "quality_metrics", False):
+        return None
+    aux_dir = cfg.get("DATA_STRUCTURE", "results_aux_dir", "./results/aux/")
+    return QualityDB(Path(aux_dir) / cfg.get("QUALITY", "quality_db", DEFAULT_DB))
+
+
+# ---------------------------------------------------------------------------
+# Main block: print or export the metrics of a night.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the per-frame quality metrics database.")
+    parser.add_argument("-c", "--config", type=str, default="config.ini", help="Specify path to config file")
+    parser.add_argument("-n", "--night", type=str, help="observing night (YYYY-MM-DD)")
+    parser.add_argument("-f", "--filter", type=str, help="filter name")
+    parser.add_argument("--csv", type=str, help="write the selected rows to this CSV file")
+    args = parser.parse_args()
+
+    from calib_config import CalibConfig
+    cfg = CalibConfig(args.config)
+    aux_dir = cfg.get("DATA_STRUCTURE", "results_aux_dir", "./results/aux/")
+    db_path = Path(aux_dir) / cfg.get("QUALITY", "quality_db", DEFAULT_DB)
+    if not db_path.exists():
+        print(f"[ERROR]: Quality database '{db_path}' not found.")
+        sys.exit(1)
+
+    conditions, params = [], []
+    if args.night:
+        conditions.append("night = ?")
+        params.append(args.night)
+    if args.filter:
+        conditions.append("filter = ?")
+        params.append(args.filter)
+    rows = QualityDB(db_path).query(" AND ".join(conditions), params)
+
+    names = [name for name, _ in COLUMNS]
+    if args.csv:
+        import csv
+        with open(args.csv, "w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=names)
+            writer.writeheader()
+            writer.writerows(rows)
+        print(f"{len(rows)} rows written to '{args.csv}'.")
+    else:
+        print(" ".join(f"{name:>10s}" for name in names[1:]), " file")
+        for row in rows:
+            print(" ".join(f"{row[name]:>10.4g}" if isinstance(row[name], float) else f"{str(row[name]):>10s}"
+                           for name in names[1:]), "", row["file"])
+    sys.exit(0)
+
+### END
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: quicklook.py
+# Description:
+#   Low-latency quick-look calibration for focus and pointing checks during
+#   the night.
+#   - the raw frame is binned on read (default 4x4, block mean) right after
+#     trimming, before any floating point work is done on it,
+#   - it is calibrated against binned copies of the masterbias, masterdark
+#     and normalized masterflat, cached on disk (<cache_dir>/ql<N>x<N>/) and
+#     in memory, so every following frame only costs one read and a few
+#     operations on a 16x smaller array,
+#   - the correction math is the one of the file pipeline (the kernels of
+#     calibration.py),
+#   - a small PNG (and optionally a small FITS file) is written per frame.
+#
+#   All data and masters are binned by mean, so the quick-look frame keeps
+#   the ADU scale of a single pixel. Masters made with another binning than
+#   the frame are first matched to the frame binning as in the full pipeline.
+# =============================================================================
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+from astropy.io import fits
+from pathlib import Path
+import detector
+import binning
+import preview
+import linearity
+from calibration import subtract_bias, subtract_dark, divide_flat
+from flat_correction import get_filter_from_header
+import warnings
+warnings.filterwarnings("ignore")
+
+
+DEFAULT_BINNING = 4
+
+
+# ---------------------------------------------------------------------------
+# Function: bin_overscan
+# Description:
+#   Bins an overscan level (scalar, per-row or per-column array from
+#   detector.read_trimmed) the same way as the frame it belongs to.
+# ---------------------------------------------------------------------------
+def bin_overscan(overscan, factor):
+    if overscan is None or np.ndim(overscan) == 0:
+        return overscan
+    if overscan.shape[1] == 1:
+        return binning.bin_array(overscan, 1, factor, "mean")
+    return binning.bin_array(overscan, factor, 1, "mean")
+
+
+# ---------------------------------------------------------------------------
+# Function: cached_master
+# Description:
+#   Master *master_path* matched to the binning of a frame with
+#   *frame_header* and binned by *factor* (mean). The result is kept in
+#   *cache_path* and rebuilt only when the master is newer than the cache.
+#   Returns None if the master does not exist.
+# ---------------------------------------------------------------------------
+def cached_master(master_path, cache_path, frame_header, factor):
+    master_path, cache_path = Path(master_path), Path(cache_path)
+    if not master_path.exists():
+        return None
+    if cache_path.exists() and cache_path.stat().st_mtime >= master_path.stat().st_mtime:
+        return fits.getdata(cache_path).astype(np.float32)
+
+    with fits.open(master_path) as hdul:
+        master, header = hdul[0].data.astype(np.float32), hdul[0].header
+    master = binning.match_binning(master, header, frame_header, binning.master_binning_method(master_path))
+    small = binning.bin_array(master, factor, factor, "mean")
+
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_suffix(".tmp")
+    fits.PrimaryHDU(small, header=binning.binned_header(header, factor, factor)).writeto(tmp_path, overwrite=True)
+    os.replace(tmp_path, cache_path)
+    return small
+
+
+# ---------------------------------------------------------------------------
+# Class: QuickLook
+# Description:
+#   Quick-look calibrator. Binned masters are loaded once per frame binning
+#   and filter and reused for all following frames.
+# ---------------------------------------------------------------------------
+class QuickLook:
+    def __init__(self, cfg, factor=DEFAULT_BINNING, master_dir=None, cache_dir=None, verbose=False):
+        self.cfg = cfg
+        self.factor = int(factor)
+        self.master_dir = Path(master_dir or cfg.get("DATA_STRUCTURE", "working_dir", "./work/"))
+        self.cache_dir = Path(cache_dir or cfg.get("QUICKLOOK", "cache_dir", "./work/quicklook/"))
+        self.verbose = verbose
+        self.exptime_keyword = cfg.get("HEADER_SPECIFICATION", "exposure_keyword", "EXPTIME")
+        # applied to the raw (16-bit) pixels before binning (lookup table)
+        self.linearity = linearity.linearity_from_config(cfg)
+        self._masters = {}
+
+    def master(self, name, frame_header):
+        key = (name, binning.frame_binning(frame_header))
+        if key not in self._masters:
+            frame_bin = "{}x{}".format(*key[1])
+            cache_path = self.cache_dir / f"ql{self.factor}x{self.factor}" / f"bin{frame_bin}" / name
+            self._masters[key] = cached_master(self.master_dir / name, cache_path, frame_header, self.factor)
+            if self.verbose and self._masters[key] is None:
+                print(f"[WARNING] {self.master_dir / name} not found, step skipped.")
+        return self._masters[key]
+
+    # -----------------------------------------------------------------------
+    # Method: calibrate
+    # Description:
+    #   Returns the binned, calibrated data and header of one raw frame.
+    # -----------------------------------------------------------------------
+    def calibrate(self, path):
+        with fits.open(path) as hdul:
+            raw, overscan, header = detector.read_trimmed(hdul[0], self.cfg)
+            # the mean of f(x) is not f(mean of x): linearity before binning
+            if self.linearity is not None:
+                raw = self.linearity.apply(raw)
+                if overscan is not None:
+                    overscan = self.linearity.apply(overscan)
+            data = binning.bin_array(raw, self.factor, self.factor, "mean")
+        overscan = bin_overscan(overscan, self.factor)
+
+        steps = []
+        masterbias = self.master("masterbias.fits", header)
+        if masterbias is not None:
+            data = subtract_bias(data, overscan, masterbias, out=data)
+            steps.append("B")
+        elif overscan is not None:
+            data = subtract_bias(data, overscan, 0.0, out=data)
+        masterdark = self.master("masterdark.fits", header)
+        if masterdark is not None:
+            data = subtract_dark(data, masterdark, float(header.get(self.exptime_keyword, 0.0)),
+                                 out=data)
+            steps.append("D")
+        normflat = self.master(f"masterflat_{get_filter_from_header(header, self.cfg)}_norm.fits", header)
+        if normflat is not None:
+            data = divide_flat(data, normflat, out=data)
+            steps.append("F")
+
+        header = binning.binned_header(header, self.factor, self.factor)
+        header["QUICKLK"] = ("".join(steps) or "none", "Quick-look calibration steps applied")
+        if self.linearity is not None:
+            header[linearity.HEADER_KEYWORD] = self.linearity.header_card()
+        return data, header
+
+    # -----------------------------------------------------------------------
+    # Method: process
+    # Description:
+    #   Calibrates one frame and writes its PNG (and FITS) into *output_dir*.
+    #   Returns the PNG path and the elapsed time in seconds.
+    # -----------------------------------------------------------------------
+    def process(self, path, output_dir, max_size=preview.DEFAULT_SIZE, write_fits=False):
+        start = time.perf_counter()
+        data, header = self.calibrate(path)
+        png_path = preview.make_preview(data, preview.png_name(path, output_dir), max_size)
+        if write_fits:
+            fits_path = Path(output_dir) / (Path(path).stem + "-ql.fits")
+            fits.PrimaryHDU(data, header=header).writeto(fits_path, overwrite=True)
+        elapsed = time.perf_counter() - start
+        if self.verbose:
+            print(f"[INFO] {path} -> {png_path} ({header['QUICKLK']}, {1000 * elapsed:.0f} ms)")
+        return png_path, elapsed
+
+
+# ---------------------------------------------------------------------------
+# Main block: quick-look calibration of the given frames.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Quick-look calibration of raw frames on binned data.")
+    parser.add_argument("inputs", nargs="+", help="raw FITS files, list files (.lst/.txt) or directories")
+    parser.add_argument("-c", "--config", type=str, default="config.ini", help="Specify path to config file")
+    parser.add_argument("-b", "--binning", type=int, help="quick-look binning factor (default from config)")
+    parser.add_argument("-m", "--masters", type=str, help="directory with the masters (default: working_dir)")
+    parser.add_argument("-o", "--output", type=str, help="output directory (default from config)")
+    parser.add_argument("-f", "--fits", action="store_true", help="also write the binned calibrated FITS files")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
+    args = parser.parse_args()
+
+    from calib_config import CalibConfig
+    cfg = CalibConfig(args.config)
+    factor = args.binning or cfg.get("QUICKLOOK", "binning", DEFAULT_BINNING)
+    output_dir = args.output or cfg.get("QUICKLOOK", "output_dir", "./results/quicklook/")
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    files = binning.collect_input_files(args.inputs)
+    if not files:
+        print("No FITS files found.")
+        sys.exit(1)
+    quicklook = QuickLook(cfg, factor, args.masters, verbose=args.verbose)
+    for file in files:
+        try:
+            quicklook.process(file, output_dir, preview.preview_size(cfg), args.fits)
+        except Exception as e:
+            print(f"Skipping {file}: {e}")
+    sys.exit(0)
+
+### END
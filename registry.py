@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: registry.py
+# Description:
+#   Frame registry: one SQLite table describing every frame of a night
+#   instead of the derived .lst files of predicted names.
+#   - calib_prep_lists.py registers the raw frames with their image type,
+#     filter, exposure time, DATE-OBS and camera mode (one header read per
+#     frame),
+#   - every correction stage selects its input frames from the registry
+#     (by type, without opening the files of other types) and records the
+#     names of the files it really wrote, in one batch per stage,
+#   - the master makers select their bias, dark and flat frames from it.
+#   Stage outputs are columns of the raw frame row:
+#     file -> b (bias corrected) -> bd (dark corrected) -> bdf (calibrated)
+#   List files are still written once per stage for external tools.
+# =============================================================================
+
+import os
+import sys
+import sqlite3
+import argparse
+from astropy.io import fits
+from pathlib import Path
+import partitions
+import site_config
+
+
+DEFAULT_REGISTRY = "./work/frames.db"
+
+# stage output column -> stage input column
+STAGES = {"b": "file", "bd": "b", "bdf": "bd"}
+COLUMNS = [("file", "TEXT PRIMARY KEY"), ("imagetyp", "TEXT"), ("filter", "TEXT"), ("exptime", "REAL"),
+           ("date_obs", "TEXT"), ("mode", "TEXT"), ("b", "TEXT"), ("bd", "TEXT"), ("bdf", "TEXT")]
+# columns taken from the header of a raw frame
+HEADER_COLUMNS = [name for name, _ in COLUMNS[:6]]
+
+
+# ---------------------------------------------------------------------------
+# Function: frame_record
+# Description:
+#   Registry row (dict) of a raw frame from its header; the image type is
+#   stored as BIAS, DARK, FLAT or OBJECT (labels of the config).
+# ---------------------------------------------------------------------------
+def frame_record(path, header, cfg=None):
+    def keyword(key, default):
+        return cfg.get("HEADER_SPECIFICATION", key, default) if cfg is not None else default
+    try:
+        exptime = float(header.get(keyword("exposure_keyword", "EXPTIME"), 0.0))
+    except (TypeError, ValueError):
+        exptime = 0.0
+    return {
+        "file": str(path),
+        "imagetyp": site_config.from_calib_config(cfg).image_type_of(header),
+        "filter": str(header.get(keyword("filters_keyword", "FILTER"), "")).strip(),
+        "exptime": exptime,
+        "date_obs": str(header.get(keyword("date_and_time_keyword", "DATE-OBS"), "")),
+        "mode": partitions.camera_mode(header, cfg),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Class: FrameRegistry
+# Description:
+#   SQLite frame registry. All writes are batched (executemany in one
+#   transaction).
+# ---------------------------------------------------------------------------
+class FrameRegistry:
+    def __init__(self, path=DEFAULT_REGISTRY):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as con:
+            con.execute("CREATE TABLE IF NOT EXISTS frames (" +
+                        ", ".join(f"{name} {kind}" for name, kind in COLUMNS) + ")")
+            # registries of older versions lack later columns
+            existing = {row[1] for row in con.execute("PRAGMA table_info(frames)")}
+            for name, kind in COLUMNS:
+                if name not in existing:
+                    con.execute(f"ALTER TABLE frames ADD COLUMN {name} {kind}")
+            for column in STAGES:
+                con.execute(f"CREATE INDEX IF NOT EXISTS frames_{column} ON frames ({column})")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30.0)
+
+    # -----------------------------------------------------------------------
+    # Method: register
+    # Description:
+    #   Adds raw frames (header read for each file). With reset=True the
+    #   registry is emptied first (new night in the same working directory).
+    # -----------------------------------------------------------------------
+    def register(self, files, cfg=None, reset=False):
+        records = []
+        for file in files:
+            try:
+                records.append(frame_record(file, fits.getheader(file), cfg))
+            except Exception as e:
+                print(f"Skipping {file}: {e}")
+        self.add_records(records, reset)
+        return len(records)
+
+    def register_records(self, records, cfg=None, reset=False):
+        '''Adds frames scanned by scanner.scan (no file is opened again).'''
+        self.add_records([frame_record(record.path, record.header, cfg) for record in records], reset)
+        return len(records)
+
+    def add_records(self, records, reset=False):
+        names = HEADER_COLUMNS
+        with self._connect() as con:
+            if reset:
+                con.execute("DELETE FROM frames")
+            con.executemany(
+                f"INSERT INTO frames ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)}) "
+                f"ON CONFLICT(file) DO UPDATE SET " + ", ".join(f"{n} = excluded.{n}" for n in names[1:]),
+                [tuple(record.get(name) for name in names) for record in records])
+
+    # -----------------------------------------------------------------------
+    # Method: record_outputs
+    # Description:
+    #   Stores the output files of a stage ('b', 'bd' or 'bdf') given as
+    #   (input file, output file) pairs.
+    # -----------------------------------------------------------------------
+    def record_outputs(self, stage, pairs):
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage '{stage}'.")
+        with self._connect() as con:
+            con.executemany(f"UPDATE frames SET {stage} = ? WHERE {STAGES[stage]} = ?",
+                            [(str(output), str(source)) for source, output in pairs])
+
+    # -----------------------------------------------------------------------
+    # Method: select
+    # Description:
+    #   Files of *column* ('file', 'b', 'bd', 'bdf') that exist in the
+    #   registry, optionally restricted to image types and a filter or
+    #   excluding image types.
+    # -----------------------------------------------------------------------
+    def select(self, column="file", imagetypes=None, exclude=None, filt=None):
+        if column != "file" and column not in STAGES:
+            raise ValueError(f"Unknown registry column '{column}'.")
+        conditions, params = [f"{column} IS NOT NULL"], []
+        if imagetypes:
+            conditions.append(f"imagetyp IN ({', '.join('?' for _ in imagetypes)})")
+            params += [t.upper() for t in imagetypes]
+        if exclude:
+            conditions.append(f"imagetyp NOT IN ({', '.join('?' for _ in exclude)})")
+            params += [t.upper() for t in exclude]
+        if filt is not None:
+            conditions.append("filter = ?")
+            params.append(filt)
+        with self._connect() as con:
+            rows = con.execute(f"SELECT {column} FROM frames WHERE {' AND '.join(conditions)} ORDER BY file",
+                               params)
+            return [row[0] for row in rows]
+
+    def rows(self):
+        with self._connect() as con:
+            con.row_factory = sqlite3.Row
+            return [dict(row) for row in con.execute("SELECT * FROM frames ORDER BY file")]
+
+    def count(self):
+        with self._connect() as con:
+            return con.execute("SELECT COUNT(*) FROM frames").fetchone()[0]
+
+
+# ---------------------------------------------------------------------------
+# Function: registry_from_config
+# Description:
+#   The frame registry of [DATA_STRUCTURE] frame_registry, or None if it is
+#   disabled (use_frame_registry = False) or has not been created yet.
+# ---------------------------------------------------------------------------
+def registry_from_config(cfg):
+    if not cfg.get("DATA_STRUCTURE", "use_frame_registry", False):
+        return None
+    path = Path(cfg.get("DATA_STRUCTURE", "frame_registry", DEFAULT_REGISTRY))
+    return FrameRegistry(path) if path.exists() else None
+
+
+# ---------------------------------------------------------------------------
+# Function: read_list / write_list
+# Description:
+#   Plain list files (one file name per line). write_list writes the whole
+#   list once, atomically.
+# ---------------------------------------------------------------------------
+def read_list(path):
+    with open(path, encoding="utf-8") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def write_list(path, files):
+    tmp_path = str(path) + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.writelines(item + "\n" for item in files)
+    os.replace(tmp_path, path)
+
+
+# ---------------------------------------------------------------------------
+# Function: registry_selection
+# Description:
+#   The frames of the given list *files* selected from *registry* by image
+#   type (no header opened), in registry order. None if there is no
+#   registry or it does not know every listed file (e.g. a registry of
+#   another night): the list is then used as given.
+# ---------------------------------------------------------------------------
+def registry_selection(registry, files, column="file", imagetypes=None, exclude=None):
+    if registry is None:
+        return None
+    known = {os.path.normpath(f) for f in registry.select(column)}
+    unknown = [f for f in files if os.path.normpath(f) not in known]
+    if unknown:
+        print(f"[WARNING] {len(unknown)} of {len(files)} listed files are not in the frame registry "
+              f"'{registry.path}' (e.g. {unknown[0]}), the list is used as given.")
+        return None
+    listed = {os.path.normpath(f) for f in files}
+    return [f for f in registry.select(column, imagetypes, exclude) if os.path.normpath(f) in listed]
+
+
+# ---------------------------------------------------------------------------
+# Function: stage_inputs
+# Description:
+#   Input files of a stage: the list file *list_in*, restricted by image
+#   type with *registry* when given (see registry_selection).
+# ---------------------------------------------------------------------------
+def stage_inputs(registry, list_in, column="file", imagetypes=None, exclude=None):
+    files = read_list(list_in)
+    selected = registry_selection(registry, files, column, imagetypes, exclude)
+    return files if selected is None else selected
+
+
+# ---------------------------------------------------------------------------
+# Main block: query the registry or export a selection as a list file.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Query the frame registry.")
+    parser.add_argument("-c", "--config", type=str, default="config.ini", help="Specify path to config file")
+    parser.add_argument("-r", "--registry", type=str, help="registry file (default from config)")
+    parser.add_argument("-s", "--stage", choices=("file", "b", "bd", "bdf"), default="file",
+                        help="stage column to select (default: raw files)")
+    parser.add_argument("-t", "--type", action="append", help="image type (may be repeated)")
+    parser.add_argument("-f", "--filter", type=str, help="filter name")
+    parser.add_argument("-o", "--output", type=str, help="write the selection to this list file")
+    args = parser.parse_args()
+
+    path = args.registry
+    if path is None:
+        from calib_config import CalibConfig
+        path = CalibConfig(args.config).get("DATA_STRUCTURE", "frame_registry", DEFAULT_REGISTRY)
+    if not Path(path).exists():
+        print(f"[ERROR]: Frame registry '{path}' not found.")
+        sys.exit(1)
+    files = FrameRegistry(path).select(args.stage, args.type, filt=args.filter)
+    if args.output:
+        write_list(args.output, files)
+    else:
+        print("\n".join(files))
+    sys.exit(0)
+
+### END
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: roi.py
+# Description:
+#   Region-of-interest calibration: small stamps around targets calibrated
+#   from thousands of frames without reading the full frames.
+#   - windows are given in FITS notation '[x1:x2,y1:y2]' in pixels of the
+#     raw frame (command line or [ROI] windows in config.ini),
+#   - for subframe readouts the position of the subframe on the detector is
+#     read from header keywords ([ROI] subframe_keywords, e.g. XORGSUBF,
+#     YORGSUBF); without windows the whole subframe is calibrated,
+#   - only the window (and the overscan rows/columns next to it) is read
+#     from the raw file (HDU.section),
+#   - masters are opened once and only the matching cutouts are read; the
+#     cutouts are cached per window and frame binning,
+#   - every window of every frame is written as a small '-roi<N>-bdf' file.
+#   The correction math is the one of the file pipeline (the kernels of
+#   calibration.py).
+# =============================================================================
+
+import re
+import sys
+import argparse
+import numpy as np
+from astropy.io import fits
+from pathlib import Path
+import detector
+import binning
+import linearity
+from calibration import subtract_bias, subtract_dark, divide_flat
+from flat_correction import get_filter_from_header
+import warnings
+warnings.filterwarnings("ignore")
+
+
+WINDOW_PATTERN = re.compile(r"\[[^\]]*\]")
+ROI_KEYWORD = "CALROI"
+
+
+# ---------------------------------------------------------------------------
+# Function: parse_windows
+# Description:
+#   List of (rows, cols) slices from one or more FITS sections. Lists split
+#   by CalibConfig at the commas are joined back first.
+# ---------------------------------------------------------------------------
+def parse_windows(value):
+    if value is None:
+        return []
+    if isinstance(value, (list, tuple)):
+        value = ",".join(str(v) for v in value)
+    return [detector.parse_section(section) for section in WINDOW_PATTERN.findall(str(value))]
+
+
+# ---------------------------------------------------------------------------
+# Function: subframe_origin
+# Description:
+#   (x0, y0) detector position (0-based, frame pixels) of a subframe
+#   readout from the [ROI] subframe_keywords, (0, 0) for full frames.
+# ---------------------------------------------------------------------------
+def subframe_origin(header, cfg):
+    keywords = cfg.get("ROI", "subframe_keywords", ["XORGSUBF", "YORGSUBF"])
+    if not isinstance(keywords, (list, tuple)) or len(keywords) != 2:
+        return 0, 0
+    return int(header.get(keywords[0], 0)), int(header.get(keywords[1], 0))
+
+
+# ---------------------------------------------------------------------------
+# Class: ROICalibrator
+# Description:
+#   Calibrates windows of raw frames against master cutouts. The master
+#   files stay open (lazily loaded data) until close() is called.
+# ---------------------------------------------------------------------------
+class ROICalibrator:
+    def __init__(self, cfg, master_dir=None, verbose=False):
+        self.cfg = cfg
+        self.master_dir = Path(master_dir or cfg.get("DATA_STRUCTURE", "working_dir", "./work/"))
+        self.verbose = verbose
+        self.exptime_keyword = cfg.get("HEADER_SPECIFICATION", "exposure_keyword", "EXPTIME")
+        self.type_keyword = cfg.get("HEADER_SPECIFICATION", "image_type_keyword", "IMAGETYP")
+        self.linearity = linearity.linearity_from_config(cfg)
+        self.library = None
+        if cfg.get("DARK_SUBTRACTION", "library_files", False):
+            import dark_library
+            self.library = dark_library.library_from_config(cfg, verbose=verbose)
+        self._masters = {}
+        self._cutouts = {}
+
+    def _master_hdu(self, name):
+        if name not in self._masters:
+            path = self.master_dir / name
+            self._masters[name] = fits.open(path) if path.exists() else None
+        hdul = self._masters[name]
+        return None if hdul is None else hdul[0]
+
+    def cutout(self, name, rows, cols, frame_header):
+        key = (name, rows.start, rows.stop, cols.start, cols.stop, binning.frame_binning(frame_header))
+        if key not in self._cutouts:
+            hdu = self._master_hdu(name)
+            self._cutouts[key] = (None if hdu is None else
+                                  binning.master_cutout(hdu.section, hdu.header, rows, cols, frame_header,
+                                                binning.master_binning_method(name)))
+        return self._cutouts[key]
+
+    def close(self):
+        for hdul in self._masters.values():
+            if hdul is not None:
+                hdul.close()
+        self._masters = {}
+
+    # -----------------------------------------------------------------------
+    # Method: calibrate_window
+    # Description:
+    #   Reads and calibrates one window (frame pixels) of an open raw HDU.
+    #   Returns the calibrated stamp and its header.
+    # -----------------------------------------------------------------------
+    def calibrate_window(self, hdu, window):
+        header = hdu.header.copy()
+        trim, bias = detector.frame_sections(header, self.cfg)
+        rows, cols = window
+        raw = hdu.section[rows, cols]
+        if raw.shape != (rows.stop - rows.start, cols.stop - cols.start):
+            raise ValueError(f"Window {detector.format_section(window)} lies outside the frame.")
+        overscan = None
+        if bias is not None:
+            overscan = detector.overscan_level(hdu, window, bias,
+                                               self.cfg.get("DETECTOR", "overscan_method", "row"))
+
+        # window in master pixels: detector position minus the trimmed border
+        x0, y0 = subframe_origin(header, self.cfg)
+        if trim is not None:
+            x0, y0 = x0 - trim[1].start, y0 - trim[0].start
+        master_rows = slice(rows.start + y0, rows.stop + y0)
+        master_cols = slice(cols.start + x0, cols.stop + x0)
+
+        steps = []
+        masterbias = self.cutout("masterbias.fits", master_rows, master_cols, header)
+        data = subtract_bias(raw, overscan, masterbias if masterbias is not None else 0.0,
+                             linearity=self.linearity)
+        if masterbias is not None:
+            steps.append("B")
+
+        exposure = float(header.get(self.exptime_keyword, 0.0))
+        if self.library is not None:
+            import dark_library
+            temperature = dark_library.header_temperature(header, self.cfg)
+            if temperature is None:
+                raise ValueError("no CCD temperature in header, cannot select library dark")
+            dark, dark_header = self.library.get_dark(temperature, exposure)
+            dark = binning.master_cutout(dark, dark_header, master_rows, master_cols, header,
+                                         binning.MASTER_BINNING["masterdark"])
+            data = subtract_dark(data, dark, out=data)
+            steps.append("D")
+        else:
+            masterdark = self.cutout("masterdark.fits", master_rows, master_cols, header)
+            if masterdark is not None:
+                data = subtract_dark(data, masterdark, exposure, out=data)
+                steps.append("D")
+
+        normflat = self.cutout(f"masterflat_{get_filter_from_header(header, self.cfg)}_norm.fits",
+                               master_rows, master_cols, header)
+        if normflat is not None:
+            data = divide_flat(data, normflat, out=data)
+            steps.append("F")
+
+        detector.update_header(header, window, overscan)
+        header[ROI_KEYWORD] = (detector.format_section(window), "Calibrated window of the raw frame")
+        header["ROISTEPS"] = ("".join(steps) or "none", "Calibration steps applied to the window")
+        if self.linearity is not None:
+            header[linearity.HEADER_KEYWORD] = self.linearity.header_card()
+        return data, header
+
+    # -----------------------------------------------------------------------
+    # Method: process
+    # Description:
+    #   Calibrates all *windows* of one raw frame (the whole subframe if no
+    #   window is given) and writes the stamps into *output_dir*.
+    # -----------------------------------------------------------------------
+    def process(self, path, windows, output_dir):
+        outputs = []
+        with fits.open(path) as hdul:
+            hdu = hdul[0]
+            imagetyp = str(hdu.header.get(self.type_keyword, "")).strip().upper()
+            if imagetyp in ("BIAS", "DARK"):
+                return outputs
+            if not windows:
+                height, width = hdu.shape
+                windows = [(slice(0, height), slice(0, width))]
+            for number, window in enumerate(windows, start=1):
+                data, header = self.calibrate_window(hdu, window)
+                output = Path(output_dir) / f"{Path(path).stem}-roi{number}-bdf.fits"
+                fits.PrimaryHDU(data.astype(np.float32), header=header).writeto(output, overwrite=True)
+                outputs.append(str(output))
+                if self.verbose:
+                    print(f"[INFO] {path} {header[ROI_KEYWORD]} ({header['ROISTEPS']}) -> {output}")
+        return outputs
+
+
+# ---------------------------------------------------------------------------
+# Main block: ROI calibration of the given frames.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate only small windows of raw frames.")
+    parser.add_argument("inputs", nargs="+", help="raw FITS files, list files (.lst/.txt) or directories")
+    parser.add_argument("-c", "--config", type=str, default="config.ini", help="Specify path to config file")
+    parser.add_argument("-w", "--window", action="append",
+                        help="window '[x1:x2,y1:y2]' in raw frame pixels (may be repeated)")
+    parser.add_argument("-m", "--masters", type=str, help="directory with the masters (default: working_dir)")
+    parser.add_argument("-o", "--output", type=str, help="output directory (default from config)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="increase output verbosity")
+    args = parser.parse_args()
+
+    from calib_config import CalibConfig
+    cfg = CalibConfig(args.config)
+    try:
+        windows = parse_windows(args.window if args.window else cfg.get("ROI", "windows", None))
+    except ValueError as e:
+        print(f"[ERROR]: {e}")
+        sys.exit(1)
+    output_dir = args.output or cfg.get("ROI", "output_dir", "./results/roi/")
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    files = binning.collect_input_files(args.inputs)
+    if not files:
+        print("No FITS files found.")
+        sys.exit(1)
+    calibrator = ROICalibrator(cfg, args.masters, args.verbose)
+    for file in files:
+        try:
+            calibrator.process(file, windows, output_dir)
+        except Exception as e:
+            print(f"Skipping {file}: {e}")
+    calibrator.close()
+    sys.exit(0)
+
+### END
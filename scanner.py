@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: scanner.py
+# Description:
+#   Fast scanner of (nested) night directories.
+#   - directories are walked with os.scandir (no per-file stat calls
+#     besides the file size, no path resolution),
+#   - of every FITS file only the primary header blocks (2880 bytes each,
+#     up to the END card) are read and parsed, in a thread pool,
+#   - files that are not FITS, truncated or still being written (data
+#     shorter than BITPIX x NAXISn promises) are skipped,
+#   - every frame is described by a FrameRecord (type, filter, exposure,
+#     shape and the parsed header cards), which the frame registry stores
+#     without opening the file again.
+# =============================================================================
+
+import os
+import sys
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple, Tuple
+import site_config
+
+
+FITS_EXTENSIONS = (".fits", ".fit")
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+# a primary header longer than this is not a header (or not FITS)
+MAX_HEADER_BLOCKS = 64
+DEFAULT_WORKERS = 16
+
+
+class FrameRecord(NamedTuple):
+    path: str
+    imagetyp: str  # BIAS, DARK, FLAT or OBJECT (labels of the config, site_config.py)
+    filter: str
+    exptime: float
+    shape: Tuple[int, ...]
+    bitpix: int
+    header: dict
+
+
+# ---------------------------------------------------------------------------
+# Function: iter_fits_files
+# Description:
+#   Paths of the FITS files below *root* (all levels with *recursive*),
+#   found with os.scandir. Yields (path, size) pairs; hidden entries are
+#   skipped.
+# ---------------------------------------------------------------------------
+def iter_fits_files(root, recursive=True, extensions=FITS_EXTENSIONS):
+    stack = [os.path.abspath(root)]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            stack.append(entry.path)
+                    elif entry.name.lower().endswith(extensions) and entry.is_file():
+                        yield entry.path, entry.stat().st_size
+        except OSError as e:
+            print(f"Skipping {directory}: {e}")
+
+
+# ---------------------------------------------------------------------------
+# Function: parse_card_value
+# Description:
+#   Value of a header card: str, bool, int or float (None if empty).
+# ---------------------------------------------------------------------------
+def parse_card_value(text):
+    text = text.strip()
+    if text.startswith("'"):
+        value, i = [], 1
+        while i < len(text):
+            if text[i] == "'":
+                if text[i + 1:i + 2] == "'":
+                    value.append("'")
+                    i += 2
+                    continue
+                break
+            value.append(text[i])
+            i += 1
+        return "".join(value).rstrip()
+    text = text.split("/", 1)[0].strip()
+    if text == "T":
+        return True
+    if text == "F":
+        return False
+    if not text:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        try:
+            return float(text.replace("D", "E"))
+        except ValueError:
+            return text
+
+
+# ---------------------------------------------------------------------------
+# Function: sniff_header
+# Description:
+#   Reads the primary header of *path* block by block up to the END card.
+#   Returns (cards dict, header size in bytes); raises ValueError for files
+#   that are not FITS or end inside the header.
+# ---------------------------------------------------------------------------
+def sniff_header(path):
+    cards = {}
+    with open(path, "rb") as f:
+        for block_number in range(MAX_HEADER_BLOCKS):
+            block = f.read(BLOCK_SIZE)
+            if len(block) < BLOCK_SIZE:
+                raise ValueError("truncated header")
+            if block_number == 0 and not block.startswith(b"SIMPLE  ="):
+                raise ValueError("not a FITS file")
+            for start in range(0, BLOCK_SIZE, CARD_SIZE):
+                card = block[start:start + CARD_SIZE].decode("ascii", "replace")
+                keyword = card[:8].rstrip()
+                if keyword == "END":
+                    return cards, (block_number + 1) * BLOCK_SIZE
+                if card[8:10] == "= " and keyword not in cards:
+                    cards[keyword] = parse_card_value(card[10:])
+    raise ValueError("no END card")
+
+
+def data_size(cards):
+    naxis = int(cards.get("NAXIS", 0))
+    if naxis == 0:
+        return 0
+    size = abs(int(cards["BITPIX"])) // 8
+    for axis in range(1, naxis + 1):
+        size *= int(cards[f"NAXIS{axis}"])
+    return size
+
+
+# ---------------------------------------------------------------------------
+# Function: read_record
+# Description:
+#   FrameRecord of one file, None (with a message) if the file is not a
+#   complete FITS file or was modified less than *settle* seconds ago.
+# ---------------------------------------------------------------------------
+def read_record(path, size, cfg=None, settle=0.0):
+    def keyword(key, default):
+        return cfg.get("HEADER_SPECIFICATION", key, default) if cfg is not None else default
+    try:
+        if settle and time.time() - os.path.getmtime(path) < settle:
+            raise ValueError("still being written")
+        cards, header_size = sniff_header(path)
+        if size < header_size + data_size(cards):
+            raise ValueError(f"truncated data ({size} of {header_size + data_size(cards)} bytes)")
+        try:
+            exptime = float(cards.get(keyword("exposure_keyword", "EXPTIME"), 0.0))
+        except (TypeError, ValueError):
+            exptime = 0.0
+        naxis = int(cards.get("NAXIS", 0))
+        return FrameRecord(
+            path=path,
+            imagetyp=site_config.from_calib_config(cfg).image_type_of(cards),
+            filter=str(cards.get(keyword("filters_keyword", "FILTER"), "")).strip(),
+            exptime=exptime,
+            shape=tuple(int(cards[f"NAXIS{axis}"]) for axis in range(naxis, 0, -1)),
+            bitpix=int(cards.get("BITPIX", 0)),
+            header=cards,
+        )
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Skipping {path}: {e}")
+        return None
+
+
+# ---------------------------------------------------------------------------
+# Function: scan
+# Description:
+#   FrameRecords of all complete FITS files below *root* (or of the given
+#   *files*), sorted by path. Headers are read by *workers* threads.
+# ---------------------------------------------------------------------------
+def scan(root=None, cfg=None, recursive=True, workers=DEFAULT_WORKERS, settle=0.0, files=None):
+    if files is not None:
+        entries = []
+        for file in files:
+            try:
+                entries.append((file, os.path.getsize(file)))
+            except OSError as e:
+                print(f"Skipping {file}: {e}")
+    else:
+        entries = iter_fits_files(root, recursive)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        records = pool.map(lambda entry: read_record(entry[0], entry[1], cfg, settle), entries)
+        return sorted((record for record in records if record is not None), key=lambda record: record.path)
+
+
+# ---------------------------------------------------------------------------
+# Main block: list the frames of a directory tree.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scan directories for complete FITS frames.")
+    parser.add_argument("directory", help="root directory")
+    parser.add_argument("-c", "--config", type=str, help="Specify path to config file (header keywords)")
+    parser.add_argument("-n", "--no-recursive", action="store_true", help="only scan the top directory")
+    parser.add_argument("-j", "--jobs", type=int, default=DEFAULT_WORKERS, help="header reading threads")
+    parser.add_argument("-s", "--settle", type=float, default=0.0,
+                        help="skip files modified less than this many seconds ago")
+    parser.add_argument("-o", "--output", type=str, help="write the file names to this list file")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.directory):
+        print(f"[ERROR]: '{args.directory}' is not a valid directory.")
+        sys.exit(1)
+    cfg = None
+    if args.config:
+        from calib_config import CalibConfig
+        cfg = CalibConfig(args.config)
+
+    start = time.perf_counter()
+    records = scan(args.directory, cfg, not args.no_recursive, args.jobs, args.settle)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.writelines(record.path + "\n" for record in records)
+    else:
+        for record in records:
+            shape = "x".join(str(n) for n in reversed(record.shape))
+            print(f"{record.path}  {record.imagetyp:8s} {record.filter:6s} {record.exptime:8.2f}  {shape}")
+    print(f"{len(records)} frames in {time.perf_counter() - start:.2f} s", file=sys.stderr)
+    sys.exit(0)
+
+### END
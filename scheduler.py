@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: scheduler.py
+# Description:
+#   Dependency-graph (DAG) scheduler for the pipeline stages.
+#   Tasks name the tasks whose results they need. A task is started as
+#   soon as all of them have finished, on a pool of worker threads, so
+#   independent work of different stages runs at the same time (e.g. master
+#   flats of one filter while science frames are still dark corrected).
+#   Numpy and FITS I/O release the GIL; tasks running a whole script start
+#   it as a subprocess and only wait for it in their thread.
+#   A failed task marks every task depending on it as skipped; the other
+#   branches of the graph still run.
+# =============================================================================
+
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# ---------------------------------------------------------------------------
+# Class: Task
+# ---------------------------------------------------------------------------
+class Task:
+    def __init__(self, name, function, args=(), kwargs=None, deps=()):
+        self.name = name
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.deps = tuple(deps)
+
+
+# ---------------------------------------------------------------------------
+# Function: run_command
+# Description:
+#   Runs a pipeline script as a subprocess; raises on a non-zero exit code.
+# ---------------------------------------------------------------------------
+def run_command(command):
+    result = subprocess.run(command)
+    if result.returncode != 0:
+        raise RuntimeError(f"'{' '.join(command)}' exited with code {result.returncode}")
+    return result.returncode
+
+
+# ---------------------------------------------------------------------------
+# Class: Scheduler
+# Description:
+#   Collects tasks with add() and runs the graph with run(). Results of
+#   finished tasks are in .results, errors in .failed, tasks not run
+#   because of a failed dependency in .skipped.
+# ---------------------------------------------------------------------------
+class Scheduler:
+    def __init__(self, workers=None, verbose=False):
+        self.workers = workers
+        self.verbose = verbose
+        self.tasks = {}
+        self.results = {}
+        self.failed = {}
+        self.skipped = []
+
+    def add(self, name, function, *args, deps=(), **kwargs):
+        if name in self.tasks:
+            raise ValueError(f"Task '{name}' defined twice.")
+        self.tasks[name] = Task(name, function, args, kwargs, deps)
+        return name
+
+    # -----------------------------------------------------------------------
+    # Method: order
+    # Description:
+    #   Topological order of the tasks; raises on unknown dependencies and
+    #   cycles.
+    # -----------------------------------------------------------------------
+    def order(self):
+        for task in self.tasks.values():
+            for dep in task.deps:
+                if dep not in self.tasks:
+                    raise ValueError(f"Task '{task.name}' depends on unknown task '{dep}'.")
+        ordered, state = [], {}
+
+        def visit(name):
+            if state.get(name) == "done":
+                return
+            if state.get(name) == "visiting":
+                raise ValueError(f"Dependency cycle through task '{name}'.")
+            state[name] = "visiting"
+            for dep in self.tasks[name].deps:
+                visit(dep)
+            state[name] = "done"
+            ordered.append(name)
+
+        for name in self.tasks:
+            visit(name)
+        return ordered
+
+    def _log(self, message):
+        if self.verbose:
+            print(f"[{time.strftime('%H:%M:%S')}] {message}", flush=True)
+
+    # -----------------------------------------------------------------------
+    # Method: run
+    # Description:
+    #   Runs all tasks; returns True if none failed.
+    # -----------------------------------------------------------------------
+    def run(self):
+        pending = self.order()
+        running = {}
+        started = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or running:
+                # drop tasks whose dependencies failed or were skipped
+                for name in list(pending):
+                    if any(dep in self.failed or dep in self.skipped for dep in self.tasks[name].deps):
+                        pending.remove(name)
+                        self.skipped.append(name)
+                        self._log(f"skipped  {name}")
+                # start every task whose dependencies are all done
+                for name in list(pending):
+                    if all(dep in self.results for dep in self.tasks[name].deps):
+                        pending.remove(name)
+                        task = self.tasks[name]
+                        started[name] = time.perf_counter()
+                        running[pool.submit(task.function, *task.args, **task.kwargs)] = name
+                        self._log(f"started  {name}")
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    elapsed = time.perf_counter() - started[name]
+                    try:
+                        self.results[name] = future.result()
+                        self._log(f"finished {name} ({elapsed:.1f} s)")
+                    except Exception as e:
+                        self.failed[name] = e
+                        print(f"[ERROR]: Task '{name}' failed: {e}")
+        return not self.failed
+
+### END
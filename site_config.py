@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: site_config.py
+# Description:
+#   Parsed observatory configurations and their selection from headers.
+#   - SiteConfig: one config file parsed once into lookup tables:
+#       * filter aliases -> filter name ([HEADER_SPECIFICATION] filters and
+#         the optional [FILTER_ALIASES] section, e.g. 'V = V, Johnson-V'),
+#       * header image-type labels -> BIAS/DARK/FLAT/OBJECT
+#         ([HEADER_SPECIFICATION] bias_label, dark_label, flat_label,
+#         object_label),
+#       * telescope and camera ([GENERAL]) the config is meant for,
+#   - ConfigRegistry: all configs of a directory; selects the config of a
+#     frame by its TELESCOP/INSTRUME header keywords and splits mixed
+#     batches by config (calib.py -c auto).
+# =============================================================================
+
+import re
+import sys
+import argparse
+import functools
+from collections import defaultdict
+from pathlib import Path
+from astropy.io import fits
+from calib_config import CalibConfig
+
+
+DEFAULT_CONFIG_DIR = "./config"
+UNKNOWN_FILTER = "UNKNOWN"
+# filters accepted when a config does not list any
+DEFAULT_FILTERS = ["U", "B", "V", "R", "I", "Haw", "Han", "None", "-"]
+IMAGE_TYPES = ("BIAS", "DARK", "FLAT", "OBJECT")
+
+
+def _as_list(value):
+    if value is None:
+        return []
+    return [str(v) for v in value] if isinstance(value, list) else [str(value)]
+
+
+def _normalized(value):
+    return re.sub(r"[\s_]+", "-", str(value).strip()).upper()
+
+
+# ---------------------------------------------------------------------------
+# Class: SiteConfig
+# Description:
+#   One config file with its lookup tables. *cfg* is the CalibConfig of
+#   *path* (read from *path* if not given); without both the defaults are
+#   used.
+# ---------------------------------------------------------------------------
+class SiteConfig:
+    def __init__(self, path=None, cfg=None):
+        self.path = str(path) if path else ""
+        if cfg is None and self.path:
+            cfg = CalibConfig(self.path)
+        self.cfg = cfg
+        self.name = Path(self.path).stem
+
+        header = self.section("HEADER_SPECIFICATION")
+        self.filter_keyword = header.get("filters_keyword", "FILTER")
+        self.image_type_keyword = header.get("image_type_keyword", "IMAGETYP")
+        self.telescope_keyword = header.get("telescope_keyword", "TELESCOP")
+        self.camera_keyword = header.get("camera_keyword", "INSTRUME")
+
+        self.filters = {}
+        for name in _as_list(header.get("filters")) or DEFAULT_FILTERS:
+            self.filters[name.upper()] = name
+        for name, aliases in self.section("FILTER_ALIASES").items():
+            self.filters[name.upper()] = name
+            for alias in _as_list(aliases):
+                self.filters[alias.strip().upper()] = name
+
+        self.image_types = {}
+        for image_type in IMAGE_TYPES:
+            label = header.get(image_type.lower() + "_label", image_type)
+            self.image_types[str(label).strip().upper()] = image_type
+
+        self.telescope = self.section("GENERAL").get("telescope")
+        self.camera = self.section("GENERAL").get("camera")
+
+    def section(self, name):
+        return self.cfg.get_section(name) if self.cfg is not None else {}
+
+    def filter_of(self, header):
+        '''Filter name of a frame, UNKNOWN for filters not in the config.'''
+        value = str(header.get(self.filter_keyword, "")).strip().upper()
+        return self.filters.get(value, UNKNOWN_FILTER)
+
+    def image_type_of(self, header):
+        '''BIAS, DARK, FLAT or OBJECT (other header values are returned as they are).'''
+        value = str(header.get(self.image_type_keyword, "")).strip().upper()
+        return self.image_types.get(value, value)
+
+    # -----------------------------------------------------------------------
+    # Method: match
+    # Description:
+    #   Number of identifiers (telescope, camera) of the config found in the
+    #   header, 0 if any of them differs or the config names none.
+    # -----------------------------------------------------------------------
+    def match(self, header):
+        score = 0
+        for expected, keyword in ((self.telescope, self.telescope_keyword), (self.camera, self.camera_keyword)):
+            if expected is None or str(expected).strip() == "":
+                continue
+            if _normalized(header.get(keyword, "")) != _normalized(expected):
+                return 0
+            score += 1
+        return score
+
+
+# ---------------------------------------------------------------------------
+# Function: from_calib_config
+# Description:
+#   SiteConfig of an already loaded CalibConfig (defaults for None), built
+#   once per config.
+# ---------------------------------------------------------------------------
+@functools.lru_cache(maxsize=None)
+def from_calib_config(cfg):
+    return SiteConfig(getattr(cfg, "path", None), cfg)
+
+
+# ---------------------------------------------------------------------------
+# Class: ConfigRegistry
+# Description:
+#   All config files (*.ini) of *directory*, parsed once.
+# ---------------------------------------------------------------------------
+class ConfigRegistry:
+    def __init__(self, directory=DEFAULT_CONFIG_DIR):
+        self.configs = []
+        for path in sorted(Path(directory).glob("*.ini")):
+            try:
+                self.configs.append(SiteConfig(path))
+            except Exception as e:
+                print(f"Skipping {path}: {e}")
+
+    def select(self, header):
+        '''Best matching SiteConfig of a frame header, None if none matches.'''
+        best, best_score = None, 0
+        for config in self.configs:
+            score = config.match(header)
+            if score > best_score:
+                best, best_score = config, score
+        return best
+
+    # -----------------------------------------------------------------------
+    # Method: partition
+    # Description:
+    #   Splits *files* by matching config. Returns ({config path: [files]},
+    #   [files without a matching config]).
+    # -----------------------------------------------------------------------
+    def partition(self, files):
+        groups, unmatched = defaultdict(list), []
+        for file in files:
+            try:
+                config = self.select(fits.getheader(file))
+            except Exception as e:
+                print(f"Skipping {file}: {e}")
+                continue
+            if config is None:
+                unmatched.append(file)
+            else:
+                groups[config.path].append(file)
+        return dict(groups), unmatched
+
+
+# ---------------------------------------------------------------------------
+# Main block: print the config selected for every frame.
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Select the configuration of FITS frames by their headers.")
+    parser.add_argument("files", nargs="+", help="FITS files")
+    parser.add_argument("-C", "--config-dir", type=str, default=DEFAULT_CONFIG_DIR,
+                        help="directory with the observatory config files")
+    parser.add_argument("-1", "--single", action="store_true",
+                        help="print only the config path; fails unless all frames match the same config")
+    args = parser.parse_args()
+
+    groups, unmatched = ConfigRegistry(args.config_dir).partition(args.files)
+    if args.single:
+        if len(groups) != 1 or unmatched:
+            print(f"[ERROR]: Frames match {len(groups)} configs, {len(unmatched)} match none.", file=sys.stderr)
+            sys.exit(1)
+        print(next(iter(groups)))
+        sys.exit(0)
+    for path, files in sorted(groups.items()):
+        print(f"{len(files):6d}  {path}")
+    if unmatched:
+        print(f"{len(unmatched):6d}  (no matching config)")
+    sys.exit(0)
+
+### END
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: streaming.py
+# Description:
+#   Strip-streaming correction for machines with little memory.
+#   A frame is corrected in bands of rows instead of as a whole:
+#   - each band of the (trimmed) input is read through HDU.section,
+#   - the matching bands of the masters are read the same way
+#     (MasterBands), binned to the frame binning if needed,
+#   - the corrected band is written straight into a preallocated output
+#     file (fits.StreamingHDU), so the full frame never exists in memory.
+#   Memory use is a few bands of rows, independent of the frame size.
+#   The stage modules switch to this mode with [IMAGE_PROCESSING]
+#   strip_rows > 0, or when a whole frame does not fit into the memory
+#   budget (budget.py), and supply the per-band correction as a function.
+#   StackedBands reads a set of frames the same way for the master
+#   combination, one band of the whole stack at a time.
+# =============================================================================
+
+import os
+import numpy as np
+from astropy.io import fits
+from pathlib import Path
+import detector
+import binning
+import masks
+import budget
+
+
+# ---------------------------------------------------------------------------
+# Function: strip_rows_from_config
+# Description:
+#   Number of rows per band, 0 for the usual full-frame correction. Without
+#   a configured strip_rows the height is planned from the memory budget
+#   and the size of the first of *files*.
+# ---------------------------------------------------------------------------
+def strip_rows_from_config(cfg, files=None):
+    rows = max(0, int(cfg.get("IMAGE_PROCESSING", "strip_rows", 0)))
+    plan = budget.plan_from_config(cfg)
+    if rows or plan.unlimited or not files:
+        return rows
+    header = fits.getheader(files[0])
+    return plan.strip_rows(header["NAXIS2"], header["NAXIS1"])
+
+
+# ---------------------------------------------------------------------------
+# Function: row_bands
+# Description:
+#   Consecutive row slices of at most *band_rows* rows covering *height*.
+# ---------------------------------------------------------------------------
+def row_bands(height, band_rows):
+    for start in range(0, height, band_rows):
+        yield slice(start, min(start + band_rows, height))
+
+
+# ---------------------------------------------------------------------------
+# Class: MasterBands
+# Description:
+#   Lazily opened master file delivering bands of rows matched to the
+#   binning of a frame. Only the rows of the requested band are read.
+# ---------------------------------------------------------------------------
+class MasterBands:
+    def __init__(self, path, method=None):
+        self.path = Path(path)
+        self.method = method or binning.master_binning_method(self.path)
+        self._hdul = None
+
+    @property
+    def hdu(self):
+        if self._hdul is None:
+            self._hdul = fits.open(self.path)
+        return self._hdul[0]
+
+    def band(self, rows, width, frame_header):
+        return binning.master_cutout(self.hdu.section, self.hdu.header, rows, slice(0, width),
+                                     frame_header, self.method)
+
+    def close(self):
+        if self._hdul is not None:
+            self._hdul.close()
+            self._hdul = None
+
+
+# ---------------------------------------------------------------------------
+# Class: StackedBands
+# Description:
+#   Frames read as an (N, rows, W) stack band by band, for the master
+#   combination. Trimming and overscan follow [DETECTOR] as in
+#   detector.read_trimmed; without *cfg* (and for frames already trimmed)
+#   the frames are read as they are. With *linearity* (linearity.py) the
+#   raw data and the overscan level are corrected for non-linearity.
+#   bands() yields (row slice, stack band); the band buffer is reused, so
+#   it is only valid until the next band is read.
+# ---------------------------------------------------------------------------
+class StackedBands:
+    def __init__(self, files, cfg=None, dtype=np.float32, linearity=None):
+        self.files = list(files)
+        self.dtype = dtype
+        self.linearity = linearity
+        self._hduls = []
+        self._layouts = []
+        try:
+            for file in self.files:
+                hdul = fits.open(file)
+                self._hduls.append(hdul)
+                hdu = hdul[0]
+                height, width = hdu.shape
+                trim, bias = detector.frame_sections(hdu.header, cfg) if cfg is not None else (None, None)
+                rows, cols = trim if trim is not None else (slice(0, height), slice(0, width))
+                overscan = None
+                if bias is not None:
+                    overscan = detector.overscan_level(hdu, trim, bias,
+                                                       cfg.get("DETECTOR", "overscan_method", "row"))
+                    if linearity is not None:
+                        overscan = linearity.apply(overscan)
+                shape = (rows.stop - rows.start, cols.stop - cols.start)
+                if self._layouts and shape != self.shape:
+                    raise ValueError(f"{file} has shape {shape}, expected {self.shape}")
+                self.shape = shape
+                self._layouts.append((rows, cols, overscan))
+        except Exception:
+            self.close()
+            raise
+
+    def bands(self, band_rows, divisors=None):
+        height, width = self.shape
+        stack = np.empty((len(self.files), min(band_rows, height), width), dtype=self.dtype)
+        for band in row_bands(height, band_rows):
+            part = stack[:, :band.stop - band.start]
+            for i, (hdul, (rows, cols, overscan)) in enumerate(zip(self._hduls, self._layouts)):
+                section = hdul[0].section[rows.start + band.start:rows.start + band.stop, cols]
+                if self.linearity is not None:
+                    self.linearity.apply(section, out=part[i])
+                else:
+                    np.copyto(part[i], section, casting="unsafe")
+                if overscan is not None:
+                    band_overscan = overscan
+                    if np.ndim(overscan) == 2 and overscan.shape[0] > 1:
+                        band_overscan = overscan[band]
+                    np.subtract(part[i], band_overscan, out=part[i], casting="unsafe")
+                if divisors is not None:
+                    np.divide(part[i], np.float32(divisors[i]), out=part[i], casting="unsafe")
+            yield band, part
+
+    def close(self):
+        for hdul in self._hduls:
+            hdul.close()
+        self._hduls = []
+
+
+# ---------------------------------------------------------------------------
+# Function: streaming_header
+# Description:
+#   Header of the float32 output frame of *shape* (rows, columns), with the
+#   scaling keywords of the integer input removed.
+# ---------------------------------------------------------------------------
+def streaming_header(header, shape):
+    header = fits.PrimaryHDU(header=header.copy()).header
+    for keyword in ("BZERO", "BSCALE", "BLANK"):
+        header.remove(keyword, ignore_missing=True)
+    header["BITPIX"] = -32
+    header["NAXIS"] = 2
+    header.set("NAXIS1", shape[1], after="NAXIS")
+    header.set("NAXIS2", shape[0], after="NAXIS1")
+    return header
+
+
+# ---------------------------------------------------------------------------
+# Function: correct_in_strips
+# Description:
+#   Corrects the primary *hdu* band by band and streams the result into
+#   *output_path*.
+#   - correct_band(raw, overscan, rows) returns the corrected float32 band
+#     for the raw input band, its overscan level (or None) and its row
+#     slice in the output frame,
+#   - trimming and overscan follow [DETECTOR] as in detector.read_trimmed,
+#   - with *saturation_level* the saturation flags are packed band by band
+#     into a 'SATMASK' extension,
+#   - *extensions* (HDUs) are appended after the primary HDU,
+#   - *header_cards* (dict) are written with placeholder values first and
+#     filled in after the data from the dict returned by finalize().
+#   Returns the header of the written frame.
+# ---------------------------------------------------------------------------
+def correct_in_strips(hdu, output_path, cfg, correct_band, band_rows, header=None,
+                      saturation_level=None, extensions=(), header_cards=None, finalize=None):
+    header = hdu.header.copy() if header is None else header
+    height, width = hdu.shape
+    trim, bias = detector.frame_sections(header, cfg)
+    rows, cols = trim if trim is not None else (slice(0, height), slice(0, width))
+    out_height, out_width = rows.stop - rows.start, cols.stop - cols.start
+
+    overscan = None
+    if bias is not None:
+        overscan = detector.overscan_level(hdu, trim, bias, cfg.get("DETECTOR", "overscan_method", "row"))
+    if trim is not None or bias is not None:
+        detector.update_header(header, trim, overscan)
+    header = streaming_header(header, (out_height, out_width))
+    for keyword, card in (header_cards or {}).items():
+        header[keyword] = card
+
+    packed, nsat = None, 0
+    if saturation_level is not None:
+        packed = np.zeros((out_height, (out_width + 7) // 8), dtype=np.uint8)
+
+    # StreamingHDU appends to existing files: write a fresh temporary file
+    # and move it into place when complete
+    part_path = str(output_path) + ".part"
+    Path(part_path).unlink(missing_ok=True)
+    output = fits.StreamingHDU(part_path, header)
+    try:
+        for band in row_bands(out_height, band_rows):
+            raw = hdu.section[rows.start + band.start:rows.start + band.stop, cols]
+            band_overscan = overscan
+            if overscan is not None and np.ndim(overscan) == 2 and overscan.shape[0] > 1:
+                band_overscan = overscan[band]
+            if packed is not None:
+                saturated = raw >= saturation_level
+                nsat += int(np.count_nonzero(saturated))
+                packed[band] = masks.pack_flags(saturated)
+            output.write(np.asarray(correct_band(raw, band_overscan, band), dtype=np.float32))
+    finally:
+        output.close()
+
+    if nsat:
+        extensions = [masks.packed_saturation_hdu(packed, out_width, saturation_level, nsat)] + list(extensions)
+    for extension in extensions:
+        fits.append(part_path, extension.data, extension.header)
+    if finalize is not None:
+        for keyword, value in finalize().items():
+            fits.setval(part_path, keyword, value=value)
+            header[keyword] = value
+    os.replace(part_path, output_path)
+    return header
+
+### END
@@ -0,0 +1,406 @@
+#!/usr/bin/env python3
+
+# =============================================================================
+# Filename: workqueue.py
+# Description:
+#   Work queue on a shared filesystem for batch calibration on several
+#   nodes without a scheduler daemon ([QUEUE] queue_dir).
+#   - a task is a command (calib.py on a list of frames) with the tasks it
+#     depends on, stored as tasks/<task>.json,
+#   - the state of a task is a marker file: todo/<task>, claimed/<task>@<worker>,
+#     done/<task>, failed/<task> or skipped/<task>; a worker claims a task
+#     by renaming its marker, which is atomic on POSIX filesystems (also on
+#     Lustre and NFS), so every task is run by exactly one worker,
+#   - workers touch workers/<worker> every [QUEUE] heartbeat_interval
+#     seconds; tasks claimed by a worker without a heartbeat for
+#     heartbeat_timeout seconds are put back to todo (the clocks of the
+#     nodes must be synchronized),
+#   - masters are built once: the '<night>-masters' task of a night makes them in a
+#     staging directory and publishes them into the working directory with
+#     os.replace, before any task using them can be claimed,
+#   - per-frame mode: 'submit' queues the masters task and tasks of
+#     [QUEUE] frames_per_task science frames each,
+#   - per-night mode: 'campaign' queues one task per night of an archive
+#     (campaign.py), nights borrowing masters after their donor nights.
+#   Workers are started in the directory the tasks were submitted from (on
+#   any node); 'worker -n N' starts N local workers, e.g. for testing.
+# =============================================================================
+
+import os
+import sys
+import glob
+import json
+import time
+import shutil
+import socket
+import argparse
+import threading
+import subprocess
+import configparser
+from pathlib import Path
+import budget
+import campaign
+import registry
+import scanner
+import partitions
+import site_config
+from calib_config import CalibConfig
+
+
+DEFAULT_QUEUE_DIR = "./work/queue"
+DEFAULT_HEARTBEAT_INTERVAL = 10.0
+DEFAULT_HEARTBEAT_TIMEOUT = 60.0
+DEFAULT_FRAMES_PER_TASK = 20
+POLL_INTERVAL = 2.0
+STATES = ("todo", "claimed", "done", "failed", "skipped")
+
+
+def worker_name():
+    return f"{socket.gethostname().split('.')[0]}-{os.getpid()}"
+
+
+# ---------------------------------------------------------------------------
+# Function: write_atomic
+# Description:
+#   Writes text to *path* through a temporary file renamed into place.
+# ---------------------------------------------------------------------------
+def write_atomic(path, text):
+    tmp_path = f"{path}.{worker_name()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def copy_atomic(source, destination):
+    tmp_path = f"{destination}.{worker_name()}.tmp"
+    shutil.copy2(source, tmp_path)
+    os.replace(tmp_path, destination)
+
+
+# ---------------------------------------------------------------------------
+# Class: WorkQueue
+# Description:
+#   Task definitions and state markers in *directory*.
+# ---------------------------------------------------------------------------
+class WorkQueue:
+    def __init__(self, directory=DEFAULT_QUEUE_DIR):
+        self.directory = Path(directory)
+        for name in ("tasks", "workers") + STATES:
+            (self.directory / name).mkdir(parents=True, exist_ok=True)
+
+    def marker(self, state, name):
+        return self.directory / state / name
+
+    def names(self, state):
+        return sorted(entry.split("@", 1)[0] for entry in os.listdir(self.directory / state)
+                      if not entry.endswith(".tmp"))
+
+    def task(self, name):
+        with open(self.directory / "tasks" / f"{name}.json", encoding="utf-8") as f:
+            return json.load(f)
+
+    # -----------------------------------------------------------------------
+    # Method: submit
+    # Description:
+    #   Queues a task running *command* in *cwd* after the tasks *deps*.
+    #   *copy* files (glob pattern, directory) are copied before the command
+    #   unless they exist, *publish* files are moved after it. Tasks already
+    #   done are not queued again.
+    # -----------------------------------------------------------------------
+    def submit(self, name, command, deps=(), copy=(), publish=(), cwd=None):
+        task = {"name": name, "command": [str(arg) for arg in command], "deps": list(deps),
+                "copy": [list(map(str, item)) for item in copy],
+                "publish": [list(map(str, item)) for item in publish],
+                "cwd": str(cwd or os.getcwd())}
+        write_atomic(self.directory / "tasks" / f"{name}.json", json.dumps(task, indent=1))
+        if self.marker("done", name).exists():
+            return False
+        for state in ("failed", "skipped"):
+            if self.marker(state, name).exists():
+                os.remove(self.marker(state, name))
+        self.marker("todo", name).touch()
+        return True
+
+    # -----------------------------------------------------------------------
+    # Method: claim
+    # Description:
+    #   Claims the first task whose dependencies are done; None if there is
+    #   none. Losing the rename to another worker just moves on.
+    # -----------------------------------------------------------------------
+    def claim(self, worker):
+        done = set(self.names("done"))
+        for name in self.names("todo"):
+            if not all(dep in done for dep in self.task(name)["deps"]):
+                continue
+            try:
+                os.rename(self.marker("todo", name), self.marker("claimed", f"{name}@{worker}"))
+            except FileNotFoundError:
+                continue
+            return name
+        return None
+
+    def finish(self, name, worker, state, result):
+        try:
+            os.rename(self.marker("claimed", f"{name}@{worker}"), self.marker(state, name))
+        except FileNotFoundError:
+            print(f"Skipping result of task {name}: it was reclaimed from {worker}")
+            return
+        write_atomic(self.marker(state, name), json.dumps(result, indent=1))
+
+    # -----------------------------------------------------------------------
+    # Method: reclaim
+    # Description:
+    #   Puts tasks of workers without a heartbeat for *timeout* seconds back
+    #   to todo; returns their names.
+    # -----------------------------------------------------------------------
+    def reclaim(self, timeout=DEFAULT_HEARTBEAT_TIMEOUT):
+        reclaimed = []
+        now = time.time()
+        for entry in os.listdir(self.directory / "claimed"):
+            if entry.endswith(".tmp") or "@" not in entry:
+                continue
+            name, worker = entry.split("@", 1)
+            try:
+                age = now - os.path.getmtime(self.directory / "workers" / worker)
+            except FileNotFoundError:
+                age = float("inf")
+            if age <= timeout:
+                continue
+            try:
+                os.rename(self.marker("claimed", entry), self.marker("todo", name))
+            except FileNotFoundError:
+                continue
+            print(f"Task {name} reclaimed from {worker} (no heartbeat for {age:.0f} s).")
+            reclaimed.append(name)
+        return reclaimed
+
+    def skip_blocked(self):
+        '''Moves tasks depending on failed or skipped tasks to skipped.'''
+        blocked = set(self.names("failed")) | set(self.names("skipped"))
+        changed = True
+        while changed:
+            changed = False
+            for name in self.names("todo"):
+                if blocked & set(self.task(name)["deps"]):
+                    try:
+                        os.rename(self.marker("todo", name), self.marker("skipped", name))
+                    except FileNotFoundError:
+                        continue
+                    blocked.add(name)
+                    changed = True
+
+    def status(self):
+        return {state: self.names(state) for state in STATES}
+
+
+# ---------------------------------------------------------------------------
+# Class: Worker
+# Description:
+#   Claims and runs tasks until none is left; a thread keeps the heartbeat.
+# ---------------------------------------------------------------------------
+class Worker:
+    def __init__(self, queue, interval=DEFAULT_HEARTBEAT_INTERVAL, timeout=DEFAULT_HEARTBEAT_TIMEOUT,
+                 name=None):
+        self.queue = queue
+        self.interval = interval
+        self.timeout = timeout
+        self.name = name or worker_name()
+        self.heartbeat_path = queue.directory / "workers" / self.name
+        self.current = None
+        self.stopped = threading.Event()
+
+    def heartbeat(self):
+        while not self.stopped.is_set():
+            write_atomic(self.heartbeat_path, json.dumps({"host": socket.gethostname(), "pid": os.getpid(),
+                                                          "task": self.current, "time": time.time()}))
+            self.stopped.wait(self.interval)
+
+    # -----------------------------------------------------------------------
+    # Method: execute
+    # Description:
+    #   Copies the inputs of a task, runs its command and publishes its
+    #   outputs. Returns the result stored with the done/failed marker.
+    # -----------------------------------------------------------------------
+    def execute(self, name):
+        task = self.queue.task(name)
+        start = time.perf_counter()
+        for pattern, directory in task["copy"]:
+            for source in glob.glob(os.path.join(task["cwd"], pattern)):
+                destination = Path(task["cwd"], directory, Path(source).name)
+                if not destination.exists():
+                    copy_atomic(source, destination)
+        returncode = subprocess.run(task["command"], cwd=task["cwd"]).returncode
+        if returncode == 0:
+            for pattern, directory in task["publish"]:
+                for source in glob.glob(os.path.join(task["cwd"], pattern)):
+                    os.replace(source, Path(task["cwd"], directory, Path(source).name))
+        return {"worker": self.name, "returncode": returncode,
+                "seconds": round(time.perf_counter() - start, 1)}
+
+    def run(self):
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+        finished = 0
+        try:
+            while True:
+                name = self.queue.claim(self.name)
+                if name is None:
+                    self.queue.reclaim(self.timeout)
+                    self.queue.skip_blocked()
+                    if not self.queue.names("todo") and not self.queue.names("claimed"):
+                        break
+                    time.sleep(POLL_INTERVAL)
+                    continue
+                self.current = name
+                print(f"[{time.strftime('%H:%M:%S')}] {self.name}: started  {name}", flush=True)
+                try:
+                    result = self.execute(name)
+                except Exception as e:
+                    result = {"worker": self.name, "error": str(e)}
+                state = "done" if result.get("returncode") == 0 else "failed"
+                self.queue.finish(name, self.name, state, result)
+                print(f"[{time.strftime('%H:%M:%S')}] {self.name}: {state:8s} {name}", flush=True)
+                self.current = None
+                finished += 1
+        finally:
+            self.stopped.set()
+            if self.heartbeat_path.exists():
+                os.remove(self.heartbeat_path)
+        return finished
+
+
+# ---------------------------------------------------------------------------
+# Function: derive_config
+# Description:
+#   Writes a copy of *config_file* with [DATA_STRUCTURE] *settings* and
+#   without camera-mode partitioning to *path*.
+# ---------------------------------------------------------------------------
+def derive_config(config_file, path, **settings):
+    parser = configparser.ConfigParser()
+    parser.optionxform = str  # preserve case sensitivity of keys
+    parser.read(config_file)
+    for section in ("DATA_STRUCTURE", "CAMERA_MODES"):
+        if not parser.has_section(section):
+            parser.add_section(section)
+    for key, value in settings.items():
+        parser.set("DATA_STRUCTURE", key, str(value))
+    parser.set("CAMERA_MODES", "partition_by_mode", "False")
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        parser.write(f)
+
+
+# ---------------------------------------------------------------------------
+# Function: submit_night
+# Description:
+#   Queues the frames of one night (one camera mode, one working directory):
+#   the '<base>-masters' task on the bias, dark and flat frames, then tasks
+#   of *frames_per_task* science frames each using the published masters.
+# ---------------------------------------------------------------------------
+def submit_night(queue, files, config_file, cfg, base_name, frames_per_task, jobs):
+    site = site_config.from_calib_config(cfg)
+    records = scanner.scan(cfg=cfg, files=files)
+    calibration = [r.path for r in records if site.image_type_of(r.header) in ("BIAS", "DARK", "FLAT")]
+    science = [r.path for r in records if site.image_type_of(r.header) == "OBJECT"]
+    working_dir = Path(cfg.get("DATA_STRUCTURE", "working_dir", "./work"))
+    python = sys.executable
+
+    staging_config = working_dir / "staging" / "config.ini"
+    partitions.write_partition_config(config_file, cfg, "staging", staging_config)
+    list_path = f"{base_name}-masters.lst"
+    registry.write_list(list_path, calibration)
+    mask_name = cfg.get("MASKS", "bad_pixel_mask_file", "badpixmask.fits")
+    masters = f"{base_name}-masters"
+    queue.submit(masters, [python, "calib.py", "-l", list_path, "-c", staging_config, "-j", jobs],
+                 publish=[(working_dir / "staging" / "master*", working_dir),
+                          (working_dir / "staging" / mask_name, working_dir)])
+
+    size = max(1, int(frames_per_task))
+    for number, start in enumerate(range(0, len(science), size)):
+        name = f"{base_name}-frames-{number:04d}"
+        task_config = queue.directory / "configs" / f"{name}.ini"
+        derive_config(config_file, task_config, frame_registry=queue.directory / "registries" / f"{name}.db")
+        list_path = f"{name}.lst"
+        registry.write_list(list_path, science[start:start + size])
+        queue.submit(name, [python, "calib.py", "-l", list_path, "-c", task_config, "-j", jobs],
+                     deps=[masters])
+    return len(calibration), len(science)
+
+
+# ---------------------------------------------------------------------------
+# Function: submit_campaign
+# Description:
+#   Queues one task per night of an archive not completed yet; a night
+#   borrowing masters depends on its donor nights and copies their masters
+#   before it runs.
+# ---------------------------------------------------------------------------
+def submit_campaign(queue, run, jobs):
+    submitted = 0
+    for night in run.scan().values():
+        if run.completed(night.name):
+            continue
+        copy = []
+        for donor, sources in run.borrowed_masters(night).values():
+            copy += [(path, run.night_dir(night.name)) for path in sources]
+            copy.append((run.night_dir(donor) / run.mask_name(), run.night_dir(night.name)))
+        deps = sorted({f"night-{donor}" for donor in night.donors.values() if not run.completed(donor)})
+        submitted += queue.submit(f"night-{night.name}", run.prepare_night(night, jobs), deps=deps,
+                                  copy=copy)
+    return submitted
+
+
+# ---------------------------------------------------------------------------
+# Main block
+# ---------------------------------------------------------------------------
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Work queue for calibration on several nodes.")
+    parser.add_argument("action", choices=["submit", "campaign", "worker", "status"],
+                        help="submit: queue a night (-l/-d); campaign: queue the nights of an archive "
+                             "(-d); worker: run queued tasks; status: show the queue")
+    parser.add_argument("-c", "--config", type=str, default="config.ini", help="Specify path to config file")
+    parser.add_argument("-d", "--directory", type=str, help="directory with the FITS files")
+    parser.add_argument("-l", "--list", type=str, help="list file with FITS names")
+    parser.add_argument("-n", "--workers", type=int, default=1, help="local workers to start (worker)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="calib.py workers of every task")
+    args = parser.parse_args()
+
+    cfg = CalibConfig(args.config)
+    queue = WorkQueue(cfg.get("QUEUE", "queue_dir", DEFAULT_QUEUE_DIR))
+
+    if args.action == "submit":
+        if args.directory:
+            files = [record.path for record in scanner.scan(args.directory, cfg, recursive=False)]
+            base_name = Path(args.directory).resolve().name
+        elif args.list:
+            files = [str(Path(p).expanduser().resolve()) for p in registry.read_list(args.list)]
+            base_name = Path(args.list).stem
+        else:
+            print("[ERROR]: submit needs a directory (-d) or a list file (-l).")
+            sys.exit(1)
+        n_calibration, n_science = submit_night(queue, files, args.config, cfg, base_name,
+                                                cfg.get("QUEUE", "frames_per_task", DEFAULT_FRAMES_PER_TASK),
+                                                args.jobs)
+        print(f"Queued {n_calibration} calibration and {n_science} science frames in '{queue.directory}'.")
+    elif args.action == "campaign":
+        if not args.directory or not os.path.isdir(args.directory):
+            print("[ERROR]: campaign needs the root directory of the archive (-d).")
+            sys.exit(1)
+        run = campaign.Campaign(args.directory, args.config, cfg, args.jobs)
+        print(f"Queued {submit_campaign(queue, run, args.jobs)} nights in '{queue.directory}'.")
+    elif args.action == "worker":
+        interval = float(cfg.get("QUEUE", "heartbeat_interval", DEFAULT_HEARTBEAT_INTERVAL))
+        timeout = float(cfg.get("QUEUE", "heartbeat_timeout", DEFAULT_HEARTBEAT_TIMEOUT))
+        if args.workers > 1:
+            # local workers, sharing the memory budget
+            budget.share_between(args.workers)
+            command = [sys.executable, sys.argv[0], "worker", "-c", args.config]
+            workers = [subprocess.Popen(command) for _ in range(args.workers)]
+            sys.exit(max(worker.wait() for worker in workers))
+        finished = Worker(queue, interval, timeout).run()
+        print(f"Worker finished {finished} tasks.")
+    else:
+        for state, names in queue.status().items():
+            print(f"{state:8s} {len(names):5d}  {' '.join(names[:8])}{' ...' if len(names) > 8 else ''}")
+    failed = queue.names("failed") + queue.names("skipped")
+    sys.exit(1 if failed and args.action in ("worker", "status") else 0)
+
+### END